@@ -4,153 +4,341 @@ import extract_mzml_data as exdata
 import numpy as np
 import pandas as pd
 import os
-from utils import ppm_diff, find_nearest, _is_blank, print_progress_bar
+import json
+import shutil
+import hashlib
+import asyncio
+import functools
+import collections
+import concurrent.futures
+from utils import ppm_diff, print_progress_bar
 from raw_file_validation import get_raw_file_age, check_file_collection_method
-from raw_to_mzml import _raw_to_mzml
+from raw_to_mzml import ConversionPool, _remove_mzml
+from pipeline import PipelineStage, run_pipeline
+from results import ResultTable, initialize_table, get_table_columns, write_table_part, read_table, rewrite_table, compact_table
 import plots
-from dataset import File, filename_categories_vocab
+import spectral_cache
+import sqlite_store
+from dataset import File, _parse_file_name
+
+#result tables in data_store, one directory of .npz parts each or tables of results.db with the sqlite store
+store_backends = ['npz', 'sqlite']
+store_names = ['ms1_peak_data', 'ms1_tic_data', 'ms2_peak_data']
+
+ms1_peak_cols = ['file_name',
+                 'run_num',
+                 'file_category',
+                 'polarity',
+                 'compound_name',
+                 'retention_time',
+                 'theoretical_mz',
+                 'observed_mz',
+                 'ppm_error',
+                 'observed_intensity']
+
+ms1_tic_cols = ['file_name', 
+                'run_num',
+                'file_category',
+                'polarity',
+                'group',
+                'ms1_tic']
+
+ms2_peak_cols = ['file_name', 
+                 'run_num',
+                 'file_category',
+                 'polarity',
+                 'precursor_name',
+                 'precursor_mz',
+                 'theoretical_mz',
+                 'observed_mz',
+                 'ppm_error',
+                 'observed_intensity']
+
+store_columns = [ms1_peak_cols, ms1_tic_cols, ms2_peak_cols]
+
+#sqlite indexes for slices of one compound or precursor and for the rows of one file
+store_indexes = {'ms1_peak_data':[('compound_name', 'polarity', 'run_num'), ('file_name',)],
+                 'ms1_tic_data':[('file_name',)],
+                 'ms2_peak_data':[('precursor_name', 'polarity', 'run_num'), ('file_name',)]}
+
+def _get_table_dir(current_dir, store_name):
+    return os.path.join(current_dir, 'data_store', store_name)
+
+def _get_export_dir(current_dir):
+    return os.path.join(current_dir, 'data_store', 'export')
+
+def _get_db_path(current_dir):
+    return os.path.join(current_dir, 'data_store', 'results.db')
+
+def _check_store(store):
+    if store not in store_backends:
+        raise ValueError('Unknown result store {store}, expected one of {stores}'.format(store=store, stores=store_backends))
+
+def _get_store_columns(current_dir, store_name, store='npz'):
+    if store == 'sqlite':
+        return sqlite_store.get_db_columns(_get_db_path(current_dir), store_name)
+    return get_table_columns(_get_table_dir(current_dir, store_name))
+
+def initialize_data_storage(current_dir, resume=False, store='npz'):
+    """Create empty result stores, with resume the existing stores are kept. Returns True if they were kept."""
+
+    _check_store(store)
+
+    #a resumed run keeps appending to the stores of its checkpointed files, stores written with other columns start over
+    if resume and all(_get_store_columns(current_dir, store_name, store=store) == store_cols
+                      for store_name, store_cols in zip(store_names, store_columns)):
+        return True
+
+    shutil.rmtree(_get_export_dir(current_dir), ignore_errors=True)
+
+    if store == 'sqlite':
+        sqlite_store.initialize_db(_get_db_path(current_dir), dict(zip(store_names, store_columns)), indexes=store_indexes, trace_columns=['ms1_tic'])
+    else:
+        for store_name, store_cols in zip(store_names, store_columns):
+            initialize_table(_get_table_dir(current_dir, store_name), store_cols)
+
+    if os.path.isfile(os.path.join(current_dir, 'data_store/run_state.json')):
+        os.remove(os.path.join(current_dir, 'data_store/run_state.json'))
+
+    return False
+
+def _write_store_columns(current_dir, table_columns, store='npz'):
+    """Append {store name:{column:values}} to the stores, the sqlite store inserts them in one transaction."""
+
+    if store == 'sqlite':
+        sqlite_store.insert_rows(_get_db_path(current_dir), table_columns)
+        return
+
+    #parts are merged by the writer, readers never change the tables
+    for store_name, columns in table_columns.items():
+        write_table_part(_get_table_dir(current_dir, store_name), columns)
+        compact_table(_get_table_dir(current_dir, store_name))
+
+def _store_data(experiment_ms1_peak_data, experiment_ms1_tic_data, experiment_ms2_peak_data, current_dir, store='npz'):
+    """Append lists of row dicts to the stores, missing columns are stored as NaN."""
+
+    experiment_data = [experiment_ms1_peak_data, experiment_ms1_tic_data, experiment_ms2_peak_data]
+    table_columns = {}
+    for store_name, store_cols, rows in zip(store_names, store_columns, experiment_data):
 
+        if any(rows):
 
-def initialize_data_storage(current_dir):
+            store_df = pd.DataFrame(rows, columns=store_cols)
+            table_columns[store_name] = {column:store_df[column].to_numpy() for column in store_cols}
 
-    ms1_peak_cols = ['file_name',
-                     'run_num',
-                     'file_category',
-                     'polarity',
-                     'compound_name',
-                     'retention_time',
-                     'theoretical_mz',
-                     'observed_mz',
-                     'ppm_error',
-                     'observed_intensity']
+    _write_store_columns(current_dir, table_columns, store=store)
 
-    ms1_tic_cols = ['file_name', 
-                    'run_num',
-                    'file_category',
-                    'polarity',
-                    'group',
-                    'ms1_tic']
+class ResultWriter():
+    """Typed column buffers of the result stores, analyzed files are appended and flushed every flush_rows rows.
 
-    ms2_peak_cols = ['file_name', 
-                    'run_num',
-                    'file_category',
-                    'polarity',
-                    'theoretical_mz', 
-                    'observed_mz',
-                    'ppm_error',
-                    'observed_intensity']
+    flush_rows=0 flushes after every file. Files are only checkpointed once their rows are flushed.
+    """
 
-    pd.DataFrame(columns=ms1_peak_cols).to_csv(os.path.join(current_dir, 'data_store/ms1_peak_data.csv'), index=False)
-    pd.DataFrame(columns=ms1_tic_cols).to_csv(os.path.join(current_dir, 'data_store/ms1_tic_data.csv'), index=False)
-    pd.DataFrame(columns=ms2_peak_cols).to_csv(os.path.join(current_dir, 'data_store/ms2_peak_data.csv'), index=False)
+    def __init__(self, current_dir, flush_rows=0, store='npz'):
+        self.current_dir = current_dir
+        self.flush_rows = flush_rows
+        self.store = store
+        self.tables = [ResultTable(store_cols) for store_cols in store_columns]
 
+    def append_file(self, file_results):
+        """Append the (ms1 peak blocks, ms1 tic blocks, ms2 peak blocks) of one file."""
 
-def _store_data(experiment_ms1_peak_data, experiment_ms1_tic_data, experiment_ms2_peak_data, current_dir):
+        for table, blocks in zip(self.tables, file_results):
+            for block in blocks:
+                table.append(block)
 
-    if any(experiment_ms1_peak_data):
+    def is_due(self):
+        return sum(len(table) for table in self.tables) >= self.flush_rows
 
-        ms1_df = pd.DataFrame(experiment_ms1_peak_data)
-        ms1_df.to_csv(os.path.join(current_dir, 'data_store/ms1_peak_data.csv'), mode='a', index=False, header=False)
+    def flush(self):
+        table_columns = {store_name:table.get_columns() for store_name, table in zip(store_names, self.tables) if len(table) > 0}
+        if len(table_columns) > 0:
+            _write_store_columns(self.current_dir, table_columns, store=self.store)
+            for table in self.tables:
+                table.clear()
 
-    if any(experiment_ms1_tic_data):
+def query_data_storage(current_dir, store_name, store='npz', **filters):
+    """Rows of one stored table, filters are column=value or column=[values], e.g. compound_name='caffeine', polarity='POS'.
 
-        ms1_tic_df = pd.DataFrame(experiment_ms1_tic_data)
-        ms1_tic_df.to_csv(os.path.join(current_dir, 'data_store/ms1_tic_data.csv'), mode='a', index=False, header=False)
+    The sqlite store only reads the matching rows.
+    """
 
-    if any(experiment_ms2_peak_data):
+    _check_store(store)
 
-        ms2_df = pd.DataFrame(experiment_ms2_peak_data)
-        ms2_df.to_csv(os.path.join(current_dir, 'data_store/ms2_peak_data.csv'), mode='a', index=False, header=False)
+    if store == 'sqlite':
+        return sqlite_store.query_table(_get_db_path(current_dir), store_name, **filters)
 
-def read_data_storage(current_dir):
+    table_df = read_table(_get_table_dir(current_dir, store_name))
+    for column, values in filters.items():
+        values = values if isinstance(values, (list, tuple, set, np.ndarray, pd.Series)) else [values]
+        table_df = table_df[table_df[column].isin(values)]
 
-    ms1_df = pd.read_csv(os.path.join(current_dir, 'data_store/ms1_peak_data.csv'))
-    ms1_tic_df = pd.read_csv(os.path.join(current_dir, 'data_store/ms1_tic_data.csv'))
-    ms2_df = pd.read_csv(os.path.join(current_dir, 'data_store/ms2_peak_data.csv'))
+    return table_df.reset_index(drop=True)
+
+def read_data_storage(current_dir, store='npz'):
+    """Stored (ms1 peak, ms1 tic, ms2 peak) tables, ms1_tic holds a float32 [tic, rt] array per file."""
+
+    ms1_df = query_data_storage(current_dir, 'ms1_peak_data', store=store)
+    ms1_tic_df = query_data_storage(current_dir, 'ms1_tic_data', store=store)
+    ms2_df = query_data_storage(current_dir, 'ms2_peak_data', store=store)
 
     return ms1_df, ms1_tic_df, ms2_df
 
-def close_data_storage(current_dir):
-    os.remove(os.path.join(current_dir, 'data_store/ms1_peak_data.csv'))
-    os.remove(os.path.join(current_dir, 'data_store/ms1_tic_data.csv'))
-    os.remove(os.path.join(current_dir, 'data_store/ms2_peak_data.csv'))
+def close_data_storage(current_dir, store='npz'):
+    """Remove the run checkpoint, the export pages and the npz stores, results.db of the sqlite store is kept for readers until the next run."""
 
-def _collect_ms1_peak_data(file, atlas_df, polarity,use_rt_filtering=True, tolerance=0.0015):
+    if store == 'npz':
+        for store_name in store_names:
+            shutil.rmtree(_get_table_dir(current_dir, store_name), ignore_errors=True)
 
-    file_peak_data = []
-    for idx, row in atlas_df.iterrows():
+    shutil.rmtree(_get_export_dir(current_dir), ignore_errors=True)
 
-        theoretical_mz = row['{pol}_mz'.format(pol=polarity)]
+    if os.path.isfile(os.path.join(current_dir, 'data_store/run_state.json')):
+        os.remove(os.path.join(current_dir, 'data_store/run_state.json'))
 
-        if use_rt_filtering:
-            eic = exdata._get_ms1_eic(file.ms1_data, theoretical_mz, rt=row['ideal_rt'], tolerance=tolerance)
-        else:
-            eic = exdata._get_ms1_eic(file.ms1_data, theoretical_mz, tolerance=tolerance)
-        
-        rt, mz, i = exdata._get_peak_data(eic)
-
-        peak_data = {'file_name':file.name,
-                     'run_num':file.run_num,
-                     'file_category':file.category,
-                     'polarity':polarity,
-                     'compound_name':row['compound_name'],
-                     'retention_time':rt,
-                     'theoretical_mz':theoretical_mz,
-                     'observed_mz':mz,
-                     'ppm_error':ppm_diff(mz, theoretical_mz),
-                     'observed_intensity':i}
-
-        file_peak_data.append(peak_data)
+def get_experiment_store_dir(current_dir, experiment_dir):
+    """Directory holding the data_store of one experiment, keeps concurrent runs and daemon experiments apart."""
 
-    return file_peak_data
+    experiment_dir = os.path.abspath(experiment_dir)
+    experiment_key = '{name}_{dir_hash}'.format(name=os.path.basename(experiment_dir), dir_hash=hashlib.sha1(experiment_dir.encode()).hexdigest()[:8])
 
-def _collect_ms2_null_peaks(ms2_diagnostic, file):
-    not_found_peaks = []
-    for mz in ms2_diagnostic[file.polarity]['diagnostic_ions']:
+    store_dir = os.path.join(current_dir, 'data_store', 'experiments', experiment_key)
+    os.makedirs(os.path.join(store_dir, 'data_store'), exist_ok=True)
 
-        not_found_peaks.append({'file_name':file.name, 
-                                'run_num':file.run_num,
-                                'file_category':file.category,
-                                'polarity':file.polarity,
-                                'theoretical_mz':mz, 
-                                'observed_mz':np.nan,
-                                'ppm_error':np.nan,
-                                'observed_intensity':np.nan})
+    return store_dir
 
-    return not_found_peaks
+def get_default_atlas(current_dir, chromatography):
+    return pd.read_csv(os.path.join(current_dir, 'default_atlases', 'default_{chrom}_atlas.csv'.format(chrom=chromatography.lower())))
 
-def _collect_matching_ms2_peaks(ms2_spec, ms2_diagnostic, file, frag_tolerance=0.02):
+def load_ms2_panel(panel_path):
+    """MS2 diagnostic panel {polarity:[{'name', 'pmz', 'diagnostic_ions'}]} from a csv with one row per fragment ion.
 
-    found_peaks = []
-    for mz in ms2_diagnostic[file.polarity]['diagnostic_ions']:
-        idx = np.isclose(ms2_spec[0], mz, atol=frag_tolerance)
+    Columns are precursor_name, polarity, precursor_mz and fragment_mz, entries keep the order of the file. Entries are
+    keyed by precursor_name and polarity, the positive and negative mode entries of a precursor share its name.
+    """
 
-        if idx.any():
+    panel_df = pd.read_csv(panel_path)
 
-            filtered_mzs = ms2_spec[0][idx]
-            filtered_is = ms2_spec[1][idx]
+    duplicate_entries = panel_df.drop_duplicates(['precursor_name', 'polarity', 'precursor_mz']).duplicated(['precursor_name', 'polarity'])
+    if duplicate_entries.any():
+        raise ValueError('MS2 panel {path} has precursor names used for several precursor m/z of one polarity'.format(path=panel_path))
 
-            nearest_mz_idx = find_nearest(filtered_mzs, mz)
-            nearest_mz = filtered_mzs[nearest_mz_idx]
-            nearest_mz_intensity = filtered_is[nearest_mz_idx]
+    ms2_diagnostic = {}
+    for (precursor_name, polarity, precursor_mz), fragment_df in panel_df.groupby(['precursor_name', 'polarity', 'precursor_mz'], sort=False):
+        ms2_diagnostic.setdefault(polarity, []).append({'name':precursor_name,
+                                                        'pmz':precursor_mz,
+                                                        'diagnostic_ions':fragment_df['fragment_mz'].tolist()})
 
-            found_peaks.append({'file_name':file.name, 
-                                'run_num':file.run_num,
-                                'file_category':file.category,
-                                'polarity':file.polarity,
-                                'theoretical_mz':mz, 
-                                'observed_mz':nearest_mz,
-                                'ppm_error':ppm_diff(nearest_mz, mz),
-                                'observed_intensity':nearest_mz_intensity})
-        else:
-            found_peaks.append({'file_name':file.name,
-                                'run_num':file.run_num, 
-                                'file_category':file.category,
-                                'polarity':file.polarity,
-                                'theoretical_mz':mz, 
-                                'observed_mz':np.nan,
-                                'ppm_error':np.nan,
-                                'observed_intensity':np.nan})
+    return ms2_diagnostic
+
+def load_run_state(current_dir, experiment_dir):
+    """Checkpointed files {file_name:[size, mtime_ns]} of an unfinished run of experiment_dir, empty if there is none."""
+
+    try:
+        with open(os.path.join(current_dir, 'data_store/run_state.json')) as state_file:
+            run_state = json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+    if run_state.get('directory') != os.path.abspath(experiment_dir):
+        return {}
+
+    return run_state['files']
+
+def save_run_state(current_dir, dataset):
+    state_path = os.path.join(current_dir, 'data_store/run_state.json')
+    with open(state_path + '.tmp', 'w') as state_file:
+        json.dump({'directory':os.path.abspath(dataset.path), 'files':dataset.analyzed_stats}, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+def resume_data_storage(current_dir, dataset, store='npz'):
+    """Drop stored results of files that are not checkpointed, i.e. changed since the last run or stored right before a crash."""
+
+    file_names = set(os.path.basename(file).split('.')[0] for file in dataset.analyzed_files)
+    for store_name in store_names:
+        if store == 'sqlite':
+            db_path = _get_db_path(current_dir)
+            stored_file_names = sqlite_store.get_distinct_values(db_path, store_name, 'file_name')
+            sqlite_store.delete_rows(db_path, store_name, 'file_name', [file_name for file_name in stored_file_names if file_name not in file_names])
+            continue
+
+        table_dir = _get_table_dir(current_dir, store_name)
+        store_df = read_table(table_dir)
+
+        is_checkpointed = store_df['file_name'].isin(file_names)
+        if not is_checkpointed.all():
+            rewrite_table(table_dir, store_df[is_checkpointed])
+        compact_table(table_dir)
+
+def _get_atlas_targets(atlas_df, ms2_diagnostic, tolerance=0.0015):
+    """Per polarity m/z windows (atlas compounds + ms2 precursors) kept by targeted extraction."""
+
+    targets = {}
+    for polarity in ['POS', 'NEG']:
+        target_mzs = atlas_df['{pol}_mz'.format(pol=polarity)].tolist()
+        if polarity in ms2_diagnostic:
+            target_mzs.extend(entry['pmz'] for entry in ms2_diagnostic[polarity])
+
+        targets[polarity] = exdata._build_target_edges(target_mzs, tolerance=tolerance)
+
+    return targets
+
+def _collect_ms1_peak_data(file, atlas_df, polarity,use_rt_filtering=True, tolerance=0.0015):
+
+    theoretical_mzs = atlas_df['{pol}_mz'.format(pol=polarity)].to_numpy()
+
+    if use_rt_filtering:
+        rts, mzs, intensities = exdata._get_batch_peak_data(file.ms1_indexes[polarity], theoretical_mzs, rts=atlas_df['ideal_rt'].to_numpy(), tolerance=tolerance)
+    else:
+        rts, mzs, intensities = exdata._get_batch_peak_data(file.ms1_indexes[polarity], theoretical_mzs, tolerance=tolerance)
+
+    ppm_errors = ppm_diff(mzs, theoretical_mzs)
+
+    #one block of rows per file and polarity, file fields are shared by every row
+    file_peak_data = {'file_name':file.name,
+                      'run_num':file.run_num,
+                      'file_category':file.category,
+                      'polarity':polarity,
+                      'compound_name':atlas_df['compound_name'].to_numpy(dtype=object),
+                      'retention_time':rts,
+                      'theoretical_mz':theoretical_mzs,
+                      'observed_mz':mzs,
+                      'ppm_error':ppm_errors,
+                      'observed_intensity':intensities}
+
+    return file_peak_data
+
+def _collect_ms2_null_peaks(panel_entry, file):
+    diagnostic_ions = np.asarray(panel_entry['diagnostic_ions'], dtype=np.float64)
+
+    not_found_peaks = {'file_name':file.name, 
+                       'run_num':file.run_num,
+                       'file_category':file.category,
+                       'polarity':file.polarity,
+                       'precursor_name':panel_entry['name'],
+                       'precursor_mz':panel_entry['pmz'],
+                       'theoretical_mz':diagnostic_ions, 
+                       'observed_mz':np.full(len(diagnostic_ions), np.nan),
+                       'ppm_error':np.full(len(diagnostic_ions), np.nan),
+                       'observed_intensity':np.full(len(diagnostic_ions), np.nan)}
+
+    return not_found_peaks
+
+def _collect_matching_ms2_peaks(ms2_spec, panel_entry, file, frag_tolerance=0.02):
+
+    diagnostic_ions = np.asarray(panel_entry['diagnostic_ions'], dtype=np.float64)
+    nearest_mzs, nearest_mz_intensities = exdata._get_nearest_peaks(ms2_spec[0], ms2_spec[1], diagnostic_ions, frag_tolerance)
+
+    found_peaks = {'file_name':file.name, 
+                   'run_num':file.run_num,
+                   'file_category':file.category,
+                   'polarity':file.polarity,
+                   'precursor_name':panel_entry['name'],
+                   'precursor_mz':panel_entry['pmz'],
+                   'theoretical_mz':diagnostic_ions, 
+                   'observed_mz':nearest_mzs,
+                   'ppm_error':ppm_diff(nearest_mzs, diagnostic_ions),
+                   'observed_intensity':nearest_mz_intensities}
 
     return found_peaks
 
@@ -168,118 +356,689 @@ def analyze_file_ms1_tic(file):
 def analyze_file_ms1_data(file, atlas_df, tolerance=0.0015):
 
     if file.polarity == 'FPS':
-        file_peak_data = _collect_ms1_peak_data(file, atlas_df, 'POS', tolerance=tolerance) + _collect_ms1_peak_data(file, atlas_df, 'NEG', tolerance=tolerance)
+        file_peak_data = [_collect_ms1_peak_data(file, atlas_df, 'POS', tolerance=tolerance), _collect_ms1_peak_data(file, atlas_df, 'NEG', tolerance=tolerance)]
     else:
-        file_peak_data = _collect_ms1_peak_data(file, atlas_df, file.polarity, tolerance=tolerance)
+        file_peak_data = [_collect_ms1_peak_data(file, atlas_df, file.polarity, tolerance=tolerance)]
 
     return file_peak_data
 
 def analyze_file_ms2_data(file, ms2_diagnostic, tolerance=0.0015, frag_tolerance=0.02):
 
-    file_ms2_peaks = exdata._extract_ms2_data(file.path, ms2_diagnostic[file.polarity]['pmz'], tolerance=tolerance)
+    panel_entries = ms2_diagnostic[file.polarity]
+
+    if file.ms2_data is None:
+        file_ms2_data = [exdata._extract_ms2_data(file.path, entry['pmz'], tolerance=tolerance, top_k=1) for entry in panel_entries]
+    else:
+        file_ms2_data = file.ms2_data
 
-    if len(file_ms2_peaks) > 0:
-        ms2_intensity_sums = [ms2[1].sum() for ms2 in file_ms2_peaks]
-        ms2_i_max_idx = np.argmax(ms2_intensity_sums)
+    file_matching_peaks = []
+    for panel_entry, file_ms2_peaks in zip(panel_entries, file_ms2_data):
 
-        max_ms2_spec = file_ms2_peaks[ms2_i_max_idx]
-        file_matching_peaks =_collect_matching_ms2_peaks(max_ms2_spec, ms2_diagnostic, file, frag_tolerance=frag_tolerance)
+        if len(file_ms2_peaks) > 0:
+            ms2_intensity_sums = [ms2[1].sum() for ms2 in file_ms2_peaks]
+            ms2_i_max_idx = np.argmax(ms2_intensity_sums)
 
-    else:
-        file_matching_peaks = _collect_ms2_null_peaks(ms2_diagnostic, file)
+            max_ms2_spec = file_ms2_peaks[ms2_i_max_idx]
+            file_matching_peaks.append(_collect_matching_ms2_peaks(max_ms2_spec, panel_entry, file, frag_tolerance=frag_tolerance))
+
+        else:
+            file_matching_peaks.append(_collect_ms2_null_peaks(panel_entry, file))
 
     return file_matching_peaks
 
-def analyze_experiment(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance=0.0015, frag_tolerance=0.005):
+def _get_cache_key(file_path, args, ms2_diagnostic, tolerance, targets):
+    if args.cache_dir is None:
+        return None
+    return spectral_cache._get_cache_key(file_path, spectral_cache._get_extraction_params(ms2_diagnostic, tolerance=tolerance, targets=targets))
+
+def _is_file_ready(file_path, args, watcher=None):
+    """Raw files are analyzed once they are old enough and, with a watcher, their acquisition has finished."""
+
+    if get_raw_file_age(file_path) < args.min_file_age:
+        return False
+    if watcher is not None and not watcher.is_complete(file_path):
+        return False
+
+    return True
+
+def _needs_conversion(file_path, args, ms2_diagnostic, tolerance, targets, watcher=None):
+    """True for files the analysis loop will convert: ready, not a skipped blank and not in the spectral cache."""
+
+    if not _is_file_ready(file_path, args, watcher=watcher):
+        return False
+    if args.skip_blanks and _parse_file_name(os.path.basename(file_path).split('.')[0]).is_blank:
+        return False
+
+    cache_key = _get_cache_key(file_path, args, ms2_diagnostic, tolerance, targets)
+    if cache_key is not None and os.path.isdir(os.path.join(args.cache_dir, cache_key)):
+        return False
+
+    return True
+
+def _get_upcoming_conversions(file_paths, args, ms2_diagnostic, tolerance, targets, lookahead, watcher=None):
+    upcoming = []
+    for file_path in file_paths:
+        if len(upcoming) >= lookahead:
+            break
+        if _needs_conversion(file_path, args, ms2_diagnostic, tolerance, targets, watcher=watcher):
+            upcoming.append(file_path)
+    return upcoming
+
+def _load_streamed_file(file_path, mzml_stream, ms2_diagnostic=None, tolerance=0.0015, targets=None):
+    """Stream consumer of the conversion pool, parses the mzml piped from the converter into a File."""
+
+    file_name = os.path.basename(file_path).split('.')[0]
+
+    return File(mzml_stream, file_name, ms2_diagnostic=ms2_diagnostic, tolerance=tolerance, targets=targets, backend='native')
+
+def create_conversion_pool(args, atlas_df, ms2_diagnostic, tolerance=0.0015, workers=None):
+    """Conversion pool for the analysis options, in stream mode its results are parsed Files instead of mzml paths.
+
+    workers defaults to args.convert_workers.
+    """
+
+    stream_consumer = None
+    if args.stream:
+        targets = _get_atlas_targets(atlas_df, ms2_diagnostic, tolerance=tolerance) if args.targeted else None
+        stream_consumer = functools.partial(_load_streamed_file, ms2_diagnostic=ms2_diagnostic, tolerance=tolerance, targets=targets)
+
+    workers = args.convert_workers if workers is None else workers
+    return ConversionPool(workers=workers, timeout=args.convert_timeout, retries=args.convert_retries, stream_consumer=stream_consumer)
 
-    experiment_ms1_peak_data = []
-    experiment_ms2_peak_data = []
-    experiment_ms1_tic_data = []
+class AnalysisInterrupted(Exception):
+    """Raised for files that stop the analysis of an experiment, e.g. profile data or a failed conversion."""
+
+def _check_collection_method(file_path):
+    try:
+        centroid_check = check_file_collection_method(file_path)
+    except:
+        raise AnalysisInterrupted('Unable to determine collection method, check that {filename} is not truncated or corrupt'.format(filename=os.path.basename(file_path)))
+    if not centroid_check:
+        raise AnalysisInterrupted('Data collected in {filename} is not centroid, check method!'.format(filename=os.path.basename(file_path)))
+
+def _load_cached_file(file_path, cache_key, args, ms2_diagnostic, tolerance=0.0015):
+    """File from the spectral cache, None if file_path was not extracted with the same settings before."""
+
+    if cache_key is None:
+        return None
+
+    cached_data = spectral_cache.load_cached_data(args.cache_dir, cache_key)
+    if cached_data is None:
+        return None
+
+    return File(file_path, os.path.basename(file_path).split('.')[0], ms2_diagnostic=ms2_diagnostic, tolerance=tolerance, mzml_data=cached_data)
+
+def _analyze_loaded_file(file, atlas_df, ms2_diagnostic, tolerance=0.0015, frag_tolerance=0.005):
+    file_ms1_data = analyze_file_ms1_data(file, atlas_df, tolerance=tolerance)
+    file_ms1_tic = analyze_file_ms1_tic(file)
+
+    file_matching_peaks = []
+    if file.ms_num == 'MS2' or file.ms_num == 'MSMS':
+
+        file_matching_peaks = analyze_file_ms2_data(file, ms2_diagnostic, tolerance=tolerance, frag_tolerance=frag_tolerance)
+
+    return file_ms1_data, [file_ms1_tic], file_matching_peaks
+
+def _analyze_file(file_path, atlas_df, ms2_diagnostic, args, conversion_pool, tolerance=0.0015, frag_tolerance=0.005, targets=None, upcoming_files=(), watcher=None):
+    """Load (from the spectral cache or a conversion), extract and analyze one raw file.
+
+    Returns the file's ms1 peak, ms1 tic and ms2 peak row blocks. upcoming_files are prefetched by the conversion pool.
+    """
+
+    file_name = os.path.basename(file_path).split('.')[0]
+
+    #files already extracted with the same settings skip the centroid check, conversion and parsing
+    cache_key = _get_cache_key(file_path, args, ms2_diagnostic, tolerance, targets)
+    file = _load_cached_file(file_path, cache_key, args, ms2_diagnostic, tolerance=tolerance)
+    mzml_file_path = None
+
+    if file is None:
+        _check_collection_method(file_path)
+
+        conversion_pool.submit(file_path)
+        conversion_pool.prefetch(_get_upcoming_conversions(upcoming_files, args, ms2_diagnostic, tolerance, targets, args.convert_workers, watcher=watcher))
+        try:
+            conversion_result = conversion_pool.get_result(file_path)
+        except RuntimeError as conversion_error:
+            raise AnalysisInterrupted(str(conversion_error))
+
+        if args.stream:
+            file = conversion_result
+        else:
+            mzml_file_path = conversion_result
+            file = File(mzml_file_path, file_name, ms2_diagnostic=ms2_diagnostic, tolerance=tolerance, targets=targets, backend=args.mzml_backend)
+
+        if cache_key is not None:
+            spectral_cache.store_cached_data(args.cache_dir, cache_key, file.ms1_data, file.ms1_tic, file.ms2_data, max_size_gb=args.cache_size)
+
+    file_results = _analyze_loaded_file(file, atlas_df, ms2_diagnostic, tolerance=tolerance, frag_tolerance=frag_tolerance)
+
+    if mzml_file_path is not None:
+        _remove_mzml(mzml_file_path)
+
+    return file_results
+
+#state of the analysis worker processes, set once per process by _init_analysis_worker
+_worker_state = {}
+
+def _init_analysis_worker(atlas_df, ms2_diagnostic, args, tolerance, frag_tolerance, targets):
+    _worker_state.update(atlas_df=atlas_df, ms2_diagnostic=ms2_diagnostic, args=args, tolerance=tolerance, frag_tolerance=frag_tolerance, targets=targets)
+    #every worker converts only the file it analyzes, so args.workers processes run at most args.workers conversions at once
+    _worker_state['conversion_pool'] = create_conversion_pool(args, atlas_df, ms2_diagnostic, tolerance=tolerance, workers=1)
+
+def _analyze_file_in_worker(file_path, experiment=None):
+    #workers shared by the experiments of the daemon get the (atlas_df, targets, args) of the experiment with every file
+    atlas_df, targets, args = experiment or (_worker_state['atlas_df'], _worker_state['targets'], _worker_state['args'])
+    return _analyze_file(file_path, atlas_df, _worker_state['ms2_diagnostic'], args, _worker_state['conversion_pool'],
+                         tolerance=_worker_state['tolerance'], frag_tolerance=_worker_state['frag_tolerance'], targets=targets)
+
+def _create_analysis_executor(args, atlas_df, ms2_diagnostic, tolerance, frag_tolerance, targets):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=_init_analysis_worker,
+                                                  initargs=(atlas_df, ms2_diagnostic, args, tolerance, frag_tolerance, targets))
+
+def create_analysis_pool(args, atlas_df, ms2_diagnostic, tolerance=0.0015, frag_tolerance=0.005):
+    """Process pool of args.workers analysis workers that can be shared by several experiments, None for one worker."""
+
+    if args.workers <= 1:
+        return None
+
+    targets = _get_atlas_targets(atlas_df, ms2_diagnostic, tolerance=tolerance) if args.targeted else None
+    return _create_analysis_executor(args, atlas_df, ms2_diagnostic, tolerance, frag_tolerance, targets)
+
+def _checkpoint(dataset, result_writer, current_dir):
+    #results are flushed before their files are checkpointed so an interrupted run resumes after the last stored file
+    result_writer.flush()
+    save_run_state(current_dir, dataset)
+
+def _store_file_results(dataset, file_path, file_results, result_writer, current_dir, args):
+    result_writer.append_file(file_results)
+    dataset.add_analyzed_file(file_path)
+    if result_writer.is_due():
+        _checkpoint(dataset, result_writer, current_dir)
+    print_progress_bar(len(dataset.analyzed_files), args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
+
+def _skip_blank_file(dataset, file_path, args):
+    dataset.add_analyzed_file(file_path)
+    print_progress_bar(len(dataset.analyzed_files), args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
+
+def _is_batch_complete(dataset, args, exported_files, num_analyzed=0, max_files=None):
+    if len(dataset.analyzed_files) >= args.num_files:
+        return True
+    elif args.export_num is not None and (len(dataset.analyzed_files) - exported_files) >= args.export_num:
+        return True
+    elif max_files is not None and num_analyzed >= max_files:
+        return True
+    return False
+
+class ParallelAnalysis():
+    """Files of one experiment analyzed in a pool of analysis workers, their results are stored and checkpointed in file order.
+
+    Files are queued in the same order and up to the same batch limits as the sequential loop, so the stored data is identical.
+    With shared_pool, the workers were set up for another experiment and get the atlas, targets and args of this one with every file.
+    """
+
+    def __init__(self, dataset, atlas_df, current_dir, args, exported_files, targets, max_files=None, shared_pool=False):
+        self.dataset = dataset
+        self.current_dir = current_dir
+        self.args = args
+        self.exported_files = exported_files
+        self.max_files = max_files
+        self.experiment = (atlas_df, targets, args) if shared_pool else None
+        self.result_writer = ResultWriter(current_dir, flush_rows=args.flush_rows, store=args.store)
+        self.files_to_analyze = iter(list(dataset.files_to_analyze))
+        self.queued_files = collections.deque() #(file_path, future), future is None for skipped blanks
+        self.num_queued_analyses = 0
+        self.num_analyzed = 0
+        self.is_queued = False
+        self.interrupted = False
+
+    def get_num_running(self):
+        return sum(1 for _, future in self.queued_files if future is not None)
+
+    def get_futures(self):
+        return [future for _, future in self.queued_files if future is not None]
+
+    def is_done(self):
+        return self.interrupted or (self.is_queued and len(self.queued_files) == 0)
+
+    def queue_next_file(self, executor):
+        """Queue the next ready file (and the blanks before it), False once every file of the batch is queued."""
+
+        while not self.is_queued:
+            num_queued_files = len(self.dataset.analyzed_files) + len(self.queued_files)
+            if num_queued_files >= self.args.num_files or (self.args.export_num is not None and num_queued_files - self.exported_files >= self.args.export_num):
+                break
+            if self.max_files is not None and self.num_queued_analyses >= self.max_files:
+                break
+
+            file_path = next(self.files_to_analyze, None)
+            if file_path is None:
+                break
+            if not _is_file_ready(file_path, self.args, watcher=self.dataset.watcher):
+                continue
+
+            if self.args.skip_blanks and _parse_file_name(os.path.basename(file_path).split('.')[0]).is_blank:
+                self.queued_files.append((file_path, None))
+                continue
+
+            self.queued_files.append((file_path, executor.submit(_analyze_file_in_worker, file_path, self.experiment)))
+            self.num_queued_analyses += 1
+            return True
+
+        self.is_queued = True
+        return False
+
+    def store_done_files(self, wait=False):
+        """Store the results of the finished files at the head of the queue, with wait after waiting for the first one."""
+
+        while len(self.queued_files) > 0 and not self.interrupted:
+            file_path, future = self.queued_files[0]
+            if future is not None and not future.done() and not wait:
+                break
+            wait = False
+            self.queued_files.popleft()
+
+            if future is None:
+                _skip_blank_file(self.dataset, file_path, self.args)
+                continue
+
+            try:
+                file_results = future.result()
+            except AnalysisInterrupted as analysis_error:
+                print('\n{error}'.format(error=analysis_error))
+                self.interrupted = True
+                self.cancel()
+                break
+
+            _store_file_results(self.dataset, file_path, file_results, self.result_writer, self.current_dir, self.args)
+            self.num_analyzed += 1
+
+    def cancel(self):
+        """Files queued after an interruption are not analyzed, the pool keeps running."""
+        for _, future in self.queued_files:
+            if future is not None:
+                future.cancel()
+        self.queued_files.clear()
+
+    def finish(self):
+        _checkpoint(self.dataset, self.result_writer, self.current_dir)
+
+def _analyze_experiment_parallel(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance, frag_tolerance, targets, max_files,
+                                 analysis_pool=None):
+    """analyze_experiment with files analyzed in args.workers processes, those of analysis_pool if given."""
+
+    executor = analysis_pool
+    if analysis_pool is None:
+        executor = _create_analysis_executor(args, atlas_df, ms2_diagnostic, tolerance, frag_tolerance, targets)
+    analysis = ParallelAnalysis(dataset, atlas_df, current_dir, args, exported_files, targets, max_files=max_files, shared_pool=analysis_pool is not None)
+    try:
+        #keep every worker busy with one file and one waiting
+        while not analysis.is_done():
+            while analysis.get_num_running() < args.workers * 2 and analysis.queue_next_file(executor):
+                pass
+            analysis.store_done_files(wait=True)
+
+    finally:
+        analysis.cancel()
+        if analysis_pool is None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    analysis.finish()
+
+    return analysis.interrupted
+
+class _PipelineFile():
+    __slots__ = ['file_path', 'is_blank', 'cache_key', 'is_cached', 'mzml_file_path', 'file', 'file_results']
+
+    def __init__(self, file_path, is_blank=False):
+        self.file_path = file_path
+        self.is_blank = is_blank
+        self.cache_key = None
+        self.is_cached = False
+        self.mzml_file_path = None
+        self.file = None
+        self.file_results = None
+
+async def _analyze_experiment_pipeline(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance, frag_tolerance, targets, max_files, conversion_pool, result_writer):
+    """analyze_experiment as an asyncio pipeline, conversions, parsing and analysis of consecutive files overlap.
+
+    Stages: centroid check -> conversion (args.convert_workers async subprocesses) -> parsing -> analysis (args.parse_workers 
+    threads each), connected by bounded queues. At most args.max_parsed parsed files are held in memory. Results are stored 
+    and checkpointed in file order, so the stored data is identical to the sequential loop.
+    """
+
+    analysis_state = {'interrupted':False, 'num_queued':0, 'num_queued_analyses':0}
+    files_to_analyze = iter(list(dataset.files_to_analyze))
+
+    def next_file():
+        while True:
+            num_queued_files = len(dataset.analyzed_files) + analysis_state['num_queued']
+            if num_queued_files >= args.num_files or (args.export_num is not None and num_queued_files - exported_files >= args.export_num):
+                return None
+            if max_files is not None and analysis_state['num_queued_analyses'] >= max_files:
+                return None
+
+            file_path = next(files_to_analyze, None)
+            if file_path is None:
+                return None
+            if not _is_file_ready(file_path, args, watcher=dataset.watcher):
+                continue
+
+            analysis_state['num_queued'] += 1
+            if args.skip_blanks and _parse_file_name(os.path.basename(file_path).split('.')[0]).is_blank:
+                return _PipelineFile(file_path, is_blank=True), False
+
+            analysis_state['num_queued_analyses'] += 1
+            return _PipelineFile(file_path), True
+
+    async def check_file(pipeline_file):
+        #files already extracted with the same settings skip the centroid check and conversion
+        pipeline_file.cache_key = _get_cache_key(pipeline_file.file_path, args, ms2_diagnostic, tolerance, targets)
+        pipeline_file.is_cached = pipeline_file.cache_key is not None and os.path.isdir(os.path.join(args.cache_dir, pipeline_file.cache_key))
+        if not pipeline_file.is_cached:
+            await asyncio.to_thread(_check_collection_method, pipeline_file.file_path)
+
+    async def convert_file(pipeline_file):
+        if pipeline_file.is_cached:
+            return
+        try:
+            if args.stream:
+                pipeline_file.file = await asyncio.to_thread(conversion_pool.get_result, pipeline_file.file_path)
+            else:
+                pipeline_file.mzml_file_path = await conversion_pool.convert_async(pipeline_file.file_path)
+        except RuntimeError as conversion_error:
+            raise AnalysisInterrupted(str(conversion_error))
+
+    async def parse_file(pipeline_file):
+        if pipeline_file.is_cached:
+            pipeline_file.file = await asyncio.to_thread(_load_cached_file, pipeline_file.file_path, pipeline_file.cache_key, args, ms2_diagnostic, tolerance)
+            pipeline_file.is_cached = pipeline_file.file is not None
+
+        if pipeline_file.file is None and pipeline_file.mzml_file_path is None:
+            #evicted from the spectral cache since the check
+            await asyncio.to_thread(_check_collection_method, pipeline_file.file_path)
+            await convert_file(pipeline_file)
+
+        if pipeline_file.file is None:
+            file_name = os.path.basename(pipeline_file.file_path).split('.')[0]
+            pipeline_file.file = await asyncio.to_thread(File, pipeline_file.mzml_file_path, file_name, ms2_diagnostic=ms2_diagnostic, tolerance=tolerance, 
+                                                         targets=targets, backend=args.mzml_backend)
+
+        if pipeline_file.cache_key is not None and not pipeline_file.is_cached:
+            file = pipeline_file.file
+            await asyncio.to_thread(spectral_cache.store_cached_data, args.cache_dir, pipeline_file.cache_key, file.ms1_data, file.ms1_tic, file.ms2_data, max_size_gb=args.cache_size)
+
+    async def analyze_file(pipeline_file):
+        pipeline_file.file_results = await asyncio.to_thread(_analyze_loaded_file, pipeline_file.file, atlas_df, ms2_diagnostic, tolerance, frag_tolerance)
+        pipeline_file.file = None
+
+        if pipeline_file.mzml_file_path is not None:
+            _remove_mzml(pipeline_file.mzml_file_path)
+            pipeline_file.mzml_file_path = None
+
+    def commit_file(pipeline_file, error):
+        if error is not None:
+            discard_file(pipeline_file)
+            if not isinstance(error, AnalysisInterrupted):
+                raise error
+            print('\n{error}'.format(error=error))
+            analysis_state['interrupted'] = True
+            return False
+
+        if pipeline_file.is_blank:
+            _skip_blank_file(dataset, pipeline_file.file_path, args)
+        else:
+            _store_file_results(dataset, pipeline_file.file_path, pipeline_file.file_results, result_writer, current_dir, args)
+
+        return True
+
+    def discard_file(pipeline_file):
+        if pipeline_file.mzml_file_path is not None:
+            _remove_mzml(pipeline_file.mzml_file_path)
+
+    #in stream mode the converter output is parsed while converting, so conversions hold a parsed file slot
+    stages = [PipelineStage(check_file, workers=1),
+              PipelineStage(convert_file, workers=args.convert_workers, holds_memory=args.stream),
+              PipelineStage(parse_file, workers=args.parse_workers, holds_memory=True),
+              PipelineStage(analyze_file, workers=args.parse_workers, holds_memory=True)]
+
+    #without streaming, the conversions run as asyncio subprocesses with the converter settings of the pool
+    own_conversion_pool = conversion_pool is None
+    if own_conversion_pool:
+        conversion_pool = create_conversion_pool(args, atlas_df, ms2_diagnostic, tolerance=tolerance)
+
+    try:
+        await run_pipeline(next_file, stages, commit_file, discard=discard_file, max_in_memory=args.max_parsed)
+    finally:
+        if own_conversion_pool:
+            conversion_pool.shutdown()
+
+    _checkpoint(dataset, result_writer, current_dir)
+
+    return analysis_state['interrupted']
+
+def analyze_experiment(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance=0.0015, frag_tolerance=0.005, conversion_pool=None, max_files=None,
+                       analysis_pool=None):
+
+    targets = None
+    if args.targeted:
+        targets = _get_atlas_targets(atlas_df, ms2_diagnostic, tolerance=tolerance)
+
+    if args.workers > 1 and not args.pipeline:
+        return _analyze_experiment_parallel(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance, frag_tolerance, targets, max_files,
+                                            analysis_pool=analysis_pool)
+
+    #results are buffered in typed columns and flushed to the store every args.flush_rows rows
+    result_writer = ResultWriter(current_dir, flush_rows=args.flush_rows, store=args.store)
+
+    if args.pipeline:
+        return asyncio.run(_analyze_experiment_pipeline(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance, frag_tolerance, targets, max_files, 
+                                                        conversion_pool, result_writer))
 
     analaysis_interrupted = False
+    num_analyzed = 0
 
-    for file_path in dataset.files_to_analyze:
+    #conversions of the next files run in the background while the current file is analyzed
+    own_conversion_pool = conversion_pool is None
+    if own_conversion_pool:
+        conversion_pool = create_conversion_pool(args, atlas_df, ms2_diagnostic, tolerance=tolerance)
+
+    files_to_analyze = list(dataset.files_to_analyze)
+    for file_idx, file_path in enumerate(files_to_analyze):
     
-        file_age = get_raw_file_age(file_path)
-        if file_age < args.min_file_age:
+        if not _is_file_ready(file_path, args, watcher=dataset.watcher):
             continue
 
-        file_name = os.path.basename(file_path).split('.')[0]
-        if args.skip_blanks:
-            is_blank = _is_blank(file_name, filename_categories_vocab)
-            if is_blank:
-                dataset.add_analyzed_file(file_path)
-                print_progress_bar(len(dataset.analyzed_files), args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
-
-                if len(dataset.analyzed_files) >= args.num_files:
-                    break
-                elif (len(dataset.analyzed_files) - exported_files) == args.export_num:
-                    break
-                else:
-                    continue
-        try:
-            centroid_check = check_file_collection_method(file_path)
-            if not centroid_check:
-                print('\nData collected in {filename} is not centroid, check method!'.format(filename=os.path.basename(file_path)))
-                analaysis_interrupted = True
+        if args.skip_blanks and _parse_file_name(os.path.basename(file_path).split('.')[0]).is_blank:
+            _skip_blank_file(dataset, file_path, args)
+            if _is_batch_complete(dataset, args, exported_files):
                 break
-        except:
-            print('\nUnable to determine collection method, check that {filename} is not truncated or corrupt'.format(filename=os.path.basename(file_path)))
+            continue
+
+        try:
+            file_results = _analyze_file(file_path, atlas_df, ms2_diagnostic, args, conversion_pool, tolerance=tolerance, frag_tolerance=frag_tolerance, 
+                                         targets=targets, upcoming_files=files_to_analyze[file_idx + 1:], watcher=dataset.watcher)
+        except AnalysisInterrupted as analysis_error:
+            print('\n{error}'.format(error=analysis_error))
             analaysis_interrupted = True
             break
 
-        conversion_log = _raw_to_mzml(file_path)
-        mzml_dir = conversion_log.args.split('-o=')[1].split(' ')[0]
-        mzml_file_path = os.path.join(mzml_dir, (file_name + '.mzML'))
+        _store_file_results(dataset, file_path, file_results, result_writer, current_dir, args)
+        num_analyzed += 1
 
-        file = File(mzml_file_path, file_name)
+        if _is_batch_complete(dataset, args, exported_files, num_analyzed=num_analyzed, max_files=max_files):
+            break
 
-        file_ms1_data = analyze_file_ms1_data(file, atlas_df, tolerance=tolerance)
-        file_ms1_tic = analyze_file_ms1_tic(file)
+    if own_conversion_pool:
+        conversion_pool.shutdown()
 
-        experiment_ms1_tic_data.append(file_ms1_tic)
-        experiment_ms1_peak_data = experiment_ms1_peak_data + file_ms1_data
+    _checkpoint(dataset, result_writer, current_dir)
 
-        if file.ms_num == 'MS2' or file.ms_num == 'MSMS':
+    return analaysis_interrupted
 
-            file_matching_peaks = analyze_file_ms2_data(file, ms2_diagnostic, tolerance=tolerance, frag_tolerance=frag_tolerance)
-            experiment_ms2_peak_data = experiment_ms2_peak_data + file_matching_peaks
+def _get_rows_digest(table_df):
+    #digest of the files and their order, rows of one file are stored together
+    rows_hash = pd.util.hash_pandas_object(table_df[['file_name', 'run_num', 'polarity']], index=False)
+    return hashlib.sha1(rows_hash.to_numpy().tobytes()).hexdigest()
 
-        os.remove(mzml_file_path)
-        dataset.add_analyzed_file(file_path)
-        print_progress_bar(len(dataset.analyzed_files), args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
+def _get_export_inputs_digest(atlas_df, ms2_diagnostic):
+    atlas_hash = pd.util.hash_pandas_object(atlas_df, index=False).to_numpy().tobytes()
+    return hashlib.sha1(atlas_hash + repr(ms2_diagnostic).encode()).hexdigest()
 
-        if len(dataset.analyzed_files) >= args.num_files:
-            break
-        elif (len(dataset.analyzed_files) - exported_files) == args.export_num:
-            break
+def _load_export_state(export_dir):
+    try:
+        with open(os.path.join(export_dir, 'export_state.json')) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
 
-    _store_data(experiment_ms1_peak_data, experiment_ms1_tic_data, experiment_ms2_peak_data, current_dir)
+def _get_exported_rows(export_state, table_dfs, inputs_digest):
+    """Number of rows of every table exported before, None if those rows or the atlas and panel changed since."""
 
-    return analaysis_interrupted
+    if export_state is None or export_state['inputs'] != inputs_digest:
+        return None
 
-def export_tables_plots(current_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, exported_files):
+    for store_name, table_df in table_dfs.items():
+        num_rows, rows_digest = export_state['tables'][store_name]
+        if len(table_df) < num_rows or _get_rows_digest(table_df.iloc[:num_rows]) != rows_digest:
+            return None
+
+    return {store_name:export_state['tables'][store_name][0] for store_name in table_dfs}
 
-    ms1_peak_data, ms1_tic_data, ms2_peak_data = read_data_storage(current_dir)
-            
-    qc_output_dir = os.path.join(args.directory + '\\qc_output_{exported_files}'.format(exported_files=exported_files))
+def _update_data_sheet(sheet_path, table_df, num_exported):
+    if num_exported == 0 or not os.path.isfile(sheet_path):
+        table_df.to_csv(sheet_path)
+    else:
+        table_df.iloc[num_exported:].to_csv(sheet_path, mode='a', header=False)
+
+def _get_redraw_keys(table_df, column, exported_rows, store_name, file_categories=None):
+    """Values of column in the rows of file_categories added since the last export, None (redraw every page) if
+    everything is exported again."""
+
+    if exported_rows is None:
+        return None
+
+    new_rows = table_df.iloc[exported_rows[store_name]:]
+    if file_categories is not None:
+        new_rows = new_rows[new_rows['file_category'].isin(file_categories)]
 
-    if not os.path.isdir(qc_output_dir):
-        os.mkdir(qc_output_dir)
+    return set(new_rows[column])
 
-    file_name_warnings_df.to_csv(os.path.join(qc_output_dir, 'file_name_warnings_report.csv'))
+def _get_qc_output_dir(directory, output_name):
+    return os.path.join(directory + '\\qc_output_{output_name}'.format(output_name=output_name))
 
-    ms1_peak_data.to_csv(os.path.join(qc_output_dir, 'ms1_data_sheet.csv'))
-    plots.make_ms1_qc_plots(ms1_peak_data, atlas_df, qc_output_dir)
-    plots.make_ms1_qc_plots(ms1_peak_data, atlas_df, qc_output_dir, logy=True)
+def _recover_dir(output_dir):
+    """Moves output_dir.old back when a crash between the two renames of _replace_dir left no output_dir."""
 
-    plots.make_unlabeled_ms1_qc_plots(ms1_peak_data, atlas_df, qc_output_dir)
-    plots.make_unlabeled_ms1_qc_plots(ms1_peak_data, atlas_df, qc_output_dir, logy=True)
+    old_dir = output_dir + '.old'
+    if not os.path.isdir(output_dir) and os.path.isdir(old_dir):
+        os.rename(old_dir, output_dir)
 
-    plots.make_ms1_tic_qc_plots(ms1_tic_data, qc_output_dir, logy=False)
-    plots.make_ms1_tic_qc_plots(ms1_tic_data, qc_output_dir, logy=True)
+def recover_qc_output_dirs(directory):
+    for output_name in ('latest', 'full'):
+        _recover_dir(_get_qc_output_dir(directory, output_name))
 
-    if not ms2_peak_data.empty:
-        ms2_peak_data.to_csv(os.path.join(qc_output_dir, 'ms2_data_sheet.csv'))
-        plots.make_ms2_qc_plots(ms2_peak_data, ms2_diagnostic, qc_output_dir)
-        plots.make_ms2_qc_plots(ms2_peak_data, ms2_diagnostic, qc_output_dir, logy=True)
+def _replace_dir(new_dir, output_dir):
+    """Swaps new_dir in as output_dir. False if output_dir is in use, the previous output is then kept."""
+
+    old_dir = output_dir + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        if os.path.isdir(output_dir):
+            os.rename(output_dir, old_dir)
+    except OSError:
+        return False
+    try:
+        os.rename(new_dir, output_dir)
+    except OSError:
+        _recover_dir(output_dir)
+        return False
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return True
+
+def export_tables_plots(current_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, exported_files):
+    """Export data sheets and qc plots, partial exports replace qc_output_latest and the full export qc_output_full.
+
+    Only the pages of compounds, groups and precursors with new rows since the last export are redrawn and the data
+    sheets are appended to, the pages and sheets are kept in the export dir of the store.
+    """
+
+    ms1_peak_data, ms1_tic_data, ms2_peak_data = read_data_storage(current_dir, store=args.store)
+    table_dfs = {'ms1_peak_data':ms1_peak_data, 'ms1_tic_data':ms1_tic_data, 'ms2_peak_data':ms2_peak_data}
+
+    export_dir = _get_export_dir(current_dir)
+    inputs_digest = _get_export_inputs_digest(atlas_df, ms2_diagnostic)
+    exported_rows = _get_exported_rows(_load_export_state(export_dir), table_dfs, inputs_digest)
+    #digest of the rows in store order, the plots sort them in place
+    export_state = {'inputs':inputs_digest, 'tables':{store_name:[len(table_df), _get_rows_digest(table_df)] for store_name, table_df in table_dfs.items()}}
+    if exported_rows is None:
+        shutil.rmtree(export_dir, ignore_errors=True)
+        os.makedirs(export_dir)
+    else:
+        #an export interrupted while the sheets are appended to starts over
+        os.remove(os.path.join(export_dir, 'export_state.json'))
+    num_exported = exported_rows or {store_name:0 for store_name in table_dfs}
+
+    output_name = 'full' if exported_files == 'full' else 'latest'
+    qc_output_dir = _get_qc_output_dir(args.directory, output_name)
+    _recover_dir(qc_output_dir)
+
+    #the output is written next to the current one and swapped in once complete
+    new_output_dir = qc_output_dir + '.new'
+    shutil.rmtree(new_output_dir, ignore_errors=True)
+    os.mkdir(new_output_dir)
+
+    file_name_warnings_df.to_csv(os.path.join(new_output_dir, 'file_name_warnings_report.csv'))
+
+    ms1_sheet_path = os.path.join(export_dir, 'ms1_data_sheet.csv')
+    _update_data_sheet(ms1_sheet_path, ms1_peak_data, num_exported['ms1_peak_data'])
+    shutil.copy(ms1_sheet_path, os.path.join(new_output_dir, 'ms1_data_sheet.csv'))
+
+    #tic pages also show every ExCtrl run
+    tic_redraw_keys = _get_redraw_keys(ms1_tic_data, 'group', exported_rows, 'ms1_tic_data', file_categories=plots.tic_page_categories)
+    if tic_redraw_keys is not None and (ms1_tic_data['file_category'].iloc[num_exported['ms1_tic_data']:] == 'ExCtrl').any():
+        tic_redraw_keys = None
+
+    pages_dir = os.path.join(export_dir, 'pages')
+    ms1_page_cache = plots.PageCache(pages_dir, _get_redraw_keys(ms1_peak_data, 'compound_name', exported_rows, 'ms1_peak_data', file_categories=plots.ms1_page_categories))
+    unlabeled_page_cache = plots.PageCache(pages_dir, _get_redraw_keys(ms1_peak_data, 'compound_name', exported_rows, 'ms1_peak_data',
+                                                                       file_categories=plots.unlabeled_page_categories))
+    tic_page_cache = plots.PageCache(pages_dir, tic_redraw_keys)
+    ms2_page_cache = plots.PageCache(pages_dir, _get_redraw_keys(ms2_peak_data, 'precursor_name', exported_rows, 'ms2_peak_data'))
+
+    #pages are rendered by args.plot_workers processes
+    render_pool = plots.create_render_pool(args.plot_workers)
+    try:
+        #compound pages are prepared once for the linear and log scale plots
+        ms1_peak_data.sort_values('run_num', inplace=True)
+        ms1_page_data = plots.prepare_ms1_page_data(ms1_peak_data, plots.ms1_page_categories)
+        unlabeled_page_data = plots.prepare_ms1_page_data(ms1_peak_data, plots.unlabeled_page_categories)
+
+        plots.make_ms1_qc_plots(ms1_peak_data, atlas_df, new_output_dir, page_cache=ms1_page_cache, render_pool=render_pool, page_data=ms1_page_data)
+        plots.make_ms1_qc_plots(ms1_peak_data, atlas_df, new_output_dir, logy=True, page_cache=ms1_page_cache, render_pool=render_pool, page_data=ms1_page_data)
+
+        plots.make_unlabeled_ms1_qc_plots(ms1_peak_data, atlas_df, new_output_dir, page_cache=unlabeled_page_cache, render_pool=render_pool,
+                                          page_data=unlabeled_page_data)
+        plots.make_unlabeled_ms1_qc_plots(ms1_peak_data, atlas_df, new_output_dir, logy=True, page_cache=unlabeled_page_cache, render_pool=render_pool,
+                                          page_data=unlabeled_page_data)
+
+        plots.make_ms1_tic_qc_plots(ms1_tic_data, new_output_dir, logy=False, page_cache=tic_page_cache, render_pool=render_pool)
+        plots.make_ms1_tic_qc_plots(ms1_tic_data, new_output_dir, logy=True, page_cache=tic_page_cache, render_pool=render_pool)
+
+        if not ms2_peak_data.empty:
+            ms2_sheet_path = os.path.join(export_dir, 'ms2_data_sheet.csv')
+            _update_data_sheet(ms2_sheet_path, ms2_peak_data, num_exported['ms2_peak_data'])
+            shutil.copy(ms2_sheet_path, os.path.join(new_output_dir, 'ms2_data_sheet.csv'))
+            plots.make_ms2_qc_plots(ms2_peak_data, ms2_diagnostic, new_output_dir, page_cache=ms2_page_cache, render_pool=render_pool)
+            plots.make_ms2_qc_plots(ms2_peak_data, ms2_diagnostic, new_output_dir, logy=True, page_cache=ms2_page_cache, render_pool=render_pool)
+
+    finally:
+        if render_pool is not None:
+            render_pool.shutdown()
+
+    #every export rebuilds the whole output from the export dir, an output that is in use is replaced by the next one
+    if not _replace_dir(new_output_dir, qc_output_dir):
+        print('{qc_output_dir} is in use, the previous export is kept until the next export'.format(qc_output_dir=qc_output_dir))
+
+    with open(os.path.join(export_dir, 'export_state.json'), 'w') as state_file:
+        json.dump(export_state, state_file)
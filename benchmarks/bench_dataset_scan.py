@@ -0,0 +1,58 @@
+#time directory polls of RawDataset against the previous glob, sort and list filter scan on a synthetic directory
+#usage: python benchmarks/bench_dataset_scan.py [num_files] [num_analyzed]
+
+import os
+import sys
+import glob
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dataset import RawDataset
+
+raw_file_name = '20220101_JGI_MD_000000_TEST_final_QE-HF_C18_USHXG01583_POS_MS1_0_S{num}_Pre_Rg80to1200-CE102040-S1_Run{num}.raw'
+
+def _glob_scan(path, analyzed_files):
+    files = sorted(glob.glob(os.path.join(path, '*.raw')), key=os.path.getmtime)
+    return [file for file in files if file not in analyzed_files]
+
+def _make_directory(num_files):
+    path = tempfile.mkdtemp()
+    for num in range(num_files):
+        raw_file = os.path.join(path, raw_file_name.format(num=num))
+        open(raw_file, 'w').close()
+        os.utime(raw_file, (num, num))
+    return path
+
+def _time_polls(poll, num_polls=5):
+    start = time.perf_counter()
+    for _ in range(num_polls):
+        poll()
+    return (time.perf_counter() - start) / num_polls
+
+def main(num_files=10000, num_analyzed=9000):
+    path = _make_directory(num_files)
+    try:
+        dataset = RawDataset(path)
+        analyzed_files = list(dataset.files_to_analyze[:num_analyzed])
+        for file in analyzed_files:
+            dataset.add_analyzed_file(file)
+
+        def dataset_poll():
+            dataset.set_files_to_analyze()
+            return dataset.files_to_analyze
+
+        assert dataset_poll() == _glob_scan(path, analyzed_files)
+
+        glob_seconds = _time_polls(lambda: _glob_scan(path, analyzed_files))
+        dataset_seconds = _time_polls(dataset_poll)
+
+        print('{} files, {} analyzed'.format(num_files, num_analyzed))
+        print('glob scan:        {:.4f} s per poll'.format(glob_seconds))
+        print('incremental scan: {:.4f} s per poll'.format(dataset_seconds))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+#time and peak memory of storing ms1 peak results for a batch: a list of dicts accumulated until the end, one dict per
+#peak stored after every file and ResultWriter flushing after every file or every 10000 rows
+#usage: python benchmarks/bench_result_writer.py [num_files] [num_compounds]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from analysis_routines import initialize_data_storage, read_data_storage, ms1_peak_cols, ResultWriter, _store_data
+
+def _make_block(file_num, num_compounds):
+    rng = np.random.default_rng(file_num)
+    return {'file_name':'file_{num}'.format(num=file_num),
+            'run_num':file_num,
+            'file_category':'S1',
+            'polarity':'POS',
+            'compound_name':np.array(['compound_{num}'.format(num=num) for num in range(num_compounds)], dtype=object),
+            'retention_time':rng.uniform(0, 10, num_compounds),
+            'theoretical_mz':rng.uniform(100, 1000, num_compounds),
+            'observed_mz':rng.uniform(100, 1000, num_compounds),
+            'ppm_error':rng.normal(0, 1, num_compounds),
+            'observed_intensity':rng.uniform(0, 1e7, num_compounds).astype(np.float32)}
+
+def _get_file_dicts(block, num_compounds):
+    return [{column:(block[column][idx] if isinstance(block[column], np.ndarray) else block[column]) for column in ms1_peak_cols}
+            for idx in range(num_compounds)]
+
+def _store_batch_dicts(store_dir, num_files, num_compounds):
+    experiment_ms1_peak_data = []
+    for file_num in range(num_files):
+        experiment_ms1_peak_data = experiment_ms1_peak_data + _get_file_dicts(_make_block(file_num, num_compounds), num_compounds)
+
+    _store_data(experiment_ms1_peak_data, [], [], store_dir)
+
+def _store_file_dicts(store_dir, num_files, num_compounds):
+    for file_num in range(num_files):
+        _store_data(_get_file_dicts(_make_block(file_num, num_compounds), num_compounds), [], [], store_dir)
+
+def _store_columns(store_dir, num_files, num_compounds, flush_rows=0):
+    result_writer = ResultWriter(store_dir, flush_rows=flush_rows)
+    for file_num in range(num_files):
+        result_writer.append_file(([_make_block(file_num, num_compounds)], [], []))
+        if result_writer.is_due():
+            result_writer.flush()
+    result_writer.flush()
+
+def _run(store, num_files, num_compounds, trace_memory=False):
+    store_dir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(store_dir, 'data_store'))
+    initialize_data_storage(store_dir)
+    try:
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        store(store_dir, num_files, num_compounds)
+        seconds = time.perf_counter() - start
+        peak_bytes = None
+        if trace_memory:
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        stored_df = read_data_storage(store_dir)[0]
+    finally:
+        shutil.rmtree(store_dir)
+
+    return seconds, peak_bytes, stored_df
+
+def main(num_files=2000, num_compounds=50):
+    stores = [('list of dicts, end of batch', _store_batch_dicts),
+              ('dicts, every file', _store_file_dicts),
+              ('result writer, every file', _store_columns),
+              ('result writer, 10000 rows', lambda store_dir, num_files, num_compounds: _store_columns(store_dir, num_files, num_compounds, flush_rows=10000))]
+
+    print('{} files, {} compounds'.format(num_files, num_compounds))
+
+    expected_df = None
+    for name, store in stores:
+        seconds, _, stored_df = _run(store, num_files, num_compounds)
+        _, peak_bytes, _ = _run(store, num_files, num_compounds, trace_memory=True)
+
+        if expected_df is None:
+            expected_df = stored_df
+        pd.testing.assert_frame_equal(stored_df, expected_df)
+
+        print('{:<28} {:.2f} s, peak {:.1f} MB'.format(name + ':', seconds, peak_bytes / 1024**2))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
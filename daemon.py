@@ -0,0 +1,264 @@
+#long running service analyzing every experiment under the watched directories with one shared conversion pool
+
+import os
+import time
+import argparse
+import itertools
+import threading
+import concurrent.futures
+import pandas as pd
+from dataset import RawDataset
+from watcher import RawFileWatcher
+from analysis_routines import get_experiment_store_dir, get_default_atlas, initialize_data_storage, load_run_state, resume_data_storage, \
+                              analyze_experiment, export_tables_plots, recover_qc_output_dirs, create_conversion_pool, create_analysis_pool, ParallelAnalysis, \
+                              _get_atlas_targets, _is_file_ready
+
+chromatographies = ['c18', 'hilic']
+
+def _has_raw_files(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return any(entry.name.lower().endswith('.raw') for entry in entries)
+    except OSError:
+        return False
+
+def _find_experiment_dirs(root_dirs, known_dirs):
+    """Watched directories and their subdirectories that contain raw files, experiments already known are not rescanned."""
+
+    experiment_dirs = []
+    for root_dir in root_dirs:
+        with os.scandir(root_dir) as entries:
+            sub_dirs = sorted(entry.path for entry in entries if entry.is_dir())
+
+        for directory in [root_dir] + sub_dirs:
+            if directory not in known_dirs and _has_raw_files(directory):
+                experiment_dirs.append(directory)
+
+    return experiment_dirs
+
+class Experiment():
+    """One experiment directory of the daemon with its own dataset, atlas, watcher and result store."""
+
+    def __init__(self, experiment_dir, current_dir, args, changed=None):
+        self.args = argparse.Namespace(**vars(args))
+        self.args.directory = experiment_dir
+        self.store_dir = get_experiment_store_dir(current_dir, experiment_dir)
+
+        run_state = {} if args.fresh else load_run_state(self.store_dir, experiment_dir)
+        if not initialize_data_storage(self.store_dir, resume=len(run_state) > 0, store=args.store):
+            run_state = {}
+        recover_qc_output_dirs(experiment_dir)
+
+        self.watcher = RawFileWatcher(experiment_dir, stable_seconds=args.stable_seconds, probe_handle=not args.no_handle_probe, changed=changed)
+        try:
+            self.dataset = RawDataset(experiment_dir, watcher=self.watcher, run_state=run_state)
+            if len(run_state) > 0:
+                resume_data_storage(self.store_dir, self.dataset, store=args.store)
+
+            self.atlas_df = get_default_atlas(current_dir, self.dataset.chromatography)
+        except Exception:
+            self.watcher.stop()
+            raise
+        self.failed = False
+        self.exported_files = 0
+        if args.export_num is not None:
+            self.exported_files = len(self.dataset.analyzed_files) - len(self.dataset.analyzed_files) % args.export_num
+        self.full_export_files = None
+        self.last_analysis_time = time.time()
+        self.analysis = None
+
+    def validate_filenames(self):
+        file_name_warnings, file_name_errors = self.dataset.validate_experiment_filenames()
+        self.file_name_warnings_df = pd.DataFrame(file_name_warnings)
+        file_name_errors_df = pd.DataFrame(file_name_errors)
+
+        if len(list(itertools.chain.from_iterable(file_name_errors_df['errors']))) > 0:
+            file_name_errors_df.to_csv(os.path.join(self.args.directory, 'file_name_errors_report.csv'))
+            self.file_name_warnings_df.to_csv(os.path.join(self.args.directory, 'file_name_warnings_report.csv'))
+            return False
+
+        return True
+
+    def has_ready_files(self):
+        try:
+            self.dataset.set_files_to_analyze()
+        except OSError:
+            return False
+        return any(_is_file_ready(file, self.args, watcher=self.watcher) for file in self.dataset.files_to_analyze)
+
+    def analyze_next_file(self, ms2_diagnostic, conversion_pool, tolerance=0.0015, frag_tolerance=0.005):
+        """Analyze the next ready file (and the blanks before it), returns False if the analysis was interrupted."""
+
+        self.args.num_files = len(self.dataset.files_to_analyze) + len(self.dataset.analyzed_files)
+        analaysis_interrupted = analyze_experiment(self.dataset, self.atlas_df, ms2_diagnostic, self.store_dir, self.args, self.exported_files,
+                                                   tolerance=tolerance, frag_tolerance=frag_tolerance, conversion_pool=conversion_pool, max_files=1)
+        self.last_analysis_time = time.time()
+
+        return not analaysis_interrupted
+
+    def start_analysis(self, ms2_diagnostic, tolerance=0.0015):
+        """Queue the ready files up to the next export in the shared analysis pool, with the atlas and args of this experiment."""
+
+        self.args.num_files = len(self.dataset.files_to_analyze) + len(self.dataset.analyzed_files)
+        targets = _get_atlas_targets(self.atlas_df, ms2_diagnostic, tolerance=tolerance) if self.args.targeted else None
+        self.analysis = ParallelAnalysis(self.dataset, self.atlas_df, self.store_dir, self.args, self.exported_files, targets, shared_pool=True)
+
+    def finish_analysis(self):
+        """Checkpoint the stored files of the queued ones, returns False if the analysis was interrupted."""
+
+        self.analysis.finish()
+        analaysis_interrupted = self.analysis.interrupted
+        self.analysis = None
+        self.last_analysis_time = time.time()
+
+        return not analaysis_interrupted
+
+    def export(self, ms2_diagnostic, export_idle_minutes):
+        """Partial export every export_num files and a full export once no new files arrived for export_idle_minutes."""
+
+        num_analyzed = len(self.dataset.analyzed_files)
+        if self.args.export_num is not None and num_analyzed - self.exported_files >= self.args.export_num:
+            self.exported_files = num_analyzed
+            self.validate_filenames()
+            export_tables_plots(self.store_dir, self.args, self.file_name_warnings_df, self.atlas_df, ms2_diagnostic, self.exported_files)
+
+        is_idle = (time.time() - self.last_analysis_time) / 60 >= export_idle_minutes
+        if is_idle and num_analyzed != self.full_export_files and len(self.dataset.files_to_analyze) == 0:
+            self.full_export_files = num_analyzed
+            self.validate_filenames()
+            export_tables_plots(self.store_dir, self.args, self.file_name_warnings_df, self.atlas_df, ms2_diagnostic, 'full')
+
+    def get_seconds_until_ready(self):
+        if len(self.dataset.files_to_analyze) == 0:
+            return None
+        return self.watcher.get_seconds_until_complete(self.dataset.files_to_analyze)
+
+def _analyze_in_turns(experiments, ms2_diagnostic, conversion_pool, args, tolerance=0.0015, frag_tolerance=0.005):
+    """Round robin, every experiment with a ready file analyzes one file per turn. False if no experiment had a ready file."""
+
+    analyzed_files = False
+    for experiment_dir, experiment in experiments.items():
+        if experiment.failed:
+            continue
+
+        if experiment.has_ready_files():
+            analyzed_files = True
+            if not experiment.analyze_next_file(ms2_diagnostic, conversion_pool, tolerance=tolerance, frag_tolerance=frag_tolerance):
+                print('\nAnalysis of {directory} interrupted, experiment skipped'.format(directory=experiment_dir))
+                experiment.failed = True
+                continue
+
+        experiment.export(ms2_diagnostic, args.export_idle)
+
+    return analyzed_files
+
+def _analyze_in_pool(experiments, ms2_diagnostic, analysis_pool, args, tolerance=0.0015, wait_seconds=5):
+    """Fair scheduler of the shared analysis pool. False if no experiment had files to analyze.
+
+    Up to args.workers * 2 files of all experiments are in flight, every free slot goes to the experiment with the
+    fewest files in flight. Each experiment stores and checkpoints its results in its own file order and exports
+    once its queued files are stored.
+    """
+
+    for experiment in experiments.values():
+        if not experiment.failed and experiment.analysis is None and experiment.has_ready_files():
+            experiment.start_analysis(ms2_diagnostic, tolerance=tolerance)
+
+    analyses = [experiment.analysis for experiment in experiments.values() if experiment.analysis is not None]
+    num_running = sum(analysis.get_num_running() for analysis in analyses)
+    queueing = list(analyses)
+    while len(queueing) > 0 and num_running < args.workers * 2:
+        analysis = min(queueing, key=lambda analysis: analysis.get_num_running())
+        if analysis.queue_next_file(analysis_pool):
+            num_running += 1
+        else:
+            queueing.remove(analysis)
+
+    futures = [future for analysis in analyses for future in analysis.get_futures()]
+    if len(futures) > 0:
+        concurrent.futures.wait(futures, timeout=wait_seconds, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    for experiment_dir, experiment in experiments.items():
+        if experiment.failed:
+            continue
+
+        if experiment.analysis is not None:
+            experiment.analysis.store_done_files()
+            if not experiment.analysis.is_done():
+                continue
+            if not experiment.finish_analysis():
+                print('\nAnalysis of {directory} interrupted, experiment skipped'.format(directory=experiment_dir))
+                experiment.failed = True
+                continue
+
+        experiment.export(ms2_diagnostic, args.export_idle)
+
+    return len(analyses) > 0
+
+def run_daemon(args, current_dir, ms2_diagnostic, tolerance=0.0015, frag_tolerance=0.005, rescan_seconds=60):
+    """Watch args.directory and args.experiment_dirs until interrupted.
+
+    Every directory (or subdirectory) with raw files is an experiment with its own atlas and result store.
+    Experiments take turns, one analyzed file each, and share one bounded conversion pool. With args.workers, they
+    share one analysis pool instead, see _analyze_in_pool. Experiments that cannot be set up are reported and skipped.
+    """
+
+    root_dirs = [args.directory] + (args.experiment_dirs or [])
+    changed = threading.Event()
+    experiments = {}
+    failed_dirs = set()
+
+    #streamed files of every experiment go through one consumer, targeted extraction keeps the windows of all atlases
+    all_atlases_df = pd.concat([get_default_atlas(current_dir, chromatography) for chromatography in chromatographies], ignore_index=True)
+    conversion_pool = create_conversion_pool(args, all_atlases_df, ms2_diagnostic, tolerance=tolerance)
+    analysis_pool = create_analysis_pool(args, all_atlases_df, ms2_diagnostic, tolerance=tolerance, frag_tolerance=frag_tolerance)
+
+    try:
+        while True:
+
+            for experiment_dir in _find_experiment_dirs(root_dirs, experiments.keys() | failed_dirs):
+                try:
+                    experiment = Experiment(experiment_dir, current_dir, args, changed=changed)
+                except Exception as error:
+                    print('Could not set up {directory}, experiment skipped: {error!r}'.format(directory=experiment_dir, error=error))
+                    failed_dirs.add(experiment_dir)
+                    continue
+                experiments[experiment_dir] = experiment
+
+                if not experiment.validate_filenames():
+                    print('Filename errors detected in {directory}, reports exported and experiment skipped'.format(directory=experiment_dir))
+                    experiment.failed = True
+                else:
+                    print('Watching {directory}, {chrom} atlas'.format(directory=experiment_dir, chrom=experiment.dataset.chromatography))
+
+            if analysis_pool is None:
+                analyzed_files = _analyze_in_turns(experiments, ms2_diagnostic, conversion_pool, args, tolerance=tolerance, frag_tolerance=frag_tolerance)
+            else:
+                analyzed_files = _analyze_in_pool(experiments, ms2_diagnostic, analysis_pool, args, tolerance=tolerance)
+
+            if not analyzed_files:
+                #watchers without directory events are polled
+                wait_times = [rescan_seconds]
+                for experiment in experiments.values():
+                    if not experiment.failed and experiment.get_seconds_until_ready() is not None:
+                        wait_times.append(experiment.get_seconds_until_ready())
+                    if experiment.watcher.observer is None:
+                        wait_times.append(experiment.watcher.poll_interval)
+
+                changed.wait(min(wait_times))
+                changed.clear()
+
+    except KeyboardInterrupt:
+        print('\nStopping...')
+
+    finally:
+        #files stored before the interruption are checkpointed, queued ones are analyzed again on restart
+        for experiment in experiments.values():
+            if experiment.analysis is not None:
+                experiment.analysis.cancel()
+                experiment.finish_analysis()
+        conversion_pool.shutdown()
+        if analysis_pool is not None:
+            analysis_pool.shutdown(cancel_futures=True)
+        for experiment in experiments.values():
+            experiment.watcher.stop()
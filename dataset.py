@@ -1,18 +1,68 @@
 #data model to store files and file data
 import os
 import re
-import glob
+import heapq
+import functools
+import collections
+import concurrent.futures
 from pathlib import Path
 import extract_mzml_data as exdata
+from utils import _is_blank
 import metatlas.metatlas.tools.validate_filenames as validate
 
 filename_categories_vocab = ['ISTD', 'QC', 'InjBl'] #Words that will be searched for in filename to determine file category. case insensitive
 ignore_errors = ['(Filename and parent directory do not contain the same batch fields\.)', '(Parent directory contains .* fields but the minimum allowed is 9\.)']
 extraction_control_vocab = 'ExCtrl'
 
+#files validated in worker processes above this batch size
+parallel_validation_size = 200
+
+FileNameFields = collections.namedtuple('FileNameFields', ['chromatography', 'polarity', 'ms_num', 'group_name', 'category', 'run_num', 'is_blank'])
+
+def _get_file_category(group_field, optional_field):
+    """Take the group and optional filename fields as input, return the 'sample type' (S1, ISTD, QC, InjBl) as string"""
+
+    search_fields = group_field + optional_field
+    file_category = [ele for ele in filename_categories_vocab if (ele.upper() in search_fields.upper())]
+
+    if file_category == []:
+        file_category = ['S1']
+
+    if extraction_control_vocab in group_field:
+        file_category = ['ExCtrl']
+
+    return file_category[0]
+
+def _get_run_number(run_num_str):
+    if not run_num_str.isnumeric():
+        run_num = int(re.sub('\\D', '', run_num_str)) #for JGI naming scheme (ex. Run4)
+    else:
+        run_num = int(run_num_str) #for EGSB naming scheme (ex. '100')
+
+    return run_num
+
+@functools.lru_cache(maxsize=None)
+def _parse_file_name(name):
+    """Split a filename once into the fields used by ms-sentry, memoized by name. Missing fields are None."""
+
+    fields = name.split('_')
+    fields += [None] * (16 - len(fields))
+
+    category = None
+    if fields[12] is not None and fields[14] is not None:
+        category = _get_file_category(fields[12], fields[14])
+
+    run_num = _get_run_number(fields[15]) if fields[15] is not None else None
+
+    return FileNameFields(chromatography=fields[7], polarity=fields[9], ms_num=fields[10], group_name=fields[12],
+                          category=category, run_num=run_num, is_blank=_is_blank(name, filename_categories_vocab))
+
+def _validate_file_name(file_name_path):
+    return validate.get_validation_messages(file_name_path, minimal=True)
+
 class File():
 
-    def __init__(self, path, name):
+    def __init__(self, path, name, ms2_diagnostic=None, tolerance=0.0015, targets=None, backend='pymzml', mzml_data=None):
         self.path = path
         self.name = name
         self.polarity = self.get_file_polarity()
@@ -21,90 +71,170 @@ class File():
         self.run_num = self.get_file_run_number()
         self.ms_num = self.get_file_msnum()
         self.group_name = self.get_group_name()
-        self.ms1_data = exdata._extract_ms1_data(self.path)
-        self.ms1_tic = exdata._extract_ms1_tic(self.path)
+
+        #single pass over the mzml, ms2 spectra are only collected for ms2 files with diagnostic precursors
+        precursor_index = None
+        if ms2_diagnostic is not None and self.ms_num in ['MS2', 'MSMS'] and self.polarity in ms2_diagnostic:
+            precursor_index = exdata.PrecursorIndex([entry['pmz'] for entry in ms2_diagnostic[self.polarity]], tolerance=tolerance)
+
+        #mzml_data is (ms1_data, ms1_tic, ms2_data) already extracted with the same settings, e.g. from the spectral cache
+        #only the most intense ms2 spectrum of every panel entry is analyzed, the rest are dropped while parsing
+        if mzml_data is None:
+            mzml_data = exdata._extract_mzml_data(self.path, tolerance=tolerance, targets=targets, backend=backend, ms2_top_k=1, precursor_index=precursor_index)
+
+        self.ms1_data, self.ms1_tic, ms2_data = mzml_data
+        self.ms2_data = ms2_data if precursor_index is not None else None
+
+        #fast polarity switching files get one index per polarity so lookups only search their own scans
+        index_polarities = ['POS', 'NEG'] if self.polarity == 'FPS' else [self.polarity]
+        self.ms1_indexes = {polarity:exdata.MS1Index(self.ms1_data, polarity=polarity) for polarity in index_polarities}
 
     def get_file_polarity(self):
-        return self.name.split('_')[9]
+        return _parse_file_name(self.name).polarity
 
     def get_file_msnum(self):
-        return self.name.split('_')[10]
+        return _parse_file_name(self.name).ms_num
         
     def get_file_category(self):
         """Take filename string as input, return the 'sample type' (S1, ISTD, QC, InjBl) as string"""
-
-        group_field = self.name.split('_')[12]
-        optional_field = self.name.split('_')[14]
-
-        search_fields = group_field + optional_field
-        file_category = [ele for ele in filename_categories_vocab if (ele.upper() in search_fields.upper())]
-
-        if file_category == []:
-            file_category = ['S1']
-
-        if extraction_control_vocab in group_field:
-            file_category = ['ExCtrl']
-
-        return file_category[0]
+        return _parse_file_name(self.name).category
 
     def get_file_chromatography(self):
-        return self.name.split('_')[7]
+        return _parse_file_name(self.name).chromatography
 
     def get_file_run_number(self):
-        run_num_str = self.name.split('_')[15]
-        if not run_num_str.isnumeric():
-            run_num = int(re.sub('\\D', '', run_num_str)) #for JGI naming scheme (ex. Run4)
-        else:
-            run_num = int(run_num_str) #for EGSB naming scheme (ex. '100')
-
-        return run_num
+        return _parse_file_name(self.name).run_num
 
     def get_group_name(self):
-        return self.name.split('_')[12]
+        return _parse_file_name(self.name).group_name
 
 class RawDataset():
 
-    def __init__(self, path):
+    def __init__(self, path, watcher=None, run_state=None):
         self.path = path
+        self.watcher = watcher
         self.analyzed_files = []
-        self.files_to_analyze = []
+        self.analyzed_stats = {}
+
+        #raw files are stat'ed until they are analyzed, then only their name is checked on each scan
+        self._analyzed = set()
+        self.file_stats = {}
+        self._pending_queue = []
+        self._files_to_analyze = None
+        self.validation_results = {}
+
+        if run_state is not None:
+            self.resume(run_state)
 
         self.set_files_to_analyze()
 
         self.chromatography = self.get_chromatography()
 
+    def _queue_file(self, file, file_stat):
+        previous_stat = self.file_stats.get(file)
+        self.file_stats[file] = file_stat
+        if previous_stat is None or previous_stat.st_mtime != file_stat.st_mtime:
+            heapq.heappush(self._pending_queue, (file_stat.st_mtime, file))
+            self._files_to_analyze = None
+
     def set_files_to_analyze(self):
-        files = sorted(glob.glob(self.path + '\\*.raw'), key=os.path.getmtime) 
-        files = [file for file in files if file not in self.analyzed_files]
-        self.files_to_analyze = files
+        """Incremental scan of the directory, pending raw files are kept in a queue ordered by modification time."""
+
+        seen_files = set()
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith('.raw') or entry.path in self._analyzed:
+                    continue
+                try:
+                    self._queue_file(entry.path, entry.stat())
+                except OSError:
+                    continue
+                seen_files.add(entry.path)
+
+        for file in [file for file in self.file_stats if file not in seen_files]:
+            del self.file_stats[file]
+            self._files_to_analyze = None
+
+    def _is_queued(self, queue_item):
+        file_mtime, file = queue_item
+        return file in self.file_stats and self.file_stats[file].st_mtime == file_mtime
+
+    @property
+    def files_to_analyze(self):
+        if self._files_to_analyze is None:
+            #drop entries of analyzed, deleted or since modified files before ordering the queue
+            if len(self._pending_queue) > 2 * len(self.file_stats):
+                self._pending_queue = [queue_item for queue_item in self._pending_queue if self._is_queued(queue_item)]
+                heapq.heapify(self._pending_queue)
+            queued_files = [file for file_mtime, file in sorted(self._pending_queue) if self._is_queued((file_mtime, file))]
+            self._files_to_analyze = list(dict.fromkeys(queued_files))
+        return self._files_to_analyze
+
+    def get_next_file(self):
+        """Oldest pending raw file or None, without ordering the whole queue."""
+
+        while len(self._pending_queue) > 0 and not self._is_queued(self._pending_queue[0]):
+            heapq.heappop(self._pending_queue)
+        return self._pending_queue[0][1] if len(self._pending_queue) > 0 else None
+
+    def resume(self, run_state):
+        """Mark the checkpointed files {file_name:[size, mtime_ns]} of a previous run as analyzed, unless they changed since."""
+
+        for file_name, file_stat in run_state.items():
+            file = os.path.join(self.path, file_name)
+            try:
+                current_stat = os.stat(file)
+            except OSError:
+                continue
+
+            if [current_stat.st_size, current_stat.st_mtime_ns] == list(file_stat):
+                self._analyzed.add(file)
+                self.analyzed_files.append(file)
+                self.analyzed_stats[file_name] = list(file_stat)
 
     def add_analyzed_file(self, file):
-        self.files_to_analyze.remove(file)
+        file_stat = self.file_stats.pop(file, None)
+        try:
+            file_stat = os.stat(file)
+        except OSError:
+            pass
+        if file_stat is not None:
+            self.analyzed_stats[os.path.basename(file)] = [file_stat.st_size, file_stat.st_mtime_ns]
+
+        self._files_to_analyze = None
+        self._analyzed.add(file)
         self.analyzed_files.append(file)
+        if self.watcher is not None:
+            self.watcher.forget(file)
 
     def get_chromatography(self):
-        test_file = self.files_to_analyze[0]
-        test_name = os.path.basename(test_file)
-        if 'c18' in test_name.split('_')[7].lower():
+        test_file = self.get_next_file() or self.analyzed_files[0]
+        test_chromatography = _parse_file_name(os.path.basename(test_file)).chromatography.lower()
+        if 'c18' in test_chromatography:
             chromatography = 'c18'
-        if 'hilic' in test_name.split('_')[7].lower():
+        if 'hilic' in test_chromatography:
             chromatography = 'hilic'
         return chromatography
 
     def validate_experiment_filenames(self):
+        """Validation messages of every file, only files not seen by a previous call are validated."""
+
+        file_name_paths = [Path(os.path.basename(file)) for file in dict.fromkeys(self.files_to_analyze + self.analyzed_files)]
+        new_file_name_paths = [file_name_path for file_name_path in file_name_paths if file_name_path not in self.validation_results]
+
+        if len(new_file_name_paths) > parallel_validation_size:
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                validation_results = list(executor.map(_validate_file_name, new_file_name_paths, chunksize=50))
+        else:
+            validation_results = [_validate_file_name(file_name_path) for file_name_path in new_file_name_paths]
+        self.validation_results.update(zip(new_file_name_paths, validation_results))
+
         filename_warnings = []
         filename_errors = []
-        for file in set(self.files_to_analyze + self.analyzed_files):
-
-            file_name_path = Path(os.path.basename(file))
+        for file_name_path in file_name_paths:
 
-            warnings, errors = validate.get_validation_messages(file_name_path, minimal=True)
+            warnings, errors = self.validation_results[file_name_path]
             filename_warnings.append({'file_name':file_name_path, 'warnings':warnings})
             filename_errors.append({'file_name':file_name_path, 'errors':errors})
             
         return filename_warnings, filename_errors
-
-
-    
-
-
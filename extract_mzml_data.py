@@ -1,25 +1,388 @@
 # given the temp mzMl file_path, extract ms1 and ms2 data
 
+import heapq
+import base64
+import zlib
+import xml.etree.ElementTree as ET
 import pymzml
 import numpy as np 
-from utils import find_nearest
 
-def _extract_ms1_data(file_path):
+polarity_codes = {'POS':1, 'NEG':-1} #scan polarity as stored in MS1Data, 0 if the mzml does not say
+mzml_backends = ['pymzml', 'native']
 
-    run = pymzml.run.Reader(file_path)
-    ms1_peaks = []
+#psi-ms accessions read by the native backend
+binary_dtypes = {'MS:1000521':'<f4', 'MS:1000523':'<f8', 'MS:1000519':'<i4', 'MS:1000522':'<i8'}
+binary_compressions = {'MS:1000574':'zlib', 'MS:1000576':None}
+binary_arrays = {'MS:1000514':'mz', 'MS:1000515':'i'}
+
+class MS1Data():
+    """MS1 peaks stored per scan (rt, polarity + offset into the peak arrays) instead of one rt per peak.
+
+    Peak arrays are preallocated and grown in chunks while the mzml is parsed. Indexing or unpacking 
+    returns the (rts, mzs, is) arrays, with the per peak rts only expanded on request.
+    """
+
+    def __init__(self, mz_dtype=np.float64, chunk_size=2**20):
+        self.chunk_size = chunk_size
+        self.n_scans = 0
+        self.n_peaks = 0
+        self.scan_rts = np.empty(1024, dtype=np.float64)
+        self.scan_polarities = np.zeros(1024, dtype=np.int8)
+        self.offsets = np.zeros(1025, dtype=np.int64)
+        self.mzs = np.empty(chunk_size, dtype=mz_dtype)
+        self.intensities = np.empty(chunk_size, dtype=np.float32)
+
+    def append_scan(self, rt, mzs, intensities, polarity=0):
+
+        n = len(mzs)
+        if self.n_scans == self.scan_rts.shape[0]:
+            self.scan_rts = _grow_array(self.scan_rts, self.n_scans * 2)
+            self.scan_polarities = _grow_array(self.scan_polarities, self.n_scans * 2)
+            self.offsets = _grow_array(self.offsets, self.n_scans * 2 + 1)
+        if self.n_peaks + n > self.mzs.shape[0]:
+            capacity = self.mzs.shape[0] + max(n, self.chunk_size)
+            self.mzs = _grow_array(self.mzs, capacity)
+            self.intensities = _grow_array(self.intensities, capacity)
+
+        self.mzs[self.n_peaks:self.n_peaks + n] = mzs
+        self.intensities[self.n_peaks:self.n_peaks + n] = intensities
+        self.scan_rts[self.n_scans] = rt
+        self.scan_polarities[self.n_scans] = polarity
+        self.n_peaks += n
+        self.n_scans += 1
+        self.offsets[self.n_scans] = self.n_peaks
+
+    def trim(self):
+        """Release the unused capacity once parsing is done."""
+        self.scan_rts = self.scan_rts[:self.n_scans].copy()
+        self.scan_polarities = self.scan_polarities[:self.n_scans].copy()
+        self.offsets = self.offsets[:self.n_scans + 1].copy()
+        self.mzs = self.mzs[:self.n_peaks].copy()
+        self.intensities = self.intensities[:self.n_peaks].copy()
+
+    def get_scan_numbers(self):
+        """Scan position of every peak, the compact alternative to the expanded rts."""
+        return np.repeat(np.arange(self.n_scans, dtype=np.int32), np.diff(self.offsets[:self.n_scans + 1]))
+
+    def get_polarity_filter(self, polarity):
+        """Peak mask for the scans of one polarity. Scans without polarity information match either."""
+        scan_filter = np.isin(self.scan_polarities[:self.n_scans], [polarity_codes[polarity], 0])
+        return np.repeat(scan_filter, np.diff(self.offsets[:self.n_scans + 1]))
+
+    @property
+    def rts(self):
+        return np.repeat(self.scan_rts[:self.n_scans], np.diff(self.offsets[:self.n_scans + 1]))
+
+    def __getitem__(self, idx):
+        views = (lambda: self.rts, lambda: self.mzs[:self.n_peaks], lambda: self.intensities[:self.n_peaks])
+        return views[idx]()
+
+    def __iter__(self):
+        return iter((self.rts, self.mzs[:self.n_peaks], self.intensities[:self.n_peaks]))
+
+    def __len__(self):
+        return 3
+
+def _ms1_data_from_arrays(scan_rts, offsets, mzs, intensities, scan_polarities):
+    """Wrap existing (for example memory-mapped) arrays in an MS1Data without copying them."""
+
+    ms1_data = MS1Data(mz_dtype=mzs.dtype, chunk_size=0)
+    ms1_data.n_scans = scan_rts.shape[0]
+    ms1_data.n_peaks = mzs.shape[0]
+    ms1_data.scan_rts = scan_rts
+    ms1_data.scan_polarities = scan_polarities
+    ms1_data.offsets = offsets
+    ms1_data.mzs = mzs
+    ms1_data.intensities = intensities
+
+    return ms1_data
+
+def _grow_array(array, capacity):
+    grown = np.empty(capacity, dtype=array.dtype)
+    grown[:array.shape[0]] = array
+    return grown
+
+class NativeSpectrum():
+    """Spectrum read straight from the mzml xml, with the subset of the pymzml spectrum api used here.
+
+    Binary arrays are kept encoded and only decoded into numpy buffers when mz or i is accessed.
+    """
+
+    __slots__ = ['params', 'selected_precursors', '_arrays']
+
+    def __init__(self, params, selected_precursors, arrays):
+        self.params = params
+        self.selected_precursors = selected_precursors
+        self._arrays = arrays
+
+    def get(self, accession, default=None):
+        if accession in self.params:
+            return self.params[accession][0]
+        return default
+
+    @property
+    def ms_level(self):
+        ms_level = self.get('MS:1000511')
+        return None if ms_level is None else int(ms_level)
+
+    @property
+    def mz(self):
+        return _decode_binary_array(*self._arrays['mz']) if 'mz' in self._arrays else np.array([])
+
+    @property
+    def i(self):
+        return _decode_binary_array(*self._arrays['i']) if 'i' in self._arrays else np.array([], dtype=np.float32)
+
+    @property
+    def TIC(self):
+        tic = self.get('MS:1000285')
+        return float(self.i.sum()) if tic is None else float(tic)
+
+    def scan_time_in_minutes(self):
+        if 'MS:1000016' not in self.params:
+            return None
+        value, unit_name, unit_accession = self.params['MS:1000016']
+        if unit_name == 'second' or unit_accession == 'UO:0000010':
+            return float(value) / 60
+        return float(value)
+
+def _decode_binary_array(text, dtype, compression):
+
+    if not text:
+        return np.array([], dtype=dtype)
+
+    data = base64.b64decode(text)
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+
+    return np.frombuffer(data, dtype=dtype)
+
+def _parse_native_spectrum(spectrum_elem, ns):
+
+    params = {}
+    selected_precursors = []
+    arrays = {}
+
+    for child in spectrum_elem:
+        if child.tag == ns + 'binaryDataArrayList':
+            for array_elem in child.iter(ns + 'binaryDataArray'):
+                array_params = {cv.get('accession') for cv in array_elem.iter(ns + 'cvParam')}
+                array_name = [binary_arrays[acc] for acc in array_params if acc in binary_arrays]
+                dtype = [binary_dtypes[acc] for acc in array_params if acc in binary_dtypes]
+                compression = [binary_compressions[acc] for acc in array_params if acc in binary_compressions]
+                if len(array_name) == 0:
+                    continue
+                if len(dtype) == 0 or len(compression) == 0:
+                    raise ValueError('Unsupported binary encoding in spectrum {id}'.format(id=spectrum_elem.get('id')))
+                arrays[array_name[0]] = (array_elem.findtext(ns + 'binary'), dtype[0], compression[0])
+
+        elif child.tag == ns + 'precursorList':
+            for ion_elem in child.iter(ns + 'selectedIon'):
+                for cv in ion_elem.iter(ns + 'cvParam'):
+                    if cv.get('accession') == 'MS:1000744':
+                        selected_precursors.append({'mz':float(cv.get('value'))})
+
+        else:
+            for cv in child.iter(ns + 'cvParam'):
+                params.setdefault(cv.get('accession'), (cv.get('value'), cv.get('unitName'), cv.get('unitAccession')))
+
+    return NativeSpectrum(params, selected_precursors, arrays)
+
+class NativeReader():
+    """Streams the spectra of an mzml file (path or binary file object) with iterparse, pymzml.run.Reader replacement."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def __iter__(self):
+
+        ns = None
+        spectrum_list = None
+        for event, elem in ET.iterparse(self.source, events=('start', 'end')):
+            if ns is None:
+                ns = elem.tag[:elem.tag.index('}') + 1] if elem.tag.startswith('{') else ''
+
+            if event == 'start':
+                if elem.tag == ns + 'spectrumList':
+                    spectrum_list = elem
+            elif elem.tag == ns + 'spectrum':
+                spectrum = _parse_native_spectrum(elem, ns)
+                #drop parsed spectra so memory does not grow with the file
+                if spectrum_list is not None:
+                    spectrum_list.remove(elem)
+                yield spectrum
+
+    def close(self):
+        pass
+
+def _open_mzml_run(file_path, backend='pymzml'):
+
+    if backend == 'native':
+        return NativeReader(file_path)
+    if backend == 'pymzml':
+        return pymzml.run.Reader(file_path)
+
+    raise ValueError('Unknown mzml backend {backend}, expected one of {backends}'.format(backend=backend, backends=mzml_backends))
+
+def _get_scan_polarity(spec):
+    if spec.get('MS:1000130') is not None:
+        return polarity_codes['POS']
+    if spec.get('MS:1000129') is not None:
+        return polarity_codes['NEG']
+    return 0
+
+def _merge_windows(lower, upper):
+    """Merge overlapping m/z windows, return the flat sorted edges [lo0, hi0, lo1, hi1, ...]."""
+
+    if lower.shape[0] == 0:
+        return np.array([])
+
+    sort_idx = np.argsort(lower)
+    lower = lower[sort_idx]
+    upper = np.maximum.accumulate(upper[sort_idx])
+
+    starts = np.r_[True, lower[1:] > upper[:-1]]
+    ends = np.r_[starts[1:], True]
+
+    return np.column_stack([lower[starts], upper[ends]]).ravel()
+
+def _build_target_edges(mzs, tolerance=0.02):
+    """Targeted extraction windows around every m/z, matching the windows searched by _get_batch_peak_data."""
+
+    mzs = np.asarray(mzs, dtype=float)
+    mzs = mzs[~np.isnan(mzs)]
+    lower, upper = _get_mz_window(mzs, tolerance)
+
+    return _merge_windows(lower - 1e-9, upper + 1e-9)
+
+def _get_nonempty_targets(targets):
+    """targets without the polarities that have no windows, None (no filter) if no polarity has any."""
+
+    if targets is None:
+        return None
+
+    targets = {polarity:edges for polarity, edges in targets.items() if len(edges) > 0}
+    return targets if len(targets) > 0 else None
+
+def _get_target_filter(target_edges, mzs):
+    """Peaks that fall inside one of the target windows."""
+    return np.searchsorted(target_edges, mzs, side='right') % 2 == 1
+
+class MS2TopK():
+    """Streaming reduction of MS2 spectra to the k with the highest summed intensity, ties keep the earlier spectrum.
+
+    Only spectra that make the top k are copied into np.array([mz, i]), k=None keeps every spectrum.
+    """
+
+    def __init__(self, k=1):
+        self.k = k
+        self.heap = []
+        self.n_spectra = 0
+
+    def add(self, spec):
+        self.n_spectra += 1
+
+        if self.k is None:
+            self.heap.append((0, -self.n_spectra, np.array([spec.mz, spec.i])))
+            return
+
+        intensity_sum = np.asarray(spec.i, dtype=np.float64).sum()
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (intensity_sum, -self.n_spectra, np.array([spec.mz, spec.i])))
+        elif intensity_sum > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (intensity_sum, -self.n_spectra, np.array([spec.mz, spec.i])))
+
+    def get_spectra(self):
+        """Kept spectra in the order they were added."""
+        return [ms2_spec for _, _, ms2_spec in sorted(self.heap, key=lambda item: -item[1])]
+
+class PrecursorIndex():
+    """Sorted precursor m/z of the MS2 panel entries, every MS2 scan is assigned to all entries within tolerance."""
+
+    def __init__(self, pmzs, tolerance=0.02):
+        self.pmzs = np.asarray(pmzs, dtype=np.float64)
+        self.order = np.argsort(self.pmzs, kind='stable')
+        self.sorted_pmzs = self.pmzs[self.order]
+        self.tolerance = tolerance
+
+    def __len__(self):
+        return len(self.pmzs)
+
+    def get_entries(self, mz):
+        """Entries with np.isclose(pmz, mz, atol=tolerance), in panel order."""
+
+        window = self.tolerance + 1e-05 * abs(mz)
+        lo = np.searchsorted(self.sorted_pmzs, mz - window - 1e-9, side='left')
+        hi = np.searchsorted(self.sorted_pmzs, mz + window + 1e-9, side='right')
+
+        candidates = self.order[lo:hi]
+        candidates = candidates[np.isclose(self.pmzs[candidates], mz, atol=self.tolerance)]
+
+        return np.sort(candidates)
+
+def _extract_mzml_data(file_path, pmz=None, tolerance=0.02, mz_dtype=np.float64, targets=None, backend='pymzml', ms2_top_k=None, precursor_index=None):
+    """Walk the mzML once, return (ms1_data, ms1_tic_data, ms2_data) in the formats of the single purpose extractors.
+
+    targets maps 'POS'/'NEG' to the edges from _build_target_edges. When given, only the MS1 peaks inside 
+    the windows of the scan polarity are kept, the TIC still comes from the full scans. Polarities without
+    windows (e.g. an atlas without compounds of that polarity) are not filtered. backend selects
+    pymzml or the native iterparse decoder, both return the same structures. With ms2_top_k only the
+    ms2_top_k matching MS2 spectra with the highest summed intensity are kept.
+
+    MS2 spectra are matched against pmz or, for MS2 panels, every entry of precursor_index. ms2_data is
+    the list of spectra for pmz and a list of spectra per entry for precursor_index.
+    """
+
+    if pmz is not None:
+        precursor_index = PrecursorIndex([pmz], tolerance=tolerance)
+
+    #scans without polarity are only filtered if both polarities have windows
+    targets = _get_nonempty_targets(targets)
+    if targets is not None:
+        scan_targets = {polarity_codes[polarity]:edges for polarity, edges in targets.items()}
+        if len(scan_targets) == len(polarity_codes):
+            all_edges = np.concatenate(list(targets.values()))
+            scan_targets[0] = _merge_windows(all_edges[0::2], all_edges[1::2])
+        ms1_data = MS1Data(mz_dtype=mz_dtype, chunk_size=2**16)
+    else:
+        ms1_data = MS1Data(mz_dtype=mz_dtype)
+
+    run = _open_mzml_run(file_path, backend=backend)
+    ms1_tic = []
+    ms1_tic_rts = []
+    ms2_spectra = [MS2TopK(k=ms2_top_k) for entry in range(len(precursor_index))] if precursor_index is not None else []
 
     for spec in run:
         if spec.ms_level == 1:
-            ms1_peaks.append([np.repeat(spec.scan_time_in_minutes(), spec.i.shape[0]), spec.mz,  spec.i])
+            scan_time = spec.scan_time_in_minutes()
+            scan_polarity = _get_scan_polarity(spec)
+            scan_mzs, scan_is = spec.mz, spec.i
+            if targets is not None and scan_polarity in scan_targets:
+                target_filter = _get_target_filter(scan_targets[scan_polarity], scan_mzs)
+                ms1_data.append_scan(scan_time, scan_mzs[target_filter], scan_is[target_filter], polarity=scan_polarity)
+            else:
+                ms1_data.append_scan(scan_time, scan_mzs, scan_is, polarity=scan_polarity)
+            ms1_tic.append(spec.TIC)
+            ms1_tic_rts.append(scan_time)
+
+        elif spec.ms_level == 2 and precursor_index is not None:
+            for entry in precursor_index.get_entries(spec.selected_precursors[0]['mz']):
+                ms2_spectra[entry].add(spec)
 
     run.close()
 
-    ms1_rts = np.concatenate([rtmzi[0] for rtmzi in ms1_peaks])
-    ms1_mzs = np.concatenate([rtmzi[1] for rtmzi in ms1_peaks])
-    ms1_is = np.concatenate([rtmzi[2] for rtmzi in ms1_peaks])
+    ms1_data.trim()
+    ms1_tic_data = (ms1_tic, ms1_tic_rts)
+
+    ms2_data = [entry_spectra.get_spectra() for entry_spectra in ms2_spectra]
+    if pmz is not None:
+        ms2_data = ms2_data[0]
+
+    return ms1_data, ms1_tic_data, ms2_data
+
+def _extract_ms1_data(file_path, backend='pymzml'):
 
-    ms1_data = (ms1_rts, ms1_mzs, ms1_is)
+    ms1_data, _, _ = _extract_mzml_data(file_path, backend=backend)
 
     return ms1_data
 
@@ -36,51 +399,169 @@ def _get_ms1_eic(ms1_data, mz, tolerance=0.02, rt=None, rt_window = 2):
 
     return ms1_eic
 
-def _get_peak_data(ms1_eic):
+class MS1Index():
+    """MS1 peaks sorted by m/z, built once per file and shared by all atlas lookups.
 
-    if not any(ms1_eic[2]):
-        peak_data = (np.nan, np.nan, np.nan)
+    Rts are kept per scan and looked up through the scan number of each peak. Plain (rts, mzs, is) 
+    arrays are indexed as if every peak was its own scan. Given a polarity, only the peaks of the
+    MS1Data scans acquired in that polarity are indexed (fast polarity switching files).
+    """
 
-    else:
-        max_i_idx = np.argmax(ms1_eic[2])
+    def __init__(self, ms1_data, polarity=None):
+        index_dtype = np.int32 if len(ms1_data[1]) < np.iinfo(np.int32).max else np.int64
+
+        if isinstance(ms1_data, MS1Data):
+            mzs = ms1_data[1]
+            intensities = ms1_data[2]
+            scans = ms1_data.get_scan_numbers()
+            if polarity in polarity_codes:
+                polarity_filter = ms1_data.get_polarity_filter(polarity)
+                mzs = mzs[polarity_filter]
+                intensities = intensities[polarity_filter]
+                scans = scans[polarity_filter]
+            self.scan_rts = ms1_data.scan_rts[:ms1_data.n_scans]
+        else:
+            mzs = np.asarray(ms1_data[1])
+            intensities = np.asarray(ms1_data[2])
+            scans = None
+            self.scan_rts = np.asarray(ms1_data[0])
+
+        self.order = np.argsort(mzs, kind='stable').astype(index_dtype)
+        self.mzs = mzs[self.order]
+        self.intensities = intensities[self.order]
+        self.scans = self.order if scans is None else scans[self.order]
+
+    def get_rts(self, positions):
+        return self.scan_rts[self.scans[positions]]
+
+def _get_mz_window(mz, tolerance):
+    """Bounds of the values accepted by np.isclose(mz, value, atol=tolerance) with its default rtol."""
+    rtol = 1e-05
+    return (mz - tolerance) / (1 + rtol), (mz + tolerance) / (1 - rtol)
+
+def _get_window_members(ms1_index, mzs, tolerance=0.02, rts=None, rt_window=2):
+    """Binary search every m/z window at once, return the matching index positions and the atlas row each belongs to."""
+
+    mzs = np.asarray(mzs, dtype=float)
+    tolerance = np.broadcast_to(tolerance, mzs.shape)
+
+    lower, upper = _get_mz_window(mzs, tolerance)
+    lo = np.searchsorted(ms1_index.mzs, lower - 1e-9, side='left')
+    hi = np.searchsorted(ms1_index.mzs, upper + 1e-9, side='right')
+    counts = hi - lo
+
+    groups = np.repeat(np.arange(mzs.shape[0]), counts)
+    starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+    positions = np.arange(counts.sum()) + starts
+
+    member_filter = np.isclose(mzs[groups], ms1_index.mzs[positions], atol=tolerance[groups])
+    if rts is not None:
+        rts = np.asarray(rts, dtype=float)
+        rt_window = np.broadcast_to(rt_window, mzs.shape)
+        member_filter &= np.isclose(rts[groups], ms1_index.get_rts(positions), atol=rt_window[groups])
+
+    return positions[member_filter], groups[member_filter]
+
+def _get_group_apexes(rts, mzs, intensities, groups, ranks, n_groups):
+    """Most intense peak per group, ties go to the lowest rank. Groups without signal get nans."""
+
+    peak_rts = np.full(n_groups, np.nan)
+    peak_mzs = np.full(n_groups, np.nan)
+    peak_is = np.full(n_groups, np.nan)
 
-        peak_rt = ms1_eic[0][max_i_idx]
-        peak_mz = ms1_eic[1][max_i_idx]
-        peak_i = ms1_eic[2][max_i_idx]
+    sort_idx = np.lexsort((ranks, -intensities, groups))
+    apex_groups, first_idx = np.unique(groups[sort_idx], return_index=True)
+    apex_idx = sort_idx[first_idx]
 
-        peak_data = (peak_rt, peak_mz, peak_i)
+    has_signal = intensities[apex_idx] != 0
+    apex_groups = apex_groups[has_signal]
+    apex_idx = apex_idx[has_signal]
+
+    peak_rts[apex_groups] = rts[apex_idx]
+    peak_mzs[apex_groups] = mzs[apex_idx]
+    peak_is[apex_groups] = intensities[apex_idx]
+
+    return peak_rts, peak_mzs, peak_is
+
+def _get_ms1_eics(ms1_index, mzs, tolerance=0.02, rts=None, rt_window=2):
+    """Batch version of _get_ms1_eic, returns one (rts, mzs, is) eic per requested m/z."""
+
+    if len(mzs) == 0:
+        return []
+
+    positions, groups = _get_window_members(ms1_index, mzs, tolerance=tolerance, rts=rts, rt_window=rt_window)
+
+    #restore acquisition order within each eic
+    sort_idx = np.lexsort((ms1_index.order[positions], groups))
+    positions = positions[sort_idx]
+    splits = np.cumsum(np.bincount(groups, minlength=len(mzs)))[:-1]
+
+    ms1_eics = [(ms1_index.get_rts(eic_pos), ms1_index.mzs[eic_pos], ms1_index.intensities[eic_pos]) for eic_pos in np.split(positions, splits)]
+
+    return ms1_eics
+
+def _get_batch_peak_data(ms1_index, mzs, tolerance=0.02, rts=None, rt_window=2):
+    """Batch version of _get_ms1_eic followed by _get_peak_data, returns arrays of apex rts, mzs and intensities."""
+
+    positions, groups = _get_window_members(ms1_index, mzs, tolerance=tolerance, rts=rts, rt_window=rt_window)
+
+    peak_data = _get_group_apexes(ms1_index.get_rts(positions), ms1_index.mzs[positions], ms1_index.intensities[positions], 
+                                  groups, ms1_index.order[positions], len(mzs))
 
     return peak_data
 
-def _extract_ms1_tic(file_path):
+def _get_peak_data(ms1_eic):
 
-    run = pymzml.run.Reader(file_path)
-    ms1_tic = []
-    ms1_tic_rts = []
+    eic_size = len(ms1_eic[2])
+    peak_rts, peak_mzs, peak_is = _get_group_apexes(np.asarray(ms1_eic[0]), np.asarray(ms1_eic[1]), np.asarray(ms1_eic[2]), 
+                                                    np.zeros(eic_size, dtype=int), np.arange(eic_size), 1)
 
-    for spec in run:
-        if spec.ms_level == 1:
-            ms1_tic.append(spec.TIC)
-            ms1_tic_rts.append(spec.scan_time_in_minutes())
+    peak_data = (peak_rts[0], peak_mzs[0], peak_is[0])
 
-    run.close()
-        
-    ms1_tic_data = (ms1_tic, ms1_tic_rts)
+    return peak_data
 
-    return ms1_tic_data
+def _get_nearest_peaks(mzs, intensities, target_mzs, tolerance):
+    """m/z and intensity of the peak nearest to every target within np.isclose(mzs, target, atol=tolerance), NaN where there is none.
 
-def _extract_ms2_data(file_path, pmz, tolerance=0.02):
+    One searchsorted over the sorted spectrum instead of a np.isclose scan per target. Ties go to the peak
+    that comes first in the spectrum, like find_nearest on the np.isclose selection.
+    """
 
-    run = pymzml.run.Reader(file_path)
-    ms2_data = []
+    mzs = np.asarray(mzs)
+    target_mzs = np.asarray(target_mzs, dtype=np.float64)
+    observed_mzs = np.full(len(target_mzs), np.nan)
+    observed_intensities = np.full(len(target_mzs), np.nan)
+    if len(mzs) == 0:
+        return observed_mzs, observed_intensities
 
-    for spec in run:
-        if spec.ms_level == 2:
-            mz = spec.selected_precursors[0]['mz']
-            if np.isclose(pmz, mz, atol=tolerance):
-                ms2_data.append(np.array([spec.mz, spec.i]))
+    order = np.argsort(mzs, kind='stable')
+    sorted_mzs = mzs[order]
 
-    run.close()
+    #first peak at or above the target and the first of the equal peaks below it
+    right = np.searchsorted(sorted_mzs, target_mzs, side='left')
+    left = np.searchsorted(sorted_mzs, sorted_mzs[np.maximum(right - 1, 0)], side='left')
+    right_idx = np.minimum(right, len(sorted_mzs) - 1)
+
+    left_dist = np.where(right > 0, np.abs(sorted_mzs[left] - target_mzs), np.inf)
+    right_dist = np.where(right < len(sorted_mzs), np.abs(sorted_mzs[right_idx] - target_mzs), np.inf)
+
+    use_left = (left_dist < right_dist) | ((left_dist == right_dist) & (order[left] < order[right_idx]))
+    nearest = np.where(use_left, order[left], order[right_idx])
+    is_match = np.minimum(left_dist, right_dist) <= tolerance + 1e-05 * np.abs(target_mzs)
+
+    observed_mzs[is_match] = mzs[nearest[is_match]]
+    observed_intensities[is_match] = np.asarray(intensities)[nearest[is_match]]
+
+    return observed_mzs, observed_intensities
+
+def _extract_ms1_tic(file_path, backend='pymzml'):
+
+    _, ms1_tic_data, _ = _extract_mzml_data(file_path, backend=backend)
+
+    return ms1_tic_data
+
+def _extract_ms2_data(file_path, pmz, tolerance=0.02, backend='pymzml', top_k=None):
+
+    _, _, ms2_data = _extract_mzml_data(file_path, pmz=pmz, tolerance=tolerance, backend=backend, ms2_top_k=top_k)
     
     return ms2_data
-
@@ -1,28 +1,24 @@
 #primary script to run
 
 import os
-import time
 import pandas as pd
 import itertools
 import argparse
 import plots
 from dataset import RawDataset
 from raw_file_validation import get_raw_file_age
+from watcher import RawFileWatcher, default_stable_seconds
+from daemon import run_daemon
 from utils import print_progress_bar
-from analysis_routines import initialize_data_storage, close_data_storage, read_data_storage, analyze_experiment, export_tables_plots
-
-pos_diagnostic_ions = [111.0808, 129.1045, 140.0793, 176.1135]
-pos_ms2_diagnostic = {'pmz':176.1135, 'diagnostic_ions':pos_diagnostic_ions}
-
-neg_diagnostic_ions = [75.01253, 156.07551, 174.09893]
-neg_ms2_diagnostic = {'pmz':174.09893, 'diagnostic_ions':neg_diagnostic_ions}
-
-#ms2 diagnostic ions used to plot ms2 data
-ms2_diagnostic = {'POS':pos_ms2_diagnostic, 'NEG':neg_ms2_diagnostic}
+from extract_mzml_data import mzml_backends
+from analysis_routines import store_backends, initialize_data_storage, close_data_storage, read_data_storage, load_ms2_panel, load_run_state, resume_data_storage, get_experiment_store_dir, get_default_atlas, analyze_experiment, export_tables_plots, recover_qc_output_dirs, create_conversion_pool, _is_file_ready
 
 #current directory of program
 current_dir = os.path.dirname(__file__)
 
+#ms2 diagnostic precursors and fragment ions used to plot ms2 data
+default_ms2_panel = os.path.join(current_dir, 'default_atlases', 'default_ms2_panel.csv')
+
 class PathExists(argparse.Action):
     def __call__(self, parser, args, values, option_string=None):
         if not os.path.exists(values):
@@ -41,21 +37,92 @@ def arg_parser(parser=None):
     analysis_options = parser.add_argument_group()
     analysis_options.add_argument('-num', '--num_files', type=int, action='store', required=False,
                                     help='number of files to analyze in dataset. default is all files currently in directory')
-    analysis_options.add_argument('-min','--min_file_age', type=int, action='store', default=5, required=False,
-                                    help='minimum file age in minutes. default is 30')
+    analysis_options.add_argument('-min','--min_file_age', type=int, action='store', default=0, required=False,
+                                    help='minimum file age in minutes, on top of the file stability check. default is 0')
     analysis_options.add_argument('-skip', '--skip_blanks', type=bool, action='store', default=True, required=False,
                                     help='skip blank injections. default is True')
     analysis_options.add_argument('-export', '--export_num', type=int, action='store', default=None, required=False,
                                     help='export partial analysis every n number of files. default is None')
+    analysis_options.add_argument('-targeted', '--targeted', action='store_true', required=False,
+                                    help='only keep ms1 peaks within the atlas m/z windows while parsing, reduces memory use. default is False')
+    analysis_options.add_argument('-backend', '--mzml_backend', type=str, action='store', default='pymzml', choices=mzml_backends, required=False,
+                                    help='mzml reader, pymzml or the faster native xml decoder. default is pymzml')
+    analysis_options.add_argument('-cache', '--cache_dir', type=str, action='store', default=None, required=False,
+                                    help='directory of the spectral cache, reruns reuse extracted data instead of reconverting raw files. default is None (no cache)')
+    analysis_options.add_argument('-cache_size', '--cache_size', type=float, action='store', default=20, required=False,
+                                    help='maximum size of the spectral cache in GB, least recently used files are evicted. default is 20')
+    analysis_options.add_argument('-convert_workers', '--convert_workers', type=int, action='store', default=1, required=False,
+                                    help='number of raw files converted in the background while analyzing. default is 1')
+    analysis_options.add_argument('-convert_timeout', '--convert_timeout', type=float, action='store', default=None, required=False,
+                                    help='seconds before a raw file conversion is aborted. default is None (no timeout)')
+    analysis_options.add_argument('-convert_retries', '--convert_retries', type=int, action='store', default=1, required=False,
+                                    help='number of times a failed conversion is retried. default is 1')
+    analysis_options.add_argument('-stream', '--stream', action='store_true', required=False,
+                                    help='parse the converter output through a pipe instead of a temporary mzml file, uses the native mzml backend. default is False')
+    analysis_options.add_argument('-workers', '--workers', type=int, action='store', default=1, required=False,
+                                    help='number of files converted and analyzed in parallel processes, each process converts its own file so -convert_workers is not used. default is 1')
+    analysis_options.add_argument('-pipeline', '--pipeline', action='store_true', required=False,
+                                    help='overlap the centroid check, conversion, parsing and analysis of consecutive files in an asyncio pipeline. default is False')
+    analysis_options.add_argument('-parse_workers', '--parse_workers', type=int, action='store', default=1, required=False,
+                                    help='number of files parsed and analyzed at the same time by the pipeline. default is 1')
+    analysis_options.add_argument('-max_parsed', '--max_parsed', type=int, action='store', default=2, required=False,
+                                    help='maximum number of parsed files the pipeline holds in memory. default is 2')
+    analysis_options.add_argument('-flush_rows', '--flush_rows', type=int, action='store', default=0, required=False,
+                                    help='number of result rows buffered before they are written to the data store, files are checkpointed once written. default is 0 (every file)')
+    analysis_options.add_argument('-plot_workers', '--plot_workers', type=int, action='store', default=1, required=False,
+                                    help='number of processes rendering the qc plot pages of an export, needs pypdf. default is 1')
+    analysis_options.add_argument('-store', '--store', type=str, action='store', default='npz', choices=store_backends, required=False,
+                                    help='result store, npz tables or a sqlite database (data_store/results.db) that can be queried while the analysis runs. default is npz')
+    analysis_options.add_argument('-ms2_panel', '--ms2_panel', type=str, action='store', default=default_ms2_panel, required=False,
+                                    help='csv of ms2 diagnostic precursors and fragment ions (precursor_name, polarity, precursor_mz, fragment_mz). default is default_atlases/default_ms2_panel.csv')
+    analysis_options.add_argument('-stable', '--stable_seconds', type=float, action='store', default=default_stable_seconds, required=False,
+                                    help='seconds a raw file size and modification time must stay unchanged before it is analyzed. default is 15')
+    analysis_options.add_argument('-no_probe', '--no_handle_probe', action='store_true', required=False,
+                                    help='do not check that the acquisition software has released the raw file before analyzing it. default is False')
+    analysis_options.add_argument('-fresh', '--fresh', action='store_true', required=False,
+                                    help='discard the checkpoint of an interrupted run and analyze every file again. default is False')
+
+    #Daemon options
+    daemon_options = parser.add_argument_group()
+    daemon_options.add_argument('-daemon', '--daemon', action='store_true', required=False,
+                                    help='keep running and analyze every subdirectory of directory with raw files as its own experiment. default is False')
+    daemon_options.add_argument('-experiments', '--experiment_dirs', type=str, nargs='+', action='store', default=None, required=False,
+                                    help='additional directories watched by the daemon. default is None')
+    daemon_options.add_argument('-export_idle', '--export_idle', type=float, action='store', default=10, required=False,
+                                    help='minutes without new files before the daemon exports the full analysis of an experiment. default is 10')
 
     return parser
 
 def main(args):
 
-    initialize_data_storage(current_dir)
-    dataset = RawDataset(args.directory)
+    ms2_diagnostic = load_ms2_panel(args.ms2_panel)
+
+    #the render workers write single pages that are merged with pypdf
+    if args.plot_workers > 1 and plots.PdfWriter is None:
+        print('pypdf is not installed, qc plot pages are rendered in one process')
+        args.plot_workers = 1
+
+    if args.daemon:
+        run_daemon(args, current_dir, ms2_diagnostic, tolerance=0.0015, frag_tolerance=0.005)
+        return
+
+    #every experiment has its own store, an interrupted run resumes from its checkpoint unless a fresh run is requested
+    store_dir = get_experiment_store_dir(current_dir, args.directory)
+    run_state = {} if args.fresh else load_run_state(store_dir, args.directory)
+    if not initialize_data_storage(store_dir, resume=len(run_state) > 0, store=args.store):
+        run_state = {}
+
+    recover_qc_output_dirs(args.directory)
+    watcher = RawFileWatcher(args.directory, stable_seconds=args.stable_seconds, probe_handle=not args.no_handle_probe)
+    dataset = RawDataset(args.directory, watcher=watcher, run_state=run_state)
     exported_files = 0
 
+    if len(run_state) > 0:
+        resume_data_storage(store_dir, dataset, store=args.store)
+        print('Resuming analysis, {num} files already analyzed'.format(num=len(dataset.analyzed_files)))
+        if args.export_num is not None:
+            exported_files = len(dataset.analyzed_files) - len(dataset.analyzed_files) % args.export_num
+
     file_name_warnings, file_name_errors = dataset.validate_experiment_filenames()
     file_name_warnings_df = pd.DataFrame(file_name_warnings)
     file_name_errors_df = pd.DataFrame(file_name_errors)
@@ -68,15 +135,17 @@ def main(args):
         file_name_errors_df.to_csv(os.path.join(args.directory, 'file_name_errors_report.csv'))
         file_name_warnings_df.to_csv(os.path.join(args.directory, 'file_name_warnings_report.csv'))
 
-        close_data_storage(current_dir)
+        watcher.stop()
         quit()
 
-    atlas_df = pd.read_csv(os.path.join(current_dir, 'default_atlases\default_{chrom}_atlas.csv').format(chrom=dataset.chromatography.lower()))
+    atlas_df = get_default_atlas(current_dir, dataset.chromatography)
 
     if args.num_files is None:
-        args.num_files = len(dataset.files_to_analyze)
+        args.num_files = len(dataset.files_to_analyze) + len(dataset.analyzed_files)
         
-    print_progress_bar(0, args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
+    print_progress_bar(len(dataset.analyzed_files), args.num_files, prefix = 'Progress:', suffix = 'Complete', length = 50)
+
+    conversion_pool = create_conversion_pool(args, atlas_df, ms2_diagnostic, tolerance=0.0015)
 
     analysis_complete = False
     while True:
@@ -88,36 +157,42 @@ def main(args):
             if new_exported_files == args.export_num:
                 print('\nExporting and continuing analysis...')
                 exported_files += new_exported_files
-                export_tables_plots(current_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, exported_files)
+                export_tables_plots(store_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, exported_files)
 
         if len(dataset.analyzed_files) >= args.num_files:
             analysis_complete = True
 
         if not analysis_complete:
 
+            #wake up on new or modified raw files instead of polling, until a file has finished acquiring
             if len(dataset.files_to_analyze) < 1:
-                time.sleep(15)
+                watcher.wait_for_change(60)
                 dataset.set_files_to_analyze()
                 continue
 
-            file_ages = [get_raw_file_age(file) for file in dataset.files_to_analyze]
-            if max(file_ages) < args.min_file_age:
-                wait_time_seconds = (args.min_file_age - max(file_ages)) * 60
-                time.sleep(wait_time_seconds+200)
+            if not any(_is_file_ready(file, args, watcher=watcher) for file in dataset.files_to_analyze):
+                file_ages = [get_raw_file_age(file) for file in dataset.files_to_analyze]
+                wait_time_seconds = max(0, (args.min_file_age - max(file_ages)) * 60)
+                watcher.wait_for_change(max(wait_time_seconds, watcher.get_seconds_until_complete(dataset.files_to_analyze)))
+                dataset.set_files_to_analyze()
+                continue
 
-            analaysis_interrupted = analyze_experiment(dataset, atlas_df, ms2_diagnostic, current_dir, args, exported_files, tolerance=0.0015, frag_tolerance=0.005)
+            analaysis_interrupted = analyze_experiment(dataset, atlas_df, ms2_diagnostic, store_dir, args, exported_files, tolerance=0.0015, frag_tolerance=0.005, conversion_pool=conversion_pool)
 
             if analaysis_interrupted:
                 print('Analysis interrupted. Exiting...')
-                close_data_storage(current_dir)
+                watcher.stop()
+                conversion_pool.shutdown()
                 break
 
         else:
 
             print('\nDone! Exporting Results...')
 
-            export_tables_plots(current_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, 'full')
-            close_data_storage(current_dir)
+            watcher.stop()
+            conversion_pool.shutdown()
+            export_tables_plots(store_dir, args, file_name_warnings_df, atlas_df, ms2_diagnostic, 'full')
+            close_data_storage(store_dir, store=args.store)
             break
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+#asyncio pipeline running jobs through stages connected by bounded queues, results are committed in job order
+
+import asyncio
+
+class PipelineStage():
+    """One step of the pipeline, workers tasks run the coroutine func(job) concurrently.
+
+    Jobs hold one of max_in_memory slots from the first to the last stage with holds_memory,
+    e.g. while a parsed file waits for and goes through analysis.
+    """
+
+    def __init__(self, func, workers=1, holds_memory=False):
+        self.func = func
+        self.workers = max(1, workers)
+        self.holds_memory = holds_memory
+
+class _PipelineJob():
+    __slots__ = ['job', 'done', 'error', 'holds_memory']
+
+    def __init__(self, job, done):
+        self.job = job
+        self.done = done
+        self.error = None
+        self.holds_memory = False
+
+async def _run_stage(stage, in_queue, out_queue, memory_slots, last_memory_stage):
+    while True:
+        pipeline_job = await in_queue.get()
+
+        if pipeline_job.error is None:
+            if stage.holds_memory and not pipeline_job.holds_memory:
+                await memory_slots.acquire()
+                pipeline_job.holds_memory = True
+            try:
+                await stage.func(pipeline_job.job)
+            except Exception as error:
+                pipeline_job.error = error
+
+        if pipeline_job.holds_memory and (stage is last_memory_stage or pipeline_job.error is not None):
+            memory_slots.release()
+            pipeline_job.holds_memory = False
+
+        if out_queue is None:
+            pipeline_job.done.set()
+        else:
+            await out_queue.put(pipeline_job)
+
+async def _feed(next_job, queue, ordered_jobs, outstanding):
+    while True:
+        await outstanding.acquire()
+
+        job = next_job()
+        if job is None:
+            ordered_jobs.put_nowait(None)
+            return
+        job, run_stages = job
+
+        pipeline_job = _PipelineJob(job, asyncio.Event())
+        ordered_jobs.put_nowait(pipeline_job)
+        if run_stages:
+            await queue.put(pipeline_job)
+        else:
+            pipeline_job.done.set()
+
+async def run_pipeline(next_job, stages, commit, discard=None, max_in_memory=1, max_outstanding=None):
+    """Run jobs through stages and commit(job, error) each in the order next_job produced them.
+
+    next_job() returns (job, run_stages) or None once there are no more jobs, jobs with run_stages False go
+    straight to commit. It is called lazily, at most max_outstanding jobs are uncommitted at any time.
+    A job that raises skips its remaining stages and is committed with the error. The pipeline stops
+    once commit returns False, jobs that are not committed by then are handed to discard(job).
+    """
+
+    if max_outstanding is None:
+        max_outstanding = sum(stage.workers * 2 for stage in stages) + max_in_memory
+
+    queues = [asyncio.Queue(maxsize=stage.workers) for stage in stages]
+    ordered_jobs = asyncio.Queue()
+    outstanding = asyncio.Semaphore(max_outstanding)
+    memory_slots = asyncio.Semaphore(max(1, max_in_memory))
+
+    memory_stages = [stage for stage in stages if stage.holds_memory]
+    last_memory_stage = memory_stages[-1] if len(memory_stages) > 0 else None
+
+    tasks = [asyncio.ensure_future(_feed(next_job, queues[0], ordered_jobs, outstanding))]
+    for stage_idx, stage in enumerate(stages):
+        out_queue = queues[stage_idx + 1] if stage_idx + 1 < len(stages) else None
+        for worker in range(stage.workers):
+            tasks.append(asyncio.ensure_future(_run_stage(stage, queues[stage_idx], out_queue, memory_slots, last_memory_stage)))
+
+    uncommitted_jobs = []
+    try:
+        while True:
+            pipeline_job = await ordered_jobs.get()
+            if pipeline_job is None:
+                break
+
+            uncommitted_jobs = [pipeline_job]
+            await pipeline_job.done.wait()
+            uncommitted_jobs = []
+
+            outstanding.release()
+            if not commit(pipeline_job.job, pipeline_job.error):
+                break
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        while not ordered_jobs.empty():
+            pipeline_job = ordered_jobs.get_nowait()
+            if pipeline_job is not None:
+                uncommitted_jobs.append(pipeline_job)
+        if discard is not None:
+            for pipeline_job in uncommitted_jobs:
+                discard(pipeline_job.job)
@@ -1,42 +1,130 @@
 #handle the plotting functions
 
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
 import pandas as pd
 import os
+import hashlib
+import collections
+import concurrent.futures
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+#exports without pypdf redraw every page, this is only reported once
+_reported_missing_pypdf = False
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
-def _make_unlabeled_m1_compound_figure(all_ms1_data, y_axis, compound_name, logy=False):
-    ms1_data = all_ms1_data.loc[all_ms1_data['file_category'].isin(['S1', 'ExCtrl'])]
+#file categories shown on the compound and tic pages, runs of other categories do not change them
+ms1_page_categories = ['ISTD', 'S1', 'ExCtrl']
+unlabeled_page_categories = ['S1', 'ExCtrl']
+tic_page_categories = ['S1', 'ExCtrl']
 
-    if logy:
-        ms1_data[y_axis] = np.log10(ms1_data[y_axis])
+#ms1 compound pages: polarity of each axes, (color, color below the intensity threshold) and legend label of each
+#file category in drawing order, y axes and their precomputed values
+ms1_page_polarities = ['POS', 'NEG']
+ms1_category_colors = {'S1':('orange', 'orangered'), 'ISTD':('blue', 'midnightblue'), 'ExCtrl':('gray', 'black'), 'TxCtrl':('yellow', 'gold')}
+ms1_category_labels = {'S1':'Sample', 'ISTD':'ISTD', 'ExCtrl':'ExCtrl', 'TxCtrl':'TxCtrl'}
+ms1_y_axes = ['observed_intensity', 'ppm_error', 'retention_time']
+ms1_y_keys = ms1_y_axes + ['observed_intensity_logy']
 
-    fig, axs = plt.subplots(2, sharex=True)
-    title = compound_name
+class PageCache():
+    """Pages of the qc pdfs rendered by earlier exports, one pdf per pdf name and compound, group or precursor.
 
-    pos_data = ms1_data.loc[ms1_data['polarity']=='POS']
-    neg_data = ms1_data.loc[ms1_data['polarity']=='NEG']
+    Keys in redraw_keys (every key if None) are rendered again, the other keys reuse their cached pages.
+    """
 
-    sample_pos_data = pos_data.loc[pos_data['file_category']=='S1']
-    sample_neg_data = neg_data.loc[neg_data['file_category']=='S1']
+    def __init__(self, cache_dir, redraw_keys=None):
+        self.cache_dir = cache_dir
+        self.redraw_keys = redraw_keys
 
-    exctrl_pos_data = pos_data.loc[pos_data['file_category']=='ExCtrl']
-    exctrl_neg_data = neg_data.loc[neg_data['file_category']=='ExCtrl']
+    def get_page_path(self, pdf_name, key):
+        return os.path.join(self.cache_dir, pdf_name, hashlib.sha1(str(key).encode()).hexdigest() + '.pdf')
 
-    txctrl_pos_data = pos_data.loc[pos_data['file_category']=='TxCtrl']
-    txctrl_neg_data = neg_data.loc[neg_data['file_category']=='TxCtrl']
+    def needs_redraw(self, pdf_name, key):
+        return self.redraw_keys is None or key in self.redraw_keys or not os.path.isfile(self.get_page_path(pdf_name, key))
 
-    axs[0].scatter(sample_pos_data['run_num'], sample_pos_data[y_axis], color='orange', label='Sample')
-    axs[0].scatter(exctrl_pos_data['run_num'], exctrl_pos_data[y_axis], color='gray', label='ExCtrl')
-    axs[0].scatter(txctrl_pos_data['run_num'], txctrl_pos_data[y_axis], color='yellow', label='TxCtrl')
-    
-    axs[1].scatter(sample_neg_data['run_num'], sample_neg_data[y_axis], color='orange', label='Sample')
-    axs[1].scatter(exctrl_neg_data['run_num'], exctrl_neg_data[y_axis], color='gray', label='ExCtrl')
-    axs[1].scatter(txctrl_neg_data['run_num'], txctrl_neg_data[y_axis], color='yellow', label='TxCtrl')
+def _init_render_worker():
+    #render workers only save figures to files
+    matplotlib.use('Agg')
+
+def create_render_pool(workers=1):
+    """Process pool rendering qc pages with the Agg backend, None (pages are rendered in this process) for one worker."""
+
+    if workers <= 1:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker)
+
+def _save_figures(pdf, figures):
+    for fig in figures:
+        pdf.savefig(fig)
+    plt.close('all')
+
+def _render_page(page_path, make_figures, figure_args):
+    pdf = PdfPages(page_path + '.tmp')
+    _save_figures(pdf, make_figures(*figure_args))
+    pdf.close()
+    os.replace(page_path + '.tmp', page_path)
+
+def _save_qc_pdf(pdf_path, page_keys, get_page, page_cache=None, render_pool=None):
+    """Save the pages of every key to pdf_path in key order, get_page(key) returns (make_figures, figure_args).
+
+    With a page_cache only the keys that need it are rendered, by the render_pool if there is one, and the pdf is
+    merged from the cached pages. Without pypdf every page is rendered in this process.
+    """
+
+    global _reported_missing_pypdf
+    if page_cache is not None and PdfWriter is None and not _reported_missing_pypdf:
+        print('pypdf is not installed, every qc plot page is redrawn')
+        _reported_missing_pypdf = True
+
+    if page_cache is None or PdfWriter is None:
+        pdf = PdfPages(pdf_path)
+        for key in page_keys:
+            make_figures, figure_args = get_page(key)
+            _save_figures(pdf, make_figures(*figure_args))
+        pdf.close()
+        return
+
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    os.makedirs(os.path.join(page_cache.cache_dir, pdf_name), exist_ok=True)
+
+    page_paths = [page_cache.get_page_path(pdf_name, key) for key in page_keys]
+    rendered_pages = []
+    for key, page_path in zip(page_keys, page_paths):
+        if page_cache.needs_redraw(pdf_name, key):
+            make_figures, figure_args = get_page(key)
+            if render_pool is None:
+                _render_page(page_path, make_figures, figure_args)
+            else:
+                rendered_pages.append(render_pool.submit(_render_page, page_path, make_figures, figure_args))
+
+    for rendered_page in rendered_pages:
+        rendered_page.result()
+
+    pdf_writer = PdfWriter()
+    for page_path in page_paths:
+        pdf_writer.append(page_path)
+
+    with open(pdf_path, 'wb') as pdf_file:
+        pdf_writer.write(pdf_file)
+
+def _make_unlabeled_m1_compound_figure(page_data, y_axis, compound_name, logy=False):
+    y_key = y_axis + '_logy' if logy else y_axis
+
+    fig, axs = plt.subplots(2, sharex=True)
+    title = compound_name
+
+    for ax, polarity in zip(axs, ms1_page_polarities):
+        for file_category in ['S1', 'ExCtrl', 'TxCtrl']:
+            category_data = page_data[polarity][file_category]
+            ax.scatter(category_data['run_num'], category_data[y_key], color=ms1_category_colors[file_category][0], label=ms1_category_labels[file_category])
 
     axs[0].margins(y=1)
     axs[1].margins(y=1)
@@ -63,8 +151,7 @@ def _create_line_plots(ms1_tic_data, ax, cmap_name):
         ax.plot(row.ms1_tic[1], row.ms1_tic[0], color=colors[idx], label='{group}_{run_num}'.format(group=row['group'], run_num=row['run_num']))
 
 def _make_m1_tic_figure(all_ms1_tic_data, group_name, logy=False):
-    ms1_tic_data = all_ms1_tic_data.loc[all_ms1_tic_data['file_category'].isin(['S1', 'ExCtrl'])]
-    ms1_tic_data['ms1_tic'] = ms1_tic_data['ms1_tic'].apply(lambda x: np.asarray(eval(x)))
+    ms1_tic_data = all_ms1_tic_data.loc[all_ms1_tic_data['file_category'].isin(tic_page_categories)]
 
     if logy:
         ms1_tic_data['ms1_tic']= ms1_tic_data['ms1_tic'].apply(lambda x: np.array([np.log10(x[0]), x[1]]))
@@ -100,118 +187,116 @@ def _make_m1_tic_figure(all_ms1_tic_data, group_name, logy=False):
 
     return fig
 
-def _label_outliers(data_df, y_axis, median_value, ax):
+def _get_outlier_mask(y_axis, y_values, median_value):
+    """
+    points labeled with their run number, outside of a y_axis specific range around the median value
     """
-    label points with run number outside of 50% or median value
+    if y_axis == 'observed_intensity':
+        return (y_values > median_value * 10) | (y_values < median_value * 0.1)
+    if y_axis == 'ppm_error':
+        return (y_values > median_value + 1.75) | (y_values < median_value - 2)
+    if y_axis == 'retention_time':
+        return (y_values > median_value + 0.2) | (y_values < median_value - 0.5)
+    return np.zeros(len(y_values), dtype=bool)
+
+def _label_outliers(category_data, y_key, ax):
+    outlier_mask = category_data['outliers'][y_key]
+    for run_num, y_value in zip(category_data['run_num'][outlier_mask], category_data[y_key][outlier_mask]):
+        ax.text(run_num, y_value, run_num)
+
+def _get_ms1_category_data(columns, rows, polarity_medians):
+    category_data = {column:values[rows] for column, values in columns.items()}
+    category_data['outliers'] = {y_key:_get_outlier_mask(y_key.replace('_logy', ''), category_data[y_key], polarity_medians[y_key]) for y_key in ms1_y_keys}
+    return category_data
+
+def prepare_ms1_page_data(ms1_data, file_categories):
+    """Drawing data of every compound page in one pass over ms1_data, rows of other file categories are left out.
+
+    {compound_name:{'run_num':run numbers in row order, polarity:{'median':{y key:value}, 'run_num_range':(min, max),
+    file_category:{'run_num':x, y key:y, 'outliers':{y key:mask}}}}}, the y keys are the y axes and
+    observed_intensity_logy, the log10 intensities of the log scale pages.
     """
-    for idx, row in data_df.iterrows():
 
-        if y_axis == 'observed_intensity':
-            if row[y_axis] > median_value * 10 or row[y_axis] < median_value * 0.1:
-                ax.text(row.run_num, row[y_axis], row.run_num)
-        if y_axis == 'ppm_error':
-            if row[y_axis] > median_value + 1.75 or row[y_axis] < median_value - 2:
-                ax.text(row.run_num, row[y_axis], row.run_num)
-        if y_axis == 'retention_time':
-            if row[y_axis] > median_value + 0.2 or row[y_axis] < median_value - 0.5:
-                ax.text(row.run_num, row[y_axis], row.run_num)
+    page_df = ms1_data.loc[ms1_data['file_category'].isin(file_categories)]
 
-        
+    columns = {column:page_df[column].to_numpy() for column in ['run_num'] + ms1_y_axes}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns['observed_intensity_logy'] = np.log10(columns['observed_intensity'])
 
-#'observed_intensity' 'ppm_error' 'retention_time'
+    median_df = pd.DataFrame({y_key:columns[y_key] for y_key in ms1_y_keys})
+    median_df['compound_name'] = page_df['compound_name'].to_numpy()
+    median_df['polarity'] = page_df['polarity'].to_numpy()
+    medians = median_df.groupby(['compound_name', 'polarity'], sort=False).median().to_dict('index')
 
-def _make_compound_ms1_figure(all_ms1_data, y_axis, compound_name, intensity_threshold=None, logy=False, label_outliers=True):
+    group_rows = page_df.groupby(['compound_name', 'polarity', 'file_category'], sort=False).indices
+    compound_rows = collections.defaultdict(list)
+    for (compound_name, polarity, file_category), rows in group_rows.items():
+        compound_rows[compound_name].append(rows)
 
-    ms1_data = all_ms1_data.loc[all_ms1_data['file_category'].isin(['ISTD', 'S1', 'ExCtrl'])]
+    page_data = {}
+    for compound_name, rows in compound_rows.items():
+        page_data[compound_name] = _get_ms1_page_data(columns, compound_name, np.sort(np.concatenate(rows)), group_rows, medians)
 
-    if logy:
-        ms1_data[y_axis] = np.log10(ms1_data[y_axis])
-        intensity_threshold = np.log10(intensity_threshold)
+    return page_data
 
-    fig, axs = plt.subplots(2, sharex=True)
-    title = compound_name
+def _get_ms1_page_data(columns, compound_name, compound_rows, group_rows, medians):
+    no_rows = np.array([], dtype=np.int64)
 
-    pos_data = ms1_data.loc[ms1_data['polarity']=='POS']
-    neg_data = ms1_data.loc[ms1_data['polarity']=='NEG']
+    compound_data = {'run_num':columns['run_num'][compound_rows]}
+    for polarity in ms1_page_polarities:
+        polarity_medians = medians.get((compound_name, polarity), {y_key:np.nan for y_key in ms1_y_keys})
+        polarity_data = {'median':polarity_medians}
 
-    istd_pos_data = pos_data.loc[pos_data['file_category']=='ISTD']
-    istd_neg_data = neg_data.loc[neg_data['file_category']=='ISTD']
+        polarity_rows = []
+        for file_category in ms1_category_colors:
+            rows = group_rows.get((compound_name, polarity, file_category), no_rows)
+            polarity_data[file_category] = _get_ms1_category_data(columns, rows, polarity_medians)
+            polarity_rows.append(rows)
 
-    sample_pos_data = pos_data.loc[pos_data['file_category']=='S1']
-    sample_neg_data = neg_data.loc[neg_data['file_category']=='S1']
+        polarity_run_nums = columns['run_num'][np.concatenate(polarity_rows)]
+        polarity_data['run_num_range'] = (polarity_run_nums.min(), polarity_run_nums.max()) if len(polarity_run_nums) > 0 else (np.nan, np.nan)
+        compound_data[polarity] = polarity_data
 
-    exctrl_pos_data = pos_data.loc[pos_data['file_category']=='ExCtrl']
-    exctrl_neg_data = neg_data.loc[neg_data['file_category']=='ExCtrl']
+    return compound_data
 
-    txctrl_pos_data = pos_data.loc[pos_data['file_category']=='TxCtrl']
-    txctrl_neg_data = neg_data.loc[neg_data['file_category']=='TxCtrl']
+def _get_empty_ms1_page_data():
+    empty_columns = {column:np.array([], dtype=float) for column in ['run_num'] + ms1_y_keys}
+    return _get_ms1_page_data(empty_columns, None, np.array([], dtype=np.int64), {}, {})
 
-    sample_pos_y = np.array(sample_pos_data[y_axis].tolist())
-    istd_pos_y = np.array(istd_pos_data[y_axis].tolist())
-    exctrl_pos_y = np.array(exctrl_pos_data[y_axis].tolist())
-    txctrl_pos_y = np.array(txctrl_pos_data[y_axis].tolist())
+def _make_compound_ms1_figure(page_data, y_axis, compound_name, intensity_threshold=None, logy=False, label_outliers=True):
 
-    sample_neg_y = np.array(sample_neg_data[y_axis].tolist())
-    istd_neg_y = np.array(istd_neg_data[y_axis].tolist())
-    exctrl_neg_y = np.array(exctrl_neg_data[y_axis].tolist())
-    txctrl_neg_y = np.array(txctrl_neg_data[y_axis].tolist())
+    y_key = y_axis + '_logy' if logy else y_axis
+    if logy:
+        intensity_threshold = np.log10(intensity_threshold)
 
-    if intensity_threshold is not None:
-        sample_pos_col = np.where(sample_pos_y<intensity_threshold,'orangered', 'orange')
-        istd_pos_col = np.where(istd_pos_y<intensity_threshold,'midnightblue', 'blue')
-        exctrl_pos_col = np.where(exctrl_pos_y<intensity_threshold,'black', 'gray')
-        txctrl_pos_col = np.where(txctrl_pos_y<intensity_threshold,'gold', 'yellow')
-
-        sample_neg_col = np.where(sample_neg_y<intensity_threshold,'orangered', 'orange')
-        istd_neg_col = np.where(istd_neg_y<intensity_threshold,'midnightblue', 'blue')
-        exctrl_neg_col = np.where(exctrl_neg_y<intensity_threshold,'black', 'gray')
-        txctrl_neg_col = np.where(txctrl_neg_y<intensity_threshold,'gold', 'yellow')
-    else:
-        sample_pos_col = 'orange'
-        istd_pos_col = 'blue'
-        exctrl_pos_col = 'gray'
-        txctrl_pos_col = 'yellow'
-
-        sample_neg_col = 'orange'
-        istd_neg_col = 'blue'
-        exctrl_neg_col = 'gray'
-        txctrl_neg_col = 'yellow'
-
-    axs[0].scatter(sample_pos_data['run_num'], sample_pos_y, color=sample_pos_col, label='Sample')
-    axs[0].scatter(istd_pos_data['run_num'], istd_pos_y, color=istd_pos_col, label='ISTD')
-    axs[0].scatter(exctrl_pos_data['run_num'], exctrl_pos_y, color=exctrl_pos_col, label='ExCtrl')
-    axs[0].scatter(txctrl_pos_data['run_num'], txctrl_pos_y, color=txctrl_pos_col, label='TxCtrl')
-    
-    axs[1].scatter(sample_neg_data['run_num'], sample_neg_y, color=sample_neg_col, label='Sample')
-    axs[1].scatter(istd_neg_data['run_num'], istd_neg_y, color=istd_neg_col, label='ISTD')
-    axs[1].scatter(exctrl_neg_data['run_num'], exctrl_neg_y, color=exctrl_neg_col, label='ExCtrl')
-    axs[1].scatter(txctrl_neg_data['run_num'], txctrl_neg_y, color=txctrl_neg_col, label='TxCtrl')
+    fig, axs = plt.subplots(2, sharex=True)
+    title = compound_name
+
+    for ax, polarity in zip(axs, ms1_page_polarities):
+        for file_category, (color, low_color) in ms1_category_colors.items():
+            category_data = page_data[polarity][file_category]
+            if intensity_threshold is not None:
+                color = np.where(category_data[y_key]<intensity_threshold, low_color, color)
+            ax.scatter(category_data['run_num'], category_data[y_key], color=color, label=ms1_category_labels[file_category])
 
     if label_outliers is not None:
-        pos_median_value = pos_data[y_axis].median()
-        neg_median_value = neg_data[y_axis].median()
-        _label_outliers(sample_pos_data, y_axis, pos_median_value, axs[0])
-        _label_outliers(istd_pos_data, y_axis, pos_median_value, axs[0])
-        _label_outliers(exctrl_pos_data, y_axis, pos_median_value, axs[0])
-        _label_outliers(txctrl_pos_data, y_axis, pos_median_value, axs[0])
-
-        _label_outliers(sample_neg_data, y_axis, neg_median_value, axs[1])
-        _label_outliers(istd_neg_data, y_axis, neg_median_value, axs[1])
-        _label_outliers(exctrl_neg_data, y_axis, neg_median_value, axs[1])
-        _label_outliers(txctrl_neg_data, y_axis, neg_median_value, axs[1])
+        for ax, polarity in zip(axs, ms1_page_polarities):
+            for file_category in ms1_category_colors:
+                _label_outliers(page_data[polarity][file_category], y_key, ax)
 
     axs[0].margins(y=1)
     axs[1].margins(y=1)
     axs[0].set_title('POS')
     axs[1].set_title('NEG')
 
-    axs[0].hlines(y=np.mean(np.nan_to_num(istd_pos_y)), xmin=pos_data['run_num'].min(), xmax=pos_data['run_num'].max(), color='blue', linestyle='dashed', label='ISTD Mean')
-    axs[1].hlines(y=np.mean(np.nan_to_num(istd_neg_y)), xmin=neg_data['run_num'].min(), xmax=neg_data['run_num'].max(), color='blue', linestyle='dashed', label='ISTD Mean')
+    for ax, polarity in zip(axs, ms1_page_polarities):
+        xmin, xmax = page_data[polarity]['run_num_range']
+        ax.hlines(y=np.mean(np.nan_to_num(page_data[polarity]['ISTD'][y_key])), xmin=xmin, xmax=xmax, color='blue', linestyle='dashed', label='ISTD Mean')
 
     if intensity_threshold is not None:
-        intensity_threshold = [intensity_threshold for i in range(len(ms1_data.run_num))]
-        axs[0].plot(ms1_data['run_num'], intensity_threshold, color='red', linestyle='solid', label='Intensity Threshold')
-        axs[1].plot(ms1_data['run_num'], intensity_threshold, color='red', linestyle='solid', label='Intensity Threshold')
+        intensity_threshold = [intensity_threshold for i in range(len(page_data['run_num']))]
+        axs[0].plot(page_data['run_num'], intensity_threshold, color='red', linestyle='solid', label='Intensity Threshold')
+        axs[1].plot(page_data['run_num'], intensity_threshold, color='red', linestyle='solid', label='Intensity Threshold')
 
     axs[0].legend(loc="upper right", prop={'size': 6})
     
@@ -221,31 +306,31 @@ def _make_compound_ms1_figure(all_ms1_data, y_axis, compound_name, intensity_thr
 
     return fig
 
-def _make_compound_ms2_figure(ms2_data, y_axis, ms2_diagnostic, logy=False):
+def _make_compound_ms2_figure(ms2_data, y_axis, precursor_name, ms2_diagnostic, logy=False):
     
     if logy:
         ms2_data[y_axis] = np.log10(ms2_data[y_axis])
 
-    pos_ms2_data = ms2_data.loc[ms2_data['polarity']=='POS']
-    neg_ms2_data = ms2_data.loc[ms2_data['polarity']=='NEG']
-
     fig, axes = plt.subplots(2, sharex=True)
-    title = 'Diagnostic MS2 Fragment Ions'
-
-    for pos_frag_ion in ms2_diagnostic['POS']['diagnostic_ions']:
-        pos_frag_ion_data = pos_ms2_data.loc[pos_ms2_data['theoretical_mz']==pos_frag_ion]
-        axes[0].plot(pos_frag_ion_data['run_num'], pos_frag_ion_data[y_axis], label= pos_frag_ion, marker='o')
-
-    for neg_frag_ion in ms2_diagnostic['NEG']['diagnostic_ions']:
-        neg_frag_ion_data = neg_ms2_data.loc[neg_ms2_data['theoretical_mz']==neg_frag_ion]
-        axes[1].plot(neg_frag_ion_data['run_num'], neg_frag_ion_data[y_axis], label= neg_frag_ion, marker='o')
-        
-    axes[0].margins(y=1)
-    axes[1].margins(y=1)
-    axes[0].set_title('POS')
-    axes[1].set_title('NEG')
-    axes[0].legend(loc="upper right", prop={'size': 6})
-    axes[1].legend(loc="upper right", prop={'size': 6})
+    title = '{precursor} Diagnostic MS2 Fragment Ions'.format(precursor=precursor_name)
+
+    for ax, polarity in zip(axes, ['POS', 'NEG']):
+        polarity_ms2_data = ms2_data.loc[ms2_data['polarity']==polarity]
+
+        for panel_entry in ms2_diagnostic.get(polarity, []):
+            if panel_entry['name'] != precursor_name:
+                continue
+
+            #panel entries are keyed by precursor name and polarity, precursor m/z values are floats read back from csv or the store
+            entry_ms2_data = polarity_ms2_data.loc[polarity_ms2_data['precursor_name']==precursor_name]
+            for frag_ion in panel_entry['diagnostic_ions']:
+                frag_ion_data = entry_ms2_data.loc[entry_ms2_data['theoretical_mz']==frag_ion]
+                ax.plot(frag_ion_data['run_num'], frag_ion_data[y_axis], label= frag_ion, marker='o')
+
+        ax.margins(y=1)
+        ax.set_title(polarity)
+        if ax.has_data():
+            ax.legend(loc="upper right", prop={'size': 6})
 
     fig.suptitle(title)
     fig.supxlabel('RUN_NUMBER')
@@ -254,34 +339,50 @@ def _make_compound_ms2_figure(ms2_data, y_axis, ms2_diagnostic, logy=False):
     return fig
 
 
-def make_ms1_qc_plots(ms1_data, atlas_df, qc_output_dir, logy=False):
+def _make_ms1_page(page_data, compound_name, intensity_threshold, logy):
+    fig1 = _make_compound_ms1_figure(page_data, 'observed_intensity', compound_name, intensity_threshold=intensity_threshold, logy=logy)
+    fig2 = _make_compound_ms1_figure(page_data, 'ppm_error', compound_name)
+    fig3 = _make_compound_ms1_figure(page_data, 'retention_time', compound_name)
+
+    return [fig1, fig2, fig3]
+
+def _make_ms2_page(precursor_df, precursor_name, ms2_diagnostic, logy):
+    fig1 = _make_compound_ms2_figure(precursor_df, 'observed_intensity', precursor_name, ms2_diagnostic, logy=logy)
+    fig2 = _make_compound_ms2_figure(precursor_df, 'ppm_error', precursor_name, ms2_diagnostic)
+
+    return [fig1, fig2]
+
+def _make_unlabeled_ms1_page(page_data, compound_name, logy):
+    fig1 = _make_unlabeled_m1_compound_figure(page_data, 'observed_intensity', compound_name, logy=logy)
+    fig2 = _make_unlabeled_m1_compound_figure(page_data, 'ppm_error', compound_name)
+
+    return [fig1, fig2]
+
+def _make_tic_page(ms1_tic_data, group, logy):
+    return [_make_m1_tic_figure(ms1_tic_data, group, logy=logy)]
+
+def make_ms1_qc_plots(ms1_data, atlas_df, qc_output_dir, logy=False, page_cache=None, render_pool=None, page_data=None):
+    """page_data from prepare_ms1_page_data(ms1_data, ms1_page_categories) is reused by the linear and log scale plots."""
 
     ms1_data.sort_values('run_num', inplace=True)
+    if page_data is None:
+        page_data = prepare_ms1_page_data(ms1_data, ms1_page_categories)
 
     if logy:
         logy_str = '_logy'
     else:
         logy_str = ''
-    
-    pdf = PdfPages(qc_output_dir + '/ms1_qc_plots{logy}.pdf'.format(logy=logy_str))
 
-    for idx, row in atlas_df[atlas_df.signal_check==False].iterrows():
+    compounds_df = atlas_df[atlas_df.signal_check==False]
+    intensity_thresholds = dict(zip(compounds_df.compound_name, compounds_df.intensity_threshold))
 
-        compound_df = ms1_data.loc[ms1_data.compound_name == row.compound_name]
+    def get_page(compound_name):
+        return _make_ms1_page, (page_data.get(compound_name) or _get_empty_ms1_page_data(), compound_name, intensity_thresholds[compound_name], logy)
 
-        fig1 = _make_compound_ms1_figure(compound_df, 'observed_intensity', row.compound_name, intensity_threshold=row.intensity_threshold, logy=logy)
-        fig2 = _make_compound_ms1_figure(compound_df, 'ppm_error', row.compound_name)
-        fig3 = _make_compound_ms1_figure(compound_df, 'retention_time', row.compound_name)
+    _save_qc_pdf(qc_output_dir + '/ms1_qc_plots{logy}.pdf'.format(logy=logy_str), compounds_df['compound_name'].tolist(), get_page,
+                 page_cache=page_cache, render_pool=render_pool)
 
-        pdf.savefig(fig1)
-        pdf.savefig(fig2)
-        pdf.savefig(fig3)
-
-        plt.close('all')
-
-    pdf.close()
-
-def make_ms2_qc_plots(ms2_data, ms2_diagnostic, qc_output_dir, logy=False):
+def make_ms2_qc_plots(ms2_data, ms2_diagnostic, qc_output_dir, logy=False, page_cache=None, render_pool=None):
 
     ms2_data.sort_values('run_num', inplace=True)
 
@@ -289,67 +390,54 @@ def make_ms2_qc_plots(ms2_data, ms2_diagnostic, qc_output_dir, logy=False):
         logy_str = '_logy'
     else:
         logy_str = ''
-    
-    pdf = PdfPages(qc_output_dir + '/ms2_qc_plots{logy}.pdf'.format(logy=logy_str))
 
-    fig1 = _make_compound_ms2_figure(ms2_data, 'observed_intensity', ms2_diagnostic, logy=logy)
-    fig2 = _make_compound_ms2_figure(ms2_data, 'ppm_error', ms2_diagnostic)
+    #one page per panel precursor in panel order, positive and negative mode entries of a precursor share it
+    precursor_names = list(dict.fromkeys(entry['name'] for polarity in ['POS', 'NEG'] for entry in ms2_diagnostic.get(polarity, [])))
 
-    pdf.savefig(fig1)
-    pdf.savefig(fig2)
+    def get_page(precursor_name):
+        precursor_df = ms2_data.loc[ms2_data.precursor_name == precursor_name]
+        return _make_ms2_page, (precursor_df, precursor_name, ms2_diagnostic, logy)
 
-    plt.close('all')
-
-    pdf.close()
+    _save_qc_pdf(qc_output_dir + '/ms2_qc_plots{logy}.pdf'.format(logy=logy_str), precursor_names, get_page, page_cache=page_cache, render_pool=render_pool)
 
-def make_unlabeled_ms1_qc_plots(ms1_data, atlas_df, qc_output_dir, logy=False):
+def make_unlabeled_ms1_qc_plots(ms1_data, atlas_df, qc_output_dir, logy=False, page_cache=None, render_pool=None, page_data=None):
+    """page_data from prepare_ms1_page_data(ms1_data, unlabeled_page_categories) is reused by the linear and log scale plots."""
 
     ms1_data.sort_values('run_num', inplace=True)
+    if page_data is None:
+        page_data = prepare_ms1_page_data(ms1_data, unlabeled_page_categories)
 
     if logy:
         logy_str = '_logy'
     else:
         logy_str = ''
-    
-    pdf = PdfPages(qc_output_dir + '/ms1_unlabeled_intensity_plots{logy}.pdf'.format(logy=logy_str))
-
-    for idx, row in atlas_df[atlas_df.signal_check==True].iterrows():
 
-        compound_df = ms1_data.loc[ms1_data.compound_name == row.compound_name]
+    compound_names = atlas_df[atlas_df.signal_check==True]['compound_name'].tolist()
 
-        fig1 = _make_unlabeled_m1_compound_figure(compound_df, 'observed_intensity', row.compound_name, logy=logy)
-        fig2 = _make_unlabeled_m1_compound_figure(compound_df, 'ppm_error', row.compound_name)
+    def get_page(compound_name):
+        return _make_unlabeled_ms1_page, (page_data.get(compound_name) or _get_empty_ms1_page_data(), compound_name, logy)
 
-        pdf.savefig(fig1)
-        pdf.savefig(fig2)
-
-        plt.close('all')
-
-    pdf.close()
+    _save_qc_pdf(qc_output_dir + '/ms1_unlabeled_intensity_plots{logy}.pdf'.format(logy=logy_str), compound_names, get_page,
+                 page_cache=page_cache, render_pool=render_pool)
 
-def make_ms1_tic_qc_plots(ms1_tic_data, qc_output_dir, logy=False, exclude_groups=['QC', 'ISTD', 'InjBl', 'ExCtrl']):
+def make_ms1_tic_qc_plots(ms1_tic_data, qc_output_dir, logy=False, exclude_groups=['QC', 'ISTD', 'InjBl', 'ExCtrl'], page_cache=None, render_pool=None):
 
     if logy:
         logy_str = '_logy'
     else:
         logy_str = ''
 
-    pdf = PdfPages(qc_output_dir + '/ms1_tic_plots{logy}.pdf'.format(logy=logy_str))
-
     groups = set(ms1_tic_data.group.tolist())
     [groups.discard(exclude_group) for exclude_group in exclude_groups]
 
-    if len(groups) > 1:
-        for group in groups:
-
-            fig1 = _make_m1_tic_figure(ms1_tic_data, group, logy=logy)
-
-            pdf.savefig(fig1)
-
-            plt.close('all')
-    
-    else:
+    if len(groups) <= 1:
         print('Only one group detected, not generating overlay plots...')
         plt.close('all')
-    
-    pdf.close()
\ No newline at end of file
+        groups = []
+
+    def get_page(group):
+        #a group page shows the runs of the group and every ExCtrl run
+        group_tic_data = ms1_tic_data.loc[(ms1_tic_data['group'] == group) | (ms1_tic_data['file_category'] == 'ExCtrl')]
+        return _make_tic_page, (group_tic_data, group, logy)
+
+    _save_qc_pdf(qc_output_dir + '/ms1_tic_plots{logy}.pdf'.format(logy=logy_str), list(groups), get_page, page_cache=page_cache, render_pool=render_pool)
@@ -1,15 +1,203 @@
 #convert raw file to mzml using ThermoRawFileParser 
 
 import os
+import asyncio
+import shutil
+import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 current_dir = os.path.dirname(__file__)
 thermo_parser_path = os.path.join(current_dir, 'ThermoRawFileParser\ThermoRawFileParser.exe')
 out_dir = os.path.join(current_dir, 'mzml_temp')
 
-def _raw_to_mzml(file_path):
+def thermo_parser_command(file_path, output_dir):
+    """Default converter, returns the ThermoRawFileParser command writing an indexed mzml into output_dir."""
+    return [thermo_parser_path, '-i={input}'.format(input=file_path), '-o={output}'.format(output=output_dir), '-L=1-', '-l=2', '-f=2']
 
-    command = '{converter} -i={input} -o={output} -L=1- -l=2 -f=2'.format(converter=thermo_parser_path, input=file_path, output=out_dir)
-    conversion_log = subprocess.run(command, capture_output=True)
-    
-    return conversion_log
+def thermo_parser_stream_command(file_path):
+    """Default streaming converter, ThermoRawFileParser writing a (non indexed) mzml to stdout."""
+    return [thermo_parser_path, '-i={input}'.format(input=file_path), '--stdout', '-L=1-', '-l=2', '-f=1']
+
+def _raw_to_mzml(file_path, converter=thermo_parser_command, output_root=out_dir, timeout=None, retries=0):
+    """Convert one raw file into its own temporary directory and return the mzml path.
+
+    converter(file_path, output_dir) returns the command to run, so tests can substitute a stand-in script.
+    Failed or timed out conversions are retried, a RuntimeError is raised once the retries are used up.
+    """
+
+    mzml_name = os.path.splitext(os.path.basename(file_path))[0] + '.mzML'
+    os.makedirs(output_root, exist_ok=True)
+    errors = []
+
+    for attempt in range(retries + 1):
+        output_dir = tempfile.mkdtemp(prefix='conversion_', dir=output_root)
+        mzml_file_path = os.path.join(output_dir, mzml_name)
+
+        try:
+            conversion_log = subprocess.run(converter(file_path, output_dir), capture_output=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            errors.append('timed out after {timeout} s'.format(timeout=timeout))
+            shutil.rmtree(output_dir, ignore_errors=True)
+            continue
+
+        if conversion_log.returncode == 0 and os.path.isfile(mzml_file_path):
+            return mzml_file_path
+
+        errors.append('exit code {code}: {stderr}'.format(code=conversion_log.returncode, stderr=conversion_log.stderr.decode(errors='replace').strip()))
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    raise RuntimeError('Conversion of {file} failed ({errors})'.format(file=os.path.basename(file_path), errors='; '.join(errors)))
+
+async def _raw_to_mzml_async(file_path, converter=thermo_parser_command, output_root=out_dir, timeout=None, retries=0):
+    """_raw_to_mzml as an asyncio subprocess, so conversions overlap with other pipeline stages. The converter is killed on cancellation."""
+
+    mzml_name = os.path.splitext(os.path.basename(file_path))[0] + '.mzML'
+    os.makedirs(output_root, exist_ok=True)
+    errors = []
+
+    for attempt in range(retries + 1):
+        output_dir = tempfile.mkdtemp(prefix='conversion_', dir=output_root)
+        mzml_file_path = os.path.join(output_dir, mzml_name)
+
+        process = await asyncio.create_subprocess_exec(*converter(file_path, output_dir), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            errors.append('timed out after {timeout} s'.format(timeout=timeout))
+            shutil.rmtree(output_dir, ignore_errors=True)
+            continue
+        except asyncio.CancelledError:
+            #the converter may still write into output_dir until it has exited
+            process.kill()
+            try:
+                await asyncio.shield(process.wait())
+            finally:
+                shutil.rmtree(output_dir, ignore_errors=True)
+            raise
+
+        if process.returncode == 0 and os.path.isfile(mzml_file_path):
+            return mzml_file_path
+
+        errors.append('exit code {code}: {stderr}'.format(code=process.returncode, stderr=stderr.decode(errors='replace').strip()))
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    raise RuntimeError('Conversion of {file} failed ({errors})'.format(file=os.path.basename(file_path), errors='; '.join(errors)))
+
+def _raw_to_mzml_stream(file_path, consumer, stream_converter=thermo_parser_stream_command, timeout=None, retries=0):
+    """Run the converter with its mzml on stdout and return consumer(file_path, stream), no temporary file is written.
+
+    The converter is killed when it runs longer than timeout. Failed conversions are retried, a RuntimeError
+    is raised once the retries are used up.
+    """
+
+    errors = []
+
+    for attempt in range(retries + 1):
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(stream_converter(file_path), stdout=subprocess.PIPE, stderr=stderr_file)
+            timed_out = threading.Event()
+            timer = None
+            if timeout is not None:
+                timer = threading.Timer(timeout, lambda: (timed_out.set(), process.kill()))
+                timer.start()
+
+            try:
+                result = consumer(file_path, process.stdout)
+                consumer_error = None
+            except Exception as error:
+                result = None
+                consumer_error = error
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+                if timer is not None:
+                    timer.cancel()
+
+            if returncode == 0 and consumer_error is None:
+                return result
+
+            stderr_file.seek(0)
+            if timed_out.is_set():
+                errors.append('timed out after {timeout} s'.format(timeout=timeout))
+            else:
+                errors.append('exit code {code}: {error}'.format(code=returncode, error=consumer_error or stderr_file.read().decode(errors='replace').strip()))
+
+    raise RuntimeError('Streaming conversion of {file} failed ({errors})'.format(file=os.path.basename(file_path), errors='; '.join(errors)))
+
+def _remove_mzml(mzml_file_path):
+    """Delete a converted mzml together with its temporary directory."""
+    shutil.rmtree(os.path.dirname(mzml_file_path), ignore_errors=True)
+
+class ConversionPool():
+    """Bounded pool of background conversions, so raw files ahead in the queue convert while the current one is analyzed.
+
+    Results are mzml paths. With a stream_consumer, the converter output is piped into 
+    stream_consumer(file_path, stream) instead and results are whatever the consumer returns. 
+    Streams that fail fall back to a temporary mzml file handed to the same consumer.
+    """
+
+    def __init__(self, workers=1, converter=thermo_parser_command, output_root=out_dir, timeout=None, retries=1,
+                 stream_consumer=None, stream_converter=thermo_parser_stream_command):
+        self.workers = workers
+        self.converter = converter
+        self.output_root = output_root
+        self.timeout = timeout
+        self.retries = retries
+        self.stream_consumer = stream_consumer
+        self.stream_converter = stream_converter
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _convert(self, file_path):
+
+        if self.stream_consumer is None:
+            return _raw_to_mzml(file_path, converter=self.converter, output_root=self.output_root, timeout=self.timeout, retries=self.retries)
+
+        try:
+            return _raw_to_mzml_stream(file_path, self.stream_consumer, stream_converter=self.stream_converter, timeout=self.timeout, retries=self.retries)
+        except RuntimeError:
+            mzml_file_path = _raw_to_mzml(file_path, converter=self.converter, output_root=self.output_root, timeout=self.timeout, retries=self.retries)
+            try:
+                with open(mzml_file_path, 'rb') as mzml_file:
+                    return self.stream_consumer(file_path, mzml_file)
+            finally:
+                _remove_mzml(mzml_file_path)
+
+    def submit(self, file_path):
+        if file_path not in self.pending:
+            self.pending[file_path] = self.executor.submit(self._convert, file_path)
+        return self.pending[file_path]
+
+    def prefetch(self, file_paths):
+        """Queue conversions ahead of time, never more than one waiting job per worker."""
+        for file_path in file_paths:
+            if len(self.pending) >= self.workers * 2:
+                break
+            self.submit(file_path)
+
+    def get_result(self, file_path):
+        """Wait for (or start) the conversion of file_path and return its mzml path (or consumer result)."""
+        future = self.submit(file_path)
+        try:
+            return future.result()
+        finally:
+            self.pending.pop(file_path, None)
+
+    async def convert_async(self, file_path):
+        """Convert file_path with the settings of the pool as an asyncio subprocess, the caller bounds the concurrent conversions."""
+        return await _raw_to_mzml_async(file_path, converter=self.converter, output_root=self.output_root, timeout=self.timeout, retries=self.retries)
+
+    def shutdown(self):
+        """Cancel queued conversions and delete the output of the ones that already finished."""
+        for future in self.pending.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        if self.stream_consumer is None:
+            for future in self.pending.values():
+                if not future.cancelled() and future.exception() is None:
+                    _remove_mzml(future.result())
+        self.pending = {}
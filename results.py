@@ -0,0 +1,263 @@
+#typed column buffers for analysis results and the binary store they are flushed to, one directory of .npz parts per table
+
+import os
+import json
+import time
+import shutil
+import numpy as np
+import pandas as pd
+
+def _get_block_size(block):
+    for values in block.values():
+        if isinstance(values, np.ndarray):
+            return len(values)
+    return 1
+
+def _get_values_dtype(values):
+    if isinstance(values, np.ndarray):
+        return np.dtype(object) if values.dtype.kind in 'US' else values.dtype
+    if isinstance(values, (bool, int, float, np.number, np.bool_)):
+        return np.asarray(values).dtype
+    return np.dtype(object)
+
+class ResultTable():
+    """Growable typed column arrays of one result table.
+
+    A block is a dict of column name to an array, or to one value shared by every row of the block (a block without
+    arrays is one row). Columns take the dtype of their first block, strings and other python objects are stored as
+    objects, and are promoted if a later block needs it.
+    """
+
+    def __init__(self, columns, capacity=1024):
+        self.columns = columns
+        self.capacity = capacity
+        self.arrays = {}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def _reserve(self, n_rows):
+        if n_rows <= self.capacity:
+            return
+
+        self.capacity = max(n_rows, self.capacity * 2)
+        for column, array in self.arrays.items():
+            grown_array = np.empty(self.capacity, dtype=array.dtype)
+            grown_array[:self.n_rows] = array[:self.n_rows]
+            self.arrays[column] = grown_array
+
+    def append(self, block):
+        block_size = _get_block_size(block)
+        if block_size == 0:
+            return
+
+        self._reserve(self.n_rows + block_size)
+        start, end = self.n_rows, self.n_rows + block_size
+
+        for column in self.columns:
+            values = block[column]
+            dtype = _get_values_dtype(values)
+
+            array = self.arrays.get(column)
+            if array is None:
+                array = np.empty(self.capacity, dtype=dtype)
+            elif np.result_type(array.dtype, dtype) != array.dtype:
+                array = array.astype(np.result_type(array.dtype, dtype))
+            self.arrays[column] = array
+
+            if isinstance(values, np.ndarray) or array.dtype != object:
+                array[start:end] = values
+            else:
+                #python objects like the tic tuples are not broadcast by numpy
+                for row in range(start, end):
+                    array[row] = values
+
+        self.n_rows = end
+
+    def get_columns(self):
+        return {column:self.arrays[column][:self.n_rows] for column in self.columns}
+
+    def to_frame(self):
+        return pd.DataFrame(self.get_columns())
+
+    def clear(self):
+        """Drop the rows but keep the arrays, object references are released."""
+
+        for array in self.arrays.values():
+            if array.dtype == object:
+                array[:self.n_rows] = None
+        self.n_rows = 0
+
+#part names sort in write order, merged parts record the first part they replace
+_last_part_id = 0
+
+def _get_part_name():
+    global _last_part_id
+    _last_part_id = max(time.time_ns(), _last_part_id + 1)
+    return 'part_{part_id:020d}.npz'.format(part_id=_last_part_id)
+
+def _is_ragged_column(values):
+    return values.dtype == object and len(values) > 0 and isinstance(values[0], (tuple, list, np.ndarray))
+
+def _get_part_arrays(columns):
+    """Column arrays as stored: strings as unicode arrays, other objects as floats and ragged columns (e.g. tic traces)
+    as float32 values and offsets."""
+
+    part_arrays = {}
+    for column, values in columns.items():
+        values = np.asarray(values)
+
+        if _is_ragged_column(values):
+            traces = [np.asarray(value, dtype=np.float32) for value in values]
+            part_arrays[column] = np.concatenate(traces, axis=-1)
+            part_arrays[column + '.offsets'] = np.concatenate([[0], np.cumsum([trace.shape[-1] for trace in traces], dtype=np.int64)])
+        elif values.dtype == object and not any(isinstance(value, str) for value in values):
+            part_arrays[column] = values.astype(np.float64)
+        elif values.dtype == object:
+            #missing strings are stored as a mask
+            is_missing = pd.isna(values)
+            part_arrays[column] = np.where(is_missing, '', values).astype(str)
+            if is_missing.any():
+                part_arrays[column + '.isna'] = is_missing
+        else:
+            part_arrays[column] = values
+
+    return part_arrays
+
+def initialize_table(table_dir, columns):
+    shutil.rmtree(table_dir, ignore_errors=True)
+    os.makedirs(table_dir)
+
+    with open(os.path.join(table_dir, 'columns.json'), 'w') as fh:
+        json.dump(columns, fh)
+
+def get_table_columns(table_dir):
+    """Columns of the table in table_dir, None if there is no table."""
+
+    try:
+        with open(os.path.join(table_dir, 'columns.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+def write_table_part(table_dir, columns, first_part=None):
+    """Write {column:values} as a new part. The part only becomes visible once it is complete.
+
+    A part written with first_part replaces that part and every later one, e.g. when parts are merged.
+    """
+
+    part_name = _get_part_name()
+    part_arrays = _get_part_arrays(columns)
+    part_arrays['.first_part'] = np.array(first_part if first_part is not None else part_name)
+
+    part_path = os.path.join(table_dir, part_name)
+    with open(part_path + '.tmp', 'wb') as fh:
+        np.savez(fh, **part_arrays)
+    os.replace(part_path + '.tmp', part_path)
+
+    return part_name
+
+def _get_live_part_names(table_dir):
+    """Parts in write order without those replaced by a later merged part, and the replaced parts."""
+
+    part_names = sorted(name for name in os.listdir(table_dir) if name.startswith('part_') and name.endswith('.npz'))
+
+    live_parts = []
+    replaced_parts = []
+    first_live_part = None
+    for part_name in reversed(part_names):
+        if first_live_part is not None and part_name >= first_live_part:
+            replaced_parts.append(part_name)
+            continue
+
+        with np.load(os.path.join(table_dir, part_name)) as part_file:
+            first_part = str(part_file['.first_part'])
+        live_parts.append(part_name)
+        first_live_part = min(first_live_part or part_name, first_part)
+
+    return live_parts[::-1], replaced_parts
+
+def _load_part(table_dir, part_name):
+    with np.load(os.path.join(table_dir, part_name)) as part_file:
+        return {name:part_file[name] for name in part_file.files}
+
+def _get_part_column(part, column):
+    values = part[column]
+    if column + '.isna' in part:
+        values = values.astype(object)
+        values[part[column + '.isna']] = np.nan
+    return values
+
+def _concatenate_column(arrays):
+    #parts without rows do not decide the dtype
+    arrays = [array for array in arrays if len(array) > 0] or arrays[:1]
+    if len(set(array.dtype.kind for array in arrays)) > 1:
+        arrays = [array.astype(object) for array in arrays]
+    return np.concatenate(arrays)
+
+def _concatenate_ragged_column(parts, column):
+    parts = [part for part in parts if column + '.offsets' in part]
+    values = np.concatenate([part[column] for part in parts], axis=-1)
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for part in parts:
+        offsets.append(part[column + '.offsets'][1:] + offsets[-1][-1])
+    offsets = np.concatenate(offsets)
+
+    traces = np.empty(len(offsets) - 1, dtype=object)
+    for row, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        traces[row] = values[..., start:end]
+
+    return traces
+
+def read_table(table_dir):
+    """DataFrame of every row of the table, ragged columns hold one float32 array per row.
+
+    Reading does not change the table, so exports and queries can read while results are written.
+    """
+
+    columns = get_table_columns(table_dir)
+    while True:
+        try:
+            parts = [_load_part(table_dir, part_name) for part_name in _get_live_part_names(table_dir)[0]]
+            break
+        except FileNotFoundError:
+            #the parts were merged while listing them
+            continue
+
+    table_columns = {}
+    for column in columns:
+        if len(parts) == 0:
+            table_columns[column] = np.array([], dtype=object)
+        elif any(column + '.offsets' in part for part in parts):
+            table_columns[column] = _concatenate_ragged_column(parts, column)
+        else:
+            values = _concatenate_column([_get_part_column(part, column) for part in parts])
+            table_columns[column] = values.astype(object) if values.dtype.kind == 'U' else values
+
+    return pd.DataFrame(table_columns, columns=columns)
+
+def _remove_replaced_parts(table_dir):
+    for part_name in _get_live_part_names(table_dir)[1]:
+        os.remove(os.path.join(table_dir, part_name))
+
+def rewrite_table(table_dir, table_df, first_part=None):
+    """Replace the rows of the table by table_df."""
+
+    if first_part is None:
+        live_parts = _get_live_part_names(table_dir)[0]
+        first_part = live_parts[0] if len(live_parts) > 0 else None
+
+    columns = {column:table_df[column].to_numpy() for column in table_df.columns}
+    write_table_part(table_dir, columns, first_part=first_part)
+    _remove_replaced_parts(table_dir)
+
+def compact_table(table_dir, max_parts=64):
+    """Delete replaced parts and merge tables with more than max_parts parts into one part, called by the writer."""
+
+    live_parts = _get_live_part_names(table_dir)[0]
+    if len(live_parts) > max_parts:
+        rewrite_table(table_dir, read_table(table_dir), first_part=live_parts[0])
+    else:
+        _remove_replaced_parts(table_dir)
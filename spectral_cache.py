@@ -0,0 +1,152 @@
+#on disk cache of extracted mzml data, keyed by raw file identity so reruns skip conversion and parsing
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import extract_mzml_data as exdata
+
+def _get_cache_key(raw_file_path, extraction_params):
+    """Hash of the raw file path, size, mtime and the extraction parameters the cached arrays depend on."""
+
+    raw_stat = os.stat(raw_file_path)
+    key_fields = [os.path.abspath(raw_file_path), raw_stat.st_size, raw_stat.st_mtime_ns, sorted(extraction_params.items())]
+
+    return hashlib.sha1(repr(key_fields).encode()).hexdigest()
+
+def _get_extraction_params(ms2_diagnostic=None, tolerance=0.02, targets=None):
+    """Parameters that change the extracted arrays, targets are reduced to a digest of their window edges.
+
+    tolerance only selects the MS2 spectra of the panel entries (the MS1 target windows already include it),
+    so it is part of the key only with a panel.
+    """
+
+    #cached ms2 spectra are stored per panel entry in panel order, so the key keeps that order
+    panel_entries = None
+    if ms2_diagnostic is not None:
+        panel_entries = [(polarity, [(entry['name'], entry['pmz']) for entry in ms2_diagnostic[polarity]]) for polarity in sorted(ms2_diagnostic)]
+
+    params = {'panel_entries':panel_entries, 'targets':None}
+    if panel_entries is not None:
+        params['ms2_tolerance'] = tolerance
+    targets = exdata._get_nonempty_targets(targets)
+    if targets is not None:
+        target_edges = np.concatenate([np.asarray(targets[polarity], dtype=float) for polarity in sorted(targets)])
+        params['targets'] = hashlib.sha1(repr(sorted(targets)).encode() + target_edges.tobytes()).hexdigest()
+
+    return params
+
+def _get_entry_size(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+def load_cached_data(cache_dir, cache_key):
+    """Return (ms1_data, ms1_tic, ms2_data) backed by memory-mapped .npy files, None on a cache miss.
+
+    ms2_data is a list of spectra per MS2 panel entry.
+    """
+
+    #entries evicted by concurrent workers while they are loaded are cache misses as well
+    try:
+        return _load_cached_entry(os.path.join(cache_dir, cache_key))
+    except FileNotFoundError:
+        return None
+
+def _load_cached_entry(entry_dir):
+    meta_path = os.path.join(entry_dir, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return None
+
+    with open(meta_path) as fh:
+        meta = json.load(fh)
+
+    def load(name):
+        return np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r')
+
+    ms1_data = exdata._ms1_data_from_arrays(load('scan_rts'), load('offsets'), load('mzs'), load('intensities'), load('scan_polarities'))
+    ms1_tic = (load('tic').tolist(), load('tic_rts').tolist())
+
+    ms2_data = None
+    if meta['has_ms2']:
+        ms2_offsets = load('ms2_offsets')
+        ms2_mzs = load('ms2_mzs')
+        ms2_is = load('ms2_is')
+        ms2_spectra = [np.array([ms2_mzs[start:end], ms2_is[start:end]]) for start, end in zip(ms2_offsets[:-1], ms2_offsets[1:])]
+
+        #entries written before MS2 panels hold the spectra of a single precursor
+        ms2_entry_offsets = [0, len(ms2_spectra)]
+        if os.path.isfile(os.path.join(entry_dir, 'ms2_entry_offsets.npy')):
+            ms2_entry_offsets = load('ms2_entry_offsets')
+        ms2_data = [ms2_spectra[start:end] for start, end in zip(ms2_entry_offsets[:-1], ms2_entry_offsets[1:])]
+
+    #last access time drives the lru eviction
+    os.utime(meta_path)
+
+    return ms1_data, ms1_tic, ms2_data
+
+def store_cached_data(cache_dir, cache_key, ms1_data, ms1_tic, ms2_data, max_size_gb=None):
+    """Write the extracted data as .npy files. The entry only becomes visible once it is complete."""
+
+    entry_dir = os.path.join(cache_dir, cache_key)
+    temp_dir = entry_dir + '.tmp{pid}'.format(pid=os.getpid())
+    os.makedirs(temp_dir, exist_ok=True)
+
+    def save(name, array):
+        np.save(os.path.join(temp_dir, name + '.npy'), np.ascontiguousarray(array))
+
+    save('scan_rts', ms1_data.scan_rts[:ms1_data.n_scans])
+    save('scan_polarities', ms1_data.scan_polarities[:ms1_data.n_scans])
+    save('offsets', ms1_data.offsets[:ms1_data.n_scans + 1])
+    save('mzs', ms1_data.mzs[:ms1_data.n_peaks])
+    save('intensities', ms1_data.intensities[:ms1_data.n_peaks])
+    save('tic', np.asarray(ms1_tic[0], dtype=np.float64))
+    save('tic_rts', np.asarray(ms1_tic[1], dtype=np.float64))
+
+    if ms2_data is not None:
+        ms2_spectra = [spec for entry_spectra in ms2_data for spec in entry_spectra]
+        save('ms2_entry_offsets', np.concatenate([[0], np.cumsum([len(entry_spectra) for entry_spectra in ms2_data], dtype=np.int64)]))
+        save('ms2_offsets', np.concatenate([[0], np.cumsum([spec.shape[1] for spec in ms2_spectra], dtype=np.int64)]))
+        save('ms2_mzs', np.concatenate([spec[0] for spec in ms2_spectra]) if len(ms2_spectra) > 0 else np.array([]))
+        save('ms2_is', np.concatenate([spec[1] for spec in ms2_spectra]) if len(ms2_spectra) > 0 else np.array([]))
+
+    with open(os.path.join(temp_dir, 'meta.json'), 'w') as fh:
+        json.dump({'has_ms2':ms2_data is not None, 'created':time.time()}, fh)
+
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(temp_dir)
+    else:
+        os.replace(temp_dir, entry_dir)
+
+    if max_size_gb is not None:
+        evict_cache(cache_dir, max_size_gb)
+
+def evict_cache(cache_dir, max_size_gb, stale_temp_seconds=24 * 3600):
+    """Delete the least recently used entries until the cache fits in max_size_gb.
+
+    Entries still being written are skipped, and those left behind for stale_temp_seconds by a crashed run are deleted.
+    """
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if '.tmp' in entry.name:
+            if entry.is_dir() and time.time() - entry.stat().st_mtime > stale_temp_seconds:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+
+        meta_path = os.path.join(entry.path, 'meta.json')
+        if entry.is_dir() and os.path.isfile(meta_path):
+            #entries evicted by another worker in the meantime are skipped
+            try:
+                entries.append((os.path.getmtime(meta_path), _get_entry_size(entry.path), entry.path))
+            except FileNotFoundError:
+                continue
+
+    cache_size = sum(entry[1] for entry in entries)
+    max_size = max_size_gb * 1024**3
+
+    for last_access, entry_size, entry_path in sorted(entries):
+        if cache_size <= max_size:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        cache_size -= entry_size
@@ -0,0 +1,138 @@
+#sqlite result store in WAL mode, readers like exports and dashboards can query tables while files are inserted
+
+import io
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+#ragged columns (e.g. tic traces) are stored as .npy blobs
+_trace_type = 'TRACE'
+
+def _connect(db_path):
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+def _quote(name):
+    return '"{name}"'.format(name=name.replace('"', '""'))
+
+def _encode_trace(value):
+    if value is None:
+        return None
+    trace_bytes = io.BytesIO()
+    np.save(trace_bytes, np.asarray(value, dtype=np.float32))
+    return trace_bytes.getvalue()
+
+def _decode_trace(value):
+    if value is None:
+        return None
+    return np.load(io.BytesIO(value))
+
+def _get_trace_columns(connection, table):
+    return [row[1] for row in connection.execute('PRAGMA table_info({table})'.format(table=_quote(table))) if row[2] == _trace_type]
+
+def get_db_columns(db_path, table):
+    """Columns of table in the database, None if there is no such table."""
+
+    if not os.path.isfile(db_path):
+        return None
+
+    connection = _connect(db_path)
+    try:
+        columns = [row[1] for row in connection.execute('PRAGMA table_info({table})'.format(table=_quote(table)))]
+    finally:
+        connection.close()
+
+    return columns or None
+
+def initialize_db(db_path, tables, indexes=None, trace_columns=()):
+    """(Re)create the {table:columns} tables with the {table:[index columns]} indexes.
+
+    Tables are dropped and recreated instead of deleting the file, so connected readers see the new tables.
+    """
+
+    indexes = indexes or {}
+    connection = _connect(db_path)
+    try:
+        with connection:
+            for table, columns in tables.items():
+                connection.execute('DROP TABLE IF EXISTS {table}'.format(table=_quote(table)))
+                column_defs = [_quote(column) + (' ' + _trace_type if column in trace_columns else '') for column in columns]
+                connection.execute('CREATE TABLE {table} ({columns})'.format(table=_quote(table), columns=', '.join(column_defs)))
+
+                for index_columns in indexes.get(table, []):
+                    index_name = _quote('{table}_{columns}'.format(table=table, columns='_'.join(index_columns)))
+                    connection.execute('CREATE INDEX {index} ON {table} ({columns})'.format(index=index_name, table=_quote(table),
+                                                                                              columns=', '.join(_quote(column) for column in index_columns)))
+    finally:
+        connection.close()
+
+def _get_column_values(values, is_trace):
+    if is_trace:
+        return [_encode_trace(value) for value in values]
+    #numpy scalars are not sqlite types, NaN is stored as NULL
+    return np.asarray(values).tolist()
+
+def insert_rows(db_path, table_columns):
+    """Insert {table:{column:values}} in one transaction, e.g. the rows of one flushed file."""
+
+    connection = _connect(db_path)
+    try:
+        with connection:
+            for table, columns in table_columns.items():
+                trace_columns = _get_trace_columns(connection, table)
+                column_values = [_get_column_values(values, column in trace_columns) for column, values in columns.items()]
+
+                connection.executemany('INSERT INTO {table} ({columns}) VALUES ({values})'.format(table=_quote(table),
+                                                                                                  columns=', '.join(_quote(column) for column in columns),
+                                                                                                  values=', '.join('?' * len(columns))),
+                                       zip(*column_values))
+    finally:
+        connection.close()
+
+def query_table(db_path, table, **filters):
+    """DataFrame of the rows of table in insert order, filters are column=value or column=[values], e.g.
+    query_table(db_path, 'ms1_peak_data', compound_name='caffeine', polarity='POS').
+    """
+
+    conditions = []
+    params = []
+    for column, values in filters.items():
+        values = list(values) if isinstance(values, (list, tuple, set, np.ndarray, pd.Series)) else [values]
+        conditions.append('{column} IN ({values})'.format(column=_quote(column), values=', '.join('?' * len(values))))
+        params.extend(values)
+
+    query = 'SELECT * FROM {table}'.format(table=_quote(table))
+    if len(conditions) > 0:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY rowid'
+
+    connection = _connect(db_path)
+    try:
+        table_df = pd.read_sql_query(query, connection, params=params)
+        for column in _get_trace_columns(connection, table):
+            table_df[column] = table_df[column].map(_decode_trace).astype(object)
+    finally:
+        connection.close()
+
+    return table_df
+
+def delete_rows(db_path, table, column, values):
+    """Delete the rows of table whose column is one of values."""
+
+    connection = _connect(db_path)
+    try:
+        with connection:
+            connection.executemany('DELETE FROM {table} WHERE {column} = ?'.format(table=_quote(table), column=_quote(column)),
+                                   [(value,) for value in values])
+    finally:
+        connection.close()
+
+def get_distinct_values(db_path, table, column):
+    connection = _connect(db_path)
+    try:
+        return [row[0] for row in connection.execute('SELECT DISTINCT {column} FROM {table}'.format(table=_quote(table), column=_quote(column)))]
+    finally:
+        connection.close()
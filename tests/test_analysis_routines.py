@@ -3,8 +3,20 @@ import numpy as np
 import pandas as pd
 import os
 import pytest
-from analysis_routines import initialize_data_storage, _store_data, read_data_storage, close_data_storage, _collect_ms1_peak_data
+from results import initialize_table, get_table_columns, read_table
+from analysis_routines import initialize_data_storage, _store_data, read_data_storage, close_data_storage, _collect_ms1_peak_data, load_run_state, save_run_state, resume_data_storage, _is_batch_complete, load_ms2_panel, ResultWriter, query_data_storage, \
+                              _update_data_sheet, _get_rows_digest, _get_exported_rows, _get_redraw_keys, export_tables_plots, \
+                              _replace_dir, recover_qc_output_dirs, _get_qc_output_dir
+import argparse
 import sys
+import time
+import plots
+import spectral_cache
+import analysis_routines
+from dataset import RawDataset
+from extract_mzml_data import MS1Data
+from raw_to_mzml import ConversionPool
+from test_extract_mzml_data import _write_test_indexed_mzml
 
 
 # Initialize data storage Tests
@@ -13,11 +25,11 @@ def test_file_creation(request):
     rootdir = request.config.rootdir
     initialize_data_storage(rootdir)
 
-   # Check if the CSV files were created
+   # Check if the store tables were created
     
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_peak_data.csv'))
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_tic_data.csv'))
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms2_peak_data.csv'))
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_peak_data/columns.json'))
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_tic_data/columns.json'))
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms2_peak_data/columns.json'))
 
 
 def test_column_names(request):
@@ -44,16 +56,16 @@ def test_column_names(request):
                     'run_num',
                     'file_category',
                     'polarity',
+                    'precursor_name',
+                    'precursor_mz',
                     'theoretical_mz', 
                     'observed_mz',
                     'ppm_error',
                     'observed_intensity']
 
     
-    # Read the CSV files and check column names
-    ms1_peak_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms1_peak_data.csv'))
-    ms1_tic_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms1_tic_data.csv'))
-    ms2_peak_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms2_peak_data.csv'))
+    # Read the store tables and check column names
+    ms1_peak_df, ms1_tic_df, ms2_peak_df = read_data_storage(rootdir)
 
     assert list(ms1_peak_df.columns) == ms1_peak_cols
     assert list(ms1_tic_df.columns) == ms1_tic_cols
@@ -67,21 +79,23 @@ def test_file_creation_and_appending(request):
     rootdir = request.config.rootdir
     # Sample data
     #higher_dir = os.path.dirname(rootdir)
-    experiment_ms1_peak_data = [{'col1': 1, 'col2': 'A'}, {'col1': 2, 'col2': 'B'}]
-    experiment_ms1_tic_data = [{'col1': 3, 'col2': 'C'}, {'col1': 4, 'col2': 'D'}]
-    experiment_ms2_peak_data = [{'col1': 5, 'col2': 'E'}, {'col1': 6, 'col2': 'F'}]
+    experiment_ms1_peak_data = [{'run_num': 1, 'file_name': 'A'}, {'run_num': 2, 'file_name': 'B'}]
+    experiment_ms1_tic_data = [{'run_num': 3, 'file_name': 'C', 'ms1_tic': ([1.0, 2.0], [0.1, 0.2])}, {'run_num': 4, 'file_name': 'D', 'ms1_tic': ([3.0], [0.3])}]
+    experiment_ms2_peak_data = [{'run_num': 5, 'file_name': 'E'}, {'run_num': 6, 'file_name': 'F'}]
 
  
     _store_data(experiment_ms1_peak_data, experiment_ms1_tic_data, experiment_ms2_peak_data, rootdir)
 
-    # Check if the CSV files were created and contain the correct data
-    ms1_peak_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms1_peak_data.csv'))
-    ms1_tic_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms1_tic_data.csv'))
-    ms2_df = pd.read_csv(os.path.join(rootdir, 'data_store/ms2_peak_data.csv'))
+    # Check if the store tables contain the correct data
+    ms1_peak_df, ms1_tic_df, ms2_df = read_data_storage(rootdir)
 
     assert not ms1_peak_df.empty
     assert not ms1_tic_df.empty
     assert not ms2_df.empty
+    assert ms1_peak_df['run_num'].tolist()[-2:] == [1, 2]
+    assert ms2_df['file_name'].tolist()[-2:] == ['E', 'F']
+    assert ms1_tic_df['ms1_tic'].iloc[-1].dtype == np.float32
+    assert np.array_equal(ms1_tic_df['ms1_tic'].iloc[-2], np.array([[1.0, 2.0], [0.1, 0.2]], dtype=np.float32))
 
 
 def test_handling_empty_data(request):
@@ -89,10 +103,10 @@ def test_handling_empty_data(request):
     rootdir = request.config.rootdir
     _store_data([], [], [], rootdir)
 
-    # Check if the CSV files were created 
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_peak_data.csv'))
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_tic_data.csv'))
-    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms2_peak_data.csv'))
+    # Check if the store tables were created 
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_peak_data/columns.json'))
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms1_tic_data/columns.json'))
+    assert os.path.isfile(os.path.join(rootdir, 'data_store/ms2_peak_data/columns.json'))
 
 # Test Read data storage
 
@@ -102,9 +116,9 @@ def test_read_data_storage(request):
 
     ms1_df, ms1_tic_df, ms2_df = read_data_storage(rootdir)
 
-    assert ms1_df.equals(pd.read_csv(os.path.join(rootdir, 'data_store/ms1_peak_data.csv')))
-    assert ms1_tic_df.equals(pd.read_csv(os.path.join(rootdir, 'data_store/ms1_tic_data.csv')))
-    assert ms2_df.equals(pd.read_csv(os.path.join(rootdir, 'data_store/ms2_peak_data.csv')))
+    assert ms1_df.equals(read_table(os.path.join(rootdir, 'data_store/ms1_peak_data')))
+    assert list(ms1_tic_df.columns) == get_table_columns(os.path.join(rootdir, 'data_store/ms1_tic_data'))
+    assert ms2_df.equals(read_table(os.path.join(rootdir, 'data_store/ms2_peak_data')))
 
 #Test close data storage
     
@@ -114,9 +128,366 @@ def test_close_data_storage(request):
     
     close_data_storage(rootdir)
 
-    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms1_peak_data.csv'))
-    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms1_tic_data.csv'))
-    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms2_peak_data.csv'))
+    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms1_peak_data'))
+    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms1_tic_data'))
+    assert not os.path.exists(os.path.join(rootdir, 'data_store/ms2_peak_data'))
+
+#Test run state checkpoints
+
+class _CheckpointedDataset():
+    def __init__(self, path, analyzed_files):
+        self.path = path
+        self.analyzed_files = analyzed_files
+        self.analyzed_stats = {os.path.basename(file):[1, 2] for file in analyzed_files}
+
+def test_run_state(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    dataset = _CheckpointedDataset(os.path.join(tmp_path, 'experiment'), [os.path.join(tmp_path, 'experiment', 'file_1.raw')])
+
+    assert load_run_state(tmp_path, dataset.path) == {}
+
+    save_run_state(tmp_path, dataset)
+
+    assert load_run_state(tmp_path, dataset.path) == {'file_1.raw':[1, 2]}
+    assert load_run_state(tmp_path, os.path.join(tmp_path, 'other_experiment')) == {}
+
+    initialize_data_storage(tmp_path, resume=False)
+    assert load_run_state(tmp_path, dataset.path) == {}
+
+def test_resume_data_storage(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    initialize_data_storage(tmp_path)
+    _store_data([{'file_name':'file_1'}, {'file_name':'file_2'}], [{'file_name':'file_2'}], [], tmp_path)
+
+    dataset = _CheckpointedDataset(os.path.join(tmp_path, 'experiment'), [os.path.join(tmp_path, 'experiment', 'file_1.raw')])
+    save_run_state(tmp_path, dataset)
+    initialize_data_storage(tmp_path, resume=True)
+    resume_data_storage(tmp_path, dataset)
+
+    ms1_df, ms1_tic_df, ms2_df = read_data_storage(tmp_path)
+
+    assert ms1_df['file_name'].tolist() == ['file_1']
+    assert ms1_tic_df.empty
+    assert query_data_storage(tmp_path, 'ms1_peak_data', file_name=['file_1', 'file_3'])['file_name'].tolist() == ['file_1']
+    assert load_run_state(tmp_path, dataset.path) == {'file_1.raw':[1, 2]}
+
+def test_resume_sqlite_data_storage(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    initialize_data_storage(tmp_path, store='sqlite')
+    _store_data([{'file_name':'file_1', 'compound_name':'a'}, {'file_name':'file_2', 'compound_name':'a'}], [{'file_name':'file_2'}], [], tmp_path, store='sqlite')
+
+    dataset = _CheckpointedDataset(os.path.join(tmp_path, 'experiment'), [os.path.join(tmp_path, 'experiment', 'file_1.raw')])
+    save_run_state(tmp_path, dataset)
+    assert initialize_data_storage(tmp_path, resume=True, store='sqlite')
+    resume_data_storage(tmp_path, dataset, store='sqlite')
+
+    ms1_df, ms1_tic_df, ms2_df = read_data_storage(tmp_path, store='sqlite')
+
+    assert ms1_df['file_name'].tolist() == ['file_1']
+    assert ms1_tic_df.empty
+    assert query_data_storage(tmp_path, 'ms1_peak_data', store='sqlite', compound_name='a')['file_name'].tolist() == ['file_1']
+
+def test_resume_starts_over_with_other_store_columns(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    initialize_data_storage(tmp_path)
+    initialize_table(os.path.join(tmp_path, 'data_store/ms2_peak_data'), ['file_name', 'theoretical_mz'])
+
+    assert not initialize_data_storage(tmp_path, resume=True)
+    assert initialize_data_storage(tmp_path, resume=True)
+
+#Test buffered result writing
+
+def test_result_writer_flushes_every_n_rows(tmp_path):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    initialize_data_storage(tmp_path)
+    result_writer = ResultWriter(tmp_path, flush_rows=5)
+
+    ms1_block = {'file_name':'file_1', 'run_num':1, 'file_category':'S1', 'polarity':'POS', 'compound_name':np.array(['a', 'b'], dtype=object),
+                 'retention_time':np.array([1.0, 2.0]), 'theoretical_mz':np.array([100.0, 200.0]), 'observed_mz':np.array([100.0, 200.0]),
+                 'ppm_error':np.array([0.0, 0.0]), 'observed_intensity':np.array([10.0, 20.0])}
+    tic_block = {'file_name':'file_1', 'run_num':1, 'file_category':'S1', 'polarity':'POS', 'group':'S1', 'ms1_tic':([1.0], [0.5])}
+
+    result_writer.append_file(([ms1_block], [tic_block], []))
+    assert not result_writer.is_due()
+    result_writer.append_file(([dict(ms1_block, file_name='file_2')], [dict(tic_block, file_name='file_2')], []))
+    assert result_writer.is_due()
+
+    assert read_data_storage(tmp_path)[0].empty
+    result_writer.flush()
+
+    ms1_df, ms1_tic_df, ms2_df = read_data_storage(tmp_path)
+    assert ms1_df['file_name'].tolist() == ['file_1', 'file_1', 'file_2', 'file_2']
+    assert ms1_df['observed_intensity'].tolist() == [10.0, 20.0, 10.0, 20.0]
+    assert [tic.tolist() for tic in ms1_tic_df['ms1_tic']] == [[[1.0], [0.5]], [[1.0], [0.5]]]
+    assert ms1_tic_df['ms1_tic'].iloc[0].dtype == np.float32
+    assert ms2_df.empty
+    assert not result_writer.is_due()
+
+#Test incremental export
+
+def test_data_sheet_appends_new_rows(tmp_path):
+    table_df = pd.DataFrame({'file_name':['file_1', 'file_1', 'file_2'], 'run_num':[1, 1, 2], 'polarity':['POS', 'POS', 'NEG'], 'observed_mz':[100.5, np.nan, 200.25]})
+    sheet_path = os.path.join(tmp_path, 'ms1_data_sheet.csv')
+
+    _update_data_sheet(sheet_path, table_df.iloc[:2], 0)
+    _update_data_sheet(sheet_path, table_df, 2)
+
+    table_df.to_csv(os.path.join(tmp_path, 'full_sheet.csv'))
+    assert open(sheet_path).read() == open(os.path.join(tmp_path, 'full_sheet.csv')).read()
+
+def test_exported_rows_start_over_when_stored_rows_change():
+    table_df = pd.DataFrame({'file_name':['file_1', 'file_2'], 'run_num':[1, 2], 'polarity':['POS', 'NEG']})
+    export_state = {'inputs':'atlas', 'tables':{'ms1_peak_data':[2, _get_rows_digest(table_df)]}}
+
+    grown_df = pd.concat([table_df, pd.DataFrame({'file_name':['file_3'], 'run_num':[3], 'polarity':['POS']})], ignore_index=True)
+
+    assert _get_exported_rows(export_state, {'ms1_peak_data':grown_df}, 'atlas') == {'ms1_peak_data':2}
+    assert _get_redraw_keys(grown_df, 'file_name', {'ms1_peak_data':2}, 'ms1_peak_data') == {'file_3'}
+    assert _get_exported_rows(export_state, {'ms1_peak_data':grown_df}, 'other atlas') is None
+    assert _get_exported_rows(export_state, {'ms1_peak_data':grown_df.iloc[[0, 2]]}, 'atlas') is None
+    assert _get_exported_rows(None, {'ms1_peak_data':grown_df}, 'atlas') is None
+
+def test_export_redraws_nothing_when_stored_rows_are_unchanged(tmp_path, monkeypatch):
+    os.mkdir(os.path.join(tmp_path, 'data_store'))
+    initialize_data_storage(tmp_path)
+
+    #files stored out of run_num order, with positive and negative mode rows of one run
+    ms1_peak_data = [{'file_name':file_name, 'run_num':run_num, 'file_category':'S1', 'polarity':polarity, 'compound_name':compound_name,
+                      'retention_time':1.5, 'theoretical_mz':100.0, 'observed_mz':100.0, 'ppm_error':0.0, 'observed_intensity':1e6}
+                     for file_name, run_num in [('file_2', 2), ('file_1', 1), ('file_3', 1)] for polarity in ['POS', 'NEG'] for compound_name in ['a', 'b']]
+    ms1_tic_data = [{'file_name':file_name, 'run_num':run_num, 'file_category':'S1', 'polarity':polarity, 'group':group, 'ms1_tic':([1.0, 2.0], [0.5, 1.0])}
+                    for file_name, run_num, group in [('file_2', 2, 'S1'), ('file_1', 1, 'S2'), ('file_3', 1, 'S1')] for polarity in ['POS', 'NEG']]
+    _store_data(ms1_peak_data, ms1_tic_data, [], tmp_path)
+
+    atlas_df = pd.DataFrame({'compound_name':['a', 'b'], 'intensity_threshold':[1e5, 1e5], 'signal_check':[False, True]})
+    args = argparse.Namespace(directory=os.path.join(tmp_path, 'experiment'), store='npz', plot_workers=1)
+    export_tables_plots(tmp_path, args, pd.DataFrame(), atlas_df, {}, 'full')
+
+    page_caches = []
+    class RecordedPageCache(plots.PageCache):
+        def __init__(self, cache_dir, redraw_keys=None):
+            super().__init__(cache_dir, redraw_keys=redraw_keys)
+            page_caches.append(self)
+
+    monkeypatch.setattr(plots, 'PageCache', RecordedPageCache)
+    export_tables_plots(tmp_path, args, pd.DataFrame(), atlas_df, {}, 'full')
+
+    assert len(page_caches) == 4
+    assert all(page_cache.redraw_keys == set() for page_cache in page_caches)
+
+def test_replace_dir_keeps_output_in_use(tmp_path, monkeypatch):
+    output_dir = str(tmp_path / 'qc_output_latest')
+    new_dir = output_dir + '.new'
+    os.mkdir(output_dir)
+    os.mkdir(new_dir)
+    rename = os.rename
+
+    def deny_rename(source, destination):
+        if source == new_dir:
+            raise PermissionError('file open')
+        rename(source, destination)
+    monkeypatch.setattr(os, 'rename', deny_rename)
+
+    assert not _replace_dir(new_dir, output_dir)
+    assert os.path.isdir(output_dir)
+    assert not os.path.isdir(output_dir + '.old')
+
+    monkeypatch.setattr(os, 'rename', rename)
+    assert _replace_dir(new_dir, output_dir)
+    assert os.path.isdir(output_dir) and not os.path.isdir(new_dir)
+
+def test_recover_qc_output_dirs(tmp_path):
+    output_dir = _get_qc_output_dir(str(tmp_path), 'latest')
+    os.mkdir(output_dir + '.old')
+
+    recover_qc_output_dirs(str(tmp_path))
+    assert os.path.isdir(output_dir)
+    assert not os.path.isdir(output_dir + '.old')
+
+#Test parallel analysis
+
+_test_experiment_files = [('POS', 'MSMS', 'QC'), ('NEG', 'MSMS', 'S1'), ('FPS', 'MS1', 'S2'), ('POS', 'MSMS', 'ExCtrl'), ('NEG', 'MSMS', 'QC'), ('POS', 'MS1', 'S1')]
+
+def _make_test_experiment(experiment_dir, atlas_df, ms2_diagnostic, write_raw_file):
+    """Stand-in raw files with gaussian peaks of every atlas compound, scaled per run, returns their (file_path, scans, ms2_spectra).
+
+    write_raw_file(file_path, scans, ms2_spectra) writes each file, scans are (rt, scan_polarity, mzs, intensities) and
+    ms2_spectra (pmz, polarity, fragment mzs, intensities) per panel entry, None for MS1 files.
+    """
+
+    os.mkdir(experiment_dir)
+    test_files = []
+    for run_num, (polarity, ms_num, group) in enumerate(_test_experiment_files, start=1):
+        file_name = '20210929_JGI-AK-TH_DS_503916_WRFungi_final_QE-HF_C18_USDAY63680_{polarity}_{ms_num}_31-P_{group}_3_Rg80to1200-CE102040-Csubverm-C18QU_Run{run_num}'
+        file_path = os.path.join(experiment_dir, file_name.format(polarity=polarity, ms_num=ms_num, group=group, run_num=run_num) + '.raw')
+
+        scans = []
+        for scan_rt in np.linspace(1.0, 2.0, 21):
+            for scan_polarity in {'POS':['POS'], 'NEG':['NEG'], 'FPS':['POS', 'NEG']}[polarity]:
+                mzs = np.sort(atlas_df[scan_polarity + '_mz'].to_numpy())
+                scans.append((scan_rt, scan_polarity, mzs, 1e6 * run_num * np.exp(-(scan_rt - 1.5)**2 / 0.02) * np.ones(len(mzs))))
+
+        ms2_spectra = None
+        if ms_num == 'MSMS':
+            ms2_spectra = [(entry['pmz'], polarity, entry['diagnostic_ions'], [1e4 * run_num] * len(entry['diagnostic_ions'])) for entry in ms2_diagnostic[polarity]]
+
+        write_raw_file(file_path, scans, ms2_spectra)
+        os.utime(file_path, (time.time() - 3600 + run_num, time.time() - 3600 + run_num))
+        test_files.append((file_path, scans, ms2_spectra))
+
+    return test_files
+
+def _make_cached_experiment(experiment_dir, args, atlas_df, ms2_diagnostic, tolerance=0.0015):
+    """Test experiment whose extracted data is already in the spectral cache, so its files are never converted."""
+
+    def write_raw_file(file_path, scans, ms2_spectra):
+        with open(file_path, 'w') as raw_file:
+            raw_file.write('raw')
+
+    #cache keys include the mtime of the finished raw file
+    for file_path, scans, ms2_spectra in _make_test_experiment(experiment_dir, atlas_df, ms2_diagnostic, write_raw_file):
+        ms1_data = MS1Data()
+        for scan_rt, scan_polarity, mzs, intensities in scans:
+            ms1_data.append_scan(scan_rt, mzs, intensities, polarity=1 if scan_polarity == 'POS' else -1)
+        ms1_data.trim()
+        ms1_tic = ([float(np.sum(intensities)) for _, _, _, intensities in scans], [scan_rt for scan_rt, _, _, _ in scans])
+
+        ms2_data = None
+        if ms2_spectra is not None:
+            ms2_data = [[np.array([fragment_mzs, intensities])] for _, _, fragment_mzs, intensities in ms2_spectra]
+
+        cache_key = analysis_routines._get_cache_key(file_path, args, ms2_diagnostic, tolerance, None)
+        spectral_cache.store_cached_data(args.cache_dir, cache_key, ms1_data, ms1_tic, ms2_data)
+
+def _make_converted_experiment(experiment_dir, atlas_df, ms2_diagnostic):
+    """Test experiment whose raw files hold their mzml, for a stand-in converter that copies them."""
+
+    def write_raw_file(file_path, scans, ms2_spectra):
+        spectra = [(1, None, mzs, intensities, {'polarity':scan_polarity, 'tic':float(np.sum(intensities)), 'rt':scan_rt})
+                   for scan_rt, scan_polarity, mzs, intensities in scans]
+        spectra += [(2, pmz, fragment_mzs, intensities, {'polarity':polarity, 'rt':1.5}) for pmz, polarity, fragment_mzs, intensities in ms2_spectra or []]
+        _write_test_indexed_mzml(file_path, spectra)
+
+    _make_test_experiment(experiment_dir, atlas_df, ms2_diagnostic, write_raw_file)
+
+def _analyze_test_experiment(experiment_dir, current_dir, atlas_df, ms2_diagnostic, args, conversion_pool=None):
+    """Stored tables and run state of one analysis of the test experiment into current_dir."""
+
+    os.makedirs(os.path.join(current_dir, 'data_store'))
+    initialize_data_storage(current_dir)
+
+    dataset = RawDataset(experiment_dir)
+    assert not analysis_routines.analyze_experiment(dataset, atlas_df, ms2_diagnostic, current_dir, args, 0, conversion_pool=conversion_pool)
+
+    return read_data_storage(current_dir), load_run_state(current_dir, experiment_dir)
+
+def _assert_stored_data_equal(stored_data, other_stored_data):
+    for table_df, other_table_df in zip(stored_data, other_stored_data):
+        pd.testing.assert_frame_equal(table_df.drop(columns='ms1_tic', errors='ignore'), other_table_df.drop(columns='ms1_tic', errors='ignore'))
+    for ms1_tic, other_ms1_tic in zip(stored_data[1]['ms1_tic'], other_stored_data[1]['ms1_tic']):
+        assert np.array_equal(ms1_tic, other_ms1_tic)
+
+def _get_test_analysis_args(experiment_dir, **options):
+    args = argparse.Namespace(directory=experiment_dir, num_files=len(_test_experiment_files), min_file_age=0, skip_blanks=True, export_num=None, targeted=False,
+                              mzml_backend='pymzml', cache_dir=None, cache_size=20, convert_workers=1, convert_timeout=None, convert_retries=1, stream=False,
+                              workers=1, pipeline=False, parse_workers=1, max_parsed=2, flush_rows=0, store='npz')
+    for option, value in options.items():
+        setattr(args, option, value)
+    return args
+
+def test_parallel_analysis_equals_sequential(tmp_path, request):
+    atlas_df = pd.read_csv(os.path.join(request.config.rootdir, 'default_atlases', 'default_c18_atlas.csv'))
+    ms2_diagnostic = load_ms2_panel(os.path.join(request.config.rootdir, 'default_atlases', 'default_ms2_panel.csv'))
+    experiment_dir = os.path.join(tmp_path, 'experiment')
+    args = _get_test_analysis_args(experiment_dir, cache_dir=os.path.join(tmp_path, 'cache'))
+    os.mkdir(args.cache_dir)
+    _make_cached_experiment(experiment_dir, args, atlas_df, ms2_diagnostic)
+
+    stored_data, run_state = _analyze_test_experiment(experiment_dir, os.path.join(tmp_path, 'workers_1'), atlas_df, ms2_diagnostic, args)
+    args.workers = 2
+    parallel_stored_data, parallel_run_state = _analyze_test_experiment(experiment_dir, os.path.join(tmp_path, 'workers_2'), atlas_df, ms2_diagnostic, args)
+
+    assert len(run_state) == len(_test_experiment_files) and run_state == parallel_run_state
+    assert not stored_data[2].empty
+    _assert_stored_data_equal(stored_data, parallel_stored_data)
+
+def test_pipeline_analysis_equals_sequential(tmp_path, request, monkeypatch):
+    atlas_df = pd.read_csv(os.path.join(request.config.rootdir, 'default_atlases', 'default_c18_atlas.csv'))
+    ms2_diagnostic = load_ms2_panel(os.path.join(request.config.rootdir, 'default_atlases', 'default_ms2_panel.csv'))
+    experiment_dir = os.path.join(tmp_path, 'experiment')
+    _make_converted_experiment(experiment_dir, atlas_df, ms2_diagnostic)
+    monkeypatch.setattr(analysis_routines, 'check_file_collection_method', lambda file_path: True)
+
+    #stand-in for ThermoRawFileParser that copies the mzml held by the raw file
+    script_path = os.path.join(tmp_path, 'stand_in_converter.py')
+    with open(script_path, 'w') as fh:
+        fh.write('import os, shutil, sys\nshutil.copy(sys.argv[1], os.path.join(sys.argv[2], os.path.basename(sys.argv[1])[:-4] + ".mzML"))\n')
+    def converter(file_path, output_dir):
+        return [sys.executable, script_path, file_path, output_dir]
+    mzml_dir = os.path.join(tmp_path, 'mzml')
+
+    args = _get_test_analysis_args(experiment_dir)
+    conversion_pool = ConversionPool(converter=converter, output_root=mzml_dir)
+    stored_data, run_state = _analyze_test_experiment(experiment_dir, os.path.join(tmp_path, 'sequential'), atlas_df, ms2_diagnostic, args, conversion_pool)
+    conversion_pool.shutdown()
+
+    args = _get_test_analysis_args(experiment_dir, pipeline=True, convert_workers=2, parse_workers=2)
+    conversion_pool = ConversionPool(workers=2, converter=converter, output_root=mzml_dir)
+    pipeline_stored_data, pipeline_run_state = _analyze_test_experiment(experiment_dir, os.path.join(tmp_path, 'pipeline'), atlas_df, ms2_diagnostic, args,
+                                                                        conversion_pool)
+    conversion_pool.shutdown()
+
+    assert len(run_state) == len(_test_experiment_files) and run_state == pipeline_run_state
+    assert not stored_data[2].empty
+    _assert_stored_data_equal(stored_data, pipeline_stored_data)
+    assert os.listdir(mzml_dir) == []
+
+#Test ms2 panel loading
+
+def test_load_default_ms2_panel(request):
+    ms2_diagnostic = load_ms2_panel(os.path.join(request.config.rootdir, 'default_atlases', 'default_ms2_panel.csv'))
+
+    assert ms2_diagnostic == {'POS':[{'name':'13C,15N-Phenylalanine', 'pmz':176.1135, 'diagnostic_ions':[111.0808, 129.1045, 140.0793, 176.1135]}],
+                              'NEG':[{'name':'13C,15N-Phenylalanine', 'pmz':174.09893, 'diagnostic_ions':[75.01253, 156.07551, 174.09893]}]}
+
+def test_load_ms2_panel_keeps_entry_order(tmp_path):
+    panel_path = os.path.join(tmp_path, 'panel.csv')
+    pd.DataFrame({'precursor_name':['ISTD_B', 'ISTD_A', 'ISTD_B', 'ISTD_A'],
+                  'polarity':['POS', 'POS', 'POS', 'NEG'],
+                  'precursor_mz':[300.0, 200.0, 300.0, 198.0],
+                  'fragment_mz':[150.0, 100.0, 120.0, 99.0]}).to_csv(panel_path, index=False)
+
+    ms2_diagnostic = load_ms2_panel(panel_path)
+
+    assert [entry['name'] for entry in ms2_diagnostic['POS']] == ['ISTD_B', 'ISTD_A']
+    assert ms2_diagnostic['POS'][0]['diagnostic_ions'] == [150.0, 120.0]
+    assert ms2_diagnostic['NEG'] == [{'name':'ISTD_A', 'pmz':198.0, 'diagnostic_ions':[99.0]}]
+
+def test_load_ms2_panel_rejects_ambiguous_names(tmp_path):
+    panel_path = os.path.join(tmp_path, 'panel.csv')
+    pd.DataFrame({'precursor_name':['ISTD_A', 'ISTD_A'],
+                  'polarity':['POS', 'POS'],
+                  'precursor_mz':[200.0, 210.0],
+                  'fragment_mz':[100.0, 105.0]}).to_csv(panel_path, index=False)
+
+    with pytest.raises(ValueError):
+        load_ms2_panel(panel_path)
+
+#Test batch limits shared by the sequential and parallel analysis
+
+def test_is_batch_complete(tmp_path):
+    dataset = _CheckpointedDataset(tmp_path, ['file_1.raw', 'file_2.raw', 'file_3.raw'])
+    args = argparse.Namespace(num_files=5, export_num=None)
+
+    assert not _is_batch_complete(dataset, args, 0)
+    assert _is_batch_complete(dataset, args, 0, num_analyzed=1, max_files=1)
+
+    args.export_num = 2
+    assert not _is_batch_complete(dataset, args, 2)
+    assert _is_batch_complete(dataset, args, 1)
+
+    args.num_files = 3
+    assert _is_batch_complete(dataset, args, 2)
 
 #Test _collect_ms1_peak_data work in progress
     
@@ -0,0 +1,92 @@
+import os
+import argparse
+import threading
+import pandas as pd
+import daemon
+from daemon import _find_experiment_dirs
+from analysis_routines import get_experiment_store_dir, load_ms2_panel, read_data_storage, load_run_state
+from test_analysis_routines import _make_cached_experiment, _get_test_analysis_args, _assert_stored_data_equal, _test_experiment_files
+
+def test_find_experiment_dirs(tmp_path):
+    for experiment_name in ['experiment_1', 'experiment_2', 'empty']:
+        os.mkdir(os.path.join(tmp_path, experiment_name))
+    open(os.path.join(tmp_path, 'experiment_1', 'file_1.raw'), 'w').close()
+    open(os.path.join(tmp_path, 'experiment_2', 'file_1.RAW'), 'w').close()
+
+    root_dir = str(tmp_path)
+    experiment_dirs = _find_experiment_dirs([root_dir], {})
+
+    assert experiment_dirs == [os.path.join(root_dir, 'experiment_1'), os.path.join(root_dir, 'experiment_2')]
+    assert _find_experiment_dirs([root_dir], {experiment_dirs[0]:None}) == experiment_dirs[1:]
+
+def test_get_experiment_store_dir(tmp_path):
+    store_dir_1 = get_experiment_store_dir(tmp_path, os.path.join(tmp_path, 'a', 'experiment'))
+    store_dir_2 = get_experiment_store_dir(tmp_path, os.path.join(tmp_path, 'b', 'experiment'))
+
+    assert store_dir_1 != store_dir_2
+    assert os.path.basename(store_dir_1).startswith('experiment_')
+    assert os.path.isdir(os.path.join(store_dir_1, 'data_store'))
+
+class _InterruptedEvent(threading.Event):
+    """Event whose second wait by the daemon loop interrupts it."""
+
+    num_waits = 0
+
+    def wait(self, timeout=None):
+        _InterruptedEvent.num_waits += 1
+        if _InterruptedEvent.num_waits > 1:
+            raise KeyboardInterrupt
+        return False
+
+class _IdleConversionPool():
+    def shutdown(self):
+        pass
+
+def test_daemon_skips_experiments_that_cannot_be_set_up(tmp_path, monkeypatch, capsys):
+    os.mkdir(os.path.join(tmp_path, 'experiment'))
+    open(os.path.join(tmp_path, 'experiment', 'unparsable_name.raw'), 'w').close()
+
+    monkeypatch.setattr(daemon, 'threading', argparse.Namespace(Event=_InterruptedEvent))
+    monkeypatch.setattr(daemon, 'create_conversion_pool', lambda *args, **kwargs: _IdleConversionPool())
+    monkeypatch.setattr(daemon, 'get_experiment_store_dir', lambda current_dir, experiment_dir: os.path.join(tmp_path, 'store'))
+    os.makedirs(os.path.join(tmp_path, 'store', 'data_store'))
+
+    args = argparse.Namespace(directory=str(tmp_path), experiment_dirs=None, fresh=True, store='npz', stable_seconds=0, no_handle_probe=True,
+                              workers=1, export_num=None, export_idle=10)
+    daemon.run_daemon(args, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'), {})
+
+    output = capsys.readouterr().out
+    assert output.count('Could not set up') == 1
+    assert _InterruptedEvent.num_waits == 2
+
+def test_daemon_pool_stores_every_experiment_in_file_order(tmp_path, monkeypatch):
+    package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    atlas_df = pd.read_csv(os.path.join(package_dir, 'default_atlases', 'default_c18_atlas.csv'))
+    ms2_diagnostic = load_ms2_panel(os.path.join(package_dir, 'default_atlases', 'default_ms2_panel.csv'))
+    root_dir = os.path.join(tmp_path, 'experiments')
+    os.mkdir(root_dir)
+
+    args = _get_test_analysis_args(root_dir, cache_dir=os.path.join(tmp_path, 'cache'), experiment_dirs=None, fresh=False, stable_seconds=0,
+                                   no_handle_probe=True, export_idle=10)
+    os.mkdir(args.cache_dir)
+    experiment_dirs = [os.path.join(root_dir, experiment_name) for experiment_name in ['experiment_1', 'experiment_2', 'experiment_3']]
+    for experiment_dir in experiment_dirs:
+        _make_cached_experiment(experiment_dir, args, atlas_df, ms2_diagnostic)
+
+    monkeypatch.setattr(daemon, 'threading', argparse.Namespace(Event=_InterruptedEvent))
+    monkeypatch.setattr(daemon, 'export_tables_plots', lambda *args, **kwargs: None)
+    stored_data = {}
+    for workers in [1, 2]:
+        monkeypatch.setattr(_InterruptedEvent, 'num_waits', 0)
+        current_store_dir = os.path.join(tmp_path, 'workers_{workers}'.format(workers=workers))
+        monkeypatch.setattr(daemon, 'get_experiment_store_dir', lambda current_dir, experiment_dir: get_experiment_store_dir(current_store_dir, experiment_dir))
+        args.workers = workers
+        daemon.run_daemon(args, package_dir, ms2_diagnostic)
+
+        for experiment_dir in experiment_dirs:
+            store_dir = get_experiment_store_dir(current_store_dir, experiment_dir)
+            assert len(load_run_state(store_dir, experiment_dir)) == len(_test_experiment_files)
+            stored_data[workers, experiment_dir] = read_data_storage(store_dir)
+
+    for experiment_dir in experiment_dirs:
+        _assert_stored_data_equal(stored_data[1, experiment_dir], stored_data[2, experiment_dir])
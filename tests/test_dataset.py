@@ -0,0 +1,83 @@
+import os
+import dataset as ds
+from dataset import RawDataset, _parse_file_name
+
+raw_file_name = '20220101_JGI_MD_000000_TEST_final_QE-HF_{chrom}_USHXG01583_{pol}_MS1_0_QC_Pre_Rg80to1200-CE102040-QC-S1_Run{run}.raw'
+
+def _write_raw_files(path, run_nums):
+    raw_files = []
+    for run_num in run_nums:
+        raw_file = os.path.join(str(path), raw_file_name.format(chrom='C18', pol='POS', run=run_num))
+        open(raw_file, 'w').close()
+        os.utime(raw_file, (1000 + run_num, 1000 + run_num))
+        raw_files.append(raw_file)
+    return raw_files
+
+def test_set_files_to_analyze(tmp_path):
+    raw_files = _write_raw_files(tmp_path, [3, 1, 2])
+    open(os.path.join(str(tmp_path), 'notes.txt'), 'w').close()
+
+    dataset = RawDataset(str(tmp_path))
+
+    assert dataset.files_to_analyze == [raw_files[1], raw_files[2], raw_files[0]]
+    assert dataset.get_next_file() == raw_files[1]
+    assert dataset.chromatography == 'c18'
+
+def test_set_files_to_analyze_incremental(tmp_path):
+    raw_files = _write_raw_files(tmp_path, [1, 2])
+    dataset = RawDataset(str(tmp_path))
+
+    dataset.add_analyzed_file(raw_files[0])
+    raw_files += _write_raw_files(tmp_path, [3])
+    os.utime(raw_files[1], (2000, 2000))
+    dataset.set_files_to_analyze()
+
+    assert dataset.analyzed_files == [raw_files[0]]
+    assert dataset.files_to_analyze == [raw_files[2], raw_files[1]]
+
+    os.remove(raw_files[2])
+    dataset.set_files_to_analyze()
+
+    assert dataset.files_to_analyze == [raw_files[1]]
+    assert dataset.get_next_file() == raw_files[1]
+
+def test_parse_file_name():
+    file_name_fields = _parse_file_name('20220101_JGI_MD_000000_TEST_final_QE-HF_HILICZ_USHXG01583_NEG_MSMS_0_ExCtrl_Pre_Rg80to1200-CE102040-InjBl-S1_Run12')
+
+    assert file_name_fields.chromatography == 'HILICZ'
+    assert file_name_fields.polarity == 'NEG'
+    assert file_name_fields.ms_num == 'MSMS'
+    assert file_name_fields.group_name == 'ExCtrl'
+    assert file_name_fields.category == 'ExCtrl'
+    assert file_name_fields.run_num == 12
+    assert file_name_fields.is_blank
+
+    assert _parse_file_name('20220101_JGI_MD_000000_TEST_final_QE-HF_C18_USHXG01583_POS_MS1_0_S1_Pre_Rg80to1200_100').run_num == 100
+    assert _parse_file_name('20220101_JGI_MD_000000_TEST_final_QE-HF_C18').run_num is None
+
+def test_validate_experiment_filenames_cached(tmp_path, monkeypatch):
+    raw_files = _write_raw_files(tmp_path, [1, 2])
+    validated_paths = []
+    monkeypatch.setattr(ds, '_validate_file_name', lambda file_name_path: validated_paths.append(file_name_path) or ([], []))
+
+    dataset = RawDataset(str(tmp_path))
+    dataset.validate_experiment_filenames()
+    _write_raw_files(tmp_path, [3])
+    dataset.set_files_to_analyze()
+    filename_warnings, filename_errors = dataset.validate_experiment_filenames()
+
+    assert len(validated_paths) == 3
+    assert len(filename_warnings) == 3 and len(filename_errors) == 3
+    assert str(filename_errors[0]['file_name']) == os.path.basename(raw_files[0])
+
+def test_resume(tmp_path):
+    raw_files = _write_raw_files(tmp_path, [1, 2, 3])
+    dataset = RawDataset(str(tmp_path))
+    dataset.add_analyzed_file(raw_files[0])
+    dataset.add_analyzed_file(raw_files[1])
+
+    os.utime(raw_files[1], (2000, 2000))
+    resumed_dataset = RawDataset(str(tmp_path), run_state=dataset.analyzed_stats)
+
+    assert resumed_dataset.analyzed_files == [raw_files[0]]
+    assert resumed_dataset.files_to_analyze == [raw_files[2], raw_files[1]]
@@ -1,8 +1,10 @@
 import pymzml
 import numpy as np 
 import os
+import base64
+import zlib
 from utils import find_nearest
-from extract_mzml_data import _extract_ms1_data, _get_ms1_eic, _get_peak_data, _extract_ms1_tic
+from extract_mzml_data import _extract_ms1_data, _get_ms1_eic, _get_peak_data, _extract_ms1_tic, _extract_mzml_data, _extract_ms2_data, MS1Data, MS1Index, _get_ms1_eics, _get_batch_peak_data, polarity_codes, _build_target_edges, _get_target_filter, _decode_binary_array, _get_nearest_peaks, MS2TopK, PrecursorIndex
 import pytest
 # test for _extract_ms1_data
 
@@ -100,4 +102,321 @@ def test_extract_ms1_tic_real_vals(request):
     test_vals1, test_vals2, = _extract_ms1_tic(test_file_path)
     
     assert np.allclose(test_vals1, real_vals1, atol=1e-6)
-    assert np.allclose(test_vals2, real_vals2, atol=1e-6)
\ No newline at end of file
+    assert np.allclose(test_vals2, real_vals2, atol=1e-6)
+#Test _extract_mzml_data
+
+def test_extract_mzml_data_single_pass_real_vals(request):
+
+    rootdir = request.config.rootdir
+
+    real_rts = np.load(os.path.join(rootdir, "tests/test_data/test_file_rts.npy"))
+    real_tic = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_tic0.npz"))["arr_0"]
+    real_tic_rts = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_tic1.npz"))["arr_0"]
+
+    test_file_path = os.path.join(rootdir, "tests/test_data/20210929_JGI-AK-TH_DS_503916_WRFungi_final_QE-HF_C18_USDAY63680_FPS_MS1_31-P_CsAWO-pellet_3_Rg80to1200-CE102040-Csubverm-QC-C18QU_Run248.mzML")
+
+    ms1_data, ms1_tic_data, ms2_data = _extract_mzml_data(test_file_path)
+
+    assert np.allclose(ms1_data[0], real_rts, atol=1e-6)
+    assert np.allclose(ms1_tic_data[0], real_tic, atol=1e-6)
+    assert np.allclose(ms1_tic_data[1], real_tic_rts, atol=1e-6)
+    assert ms2_data == []
+
+#Test MS1Index batch lookups
+
+def test_batch_eics_equal_real_vals(request):
+
+    rootdir = request.config.rootdir
+
+    real_vals1 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_eic1.npz"))["arr_0"]
+    real_vals2 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_eic2.npz"))["arr_0"]
+    real_vals3 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_eic3.npz"))["arr_0"]
+
+    test_ms1_index = MS1Index(np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_eic.npz"))["arr_0"])
+
+    test_eics = _get_ms1_eics(test_ms1_index, [176.1135, 500.0])
+    test_vals1, test_vals2, test_vals3 = test_eics[0]
+
+    assert np.allclose(test_vals1, real_vals1, atol=1e-6)
+    assert np.allclose(test_vals2, real_vals2, atol=1e-6)
+    assert np.allclose(test_vals3, real_vals3, atol=1e-6)
+    assert len(test_eics[1][0]) == 0
+
+def test_batch_peak_data_equal_real_vals(request):
+
+    rootdir = request.config.rootdir
+
+    real_vals1 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_peak0.npz"))["arr_0"]
+    real_vals2 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_peak1.npz"))["arr_0"]
+    real_vals3 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_peak2.npz"))["arr_0"]
+
+    test_ms1_index = MS1Index(np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_eic.npz"))["arr_0"])
+
+    test_vals1, test_vals2, test_vals3 = _get_batch_peak_data(test_ms1_index, [176.1135, 500.0])
+
+    assert np.allclose(test_vals1[0], real_vals1, atol=1e-6)
+    assert np.allclose(test_vals2[0], real_vals2, atol=1e-6)
+    assert np.allclose(test_vals3[0], real_vals3, atol=1e-6)
+    assert np.isnan([test_vals1[1], test_vals2[1], test_vals3[1]]).all()
+
+#Test MS1Data
+
+def test_ms1_data_unpacks_like_peak_arrays():
+
+    ms1_data = MS1Data(mz_dtype=np.float32, chunk_size=4)
+    ms1_data.append_scan(0.5, np.array([100.0, 200.0, 300.0]), np.array([1.0, 2.0, 3.0]))
+    ms1_data.append_scan(0.6, np.array([]), np.array([]))
+    ms1_data.append_scan(0.7, np.array([150.0, 250.0]), np.array([4.0, 5.0]))
+    ms1_data.trim()
+
+    ms1_rts, ms1_mzs, ms1_is = ms1_data
+
+    assert np.allclose(ms1_rts, [0.5, 0.5, 0.5, 0.7, 0.7])
+    assert np.allclose(ms1_mzs, [100.0, 200.0, 300.0, 150.0, 250.0])
+    assert np.allclose(ms1_data[2], [1.0, 2.0, 3.0, 4.0, 5.0])
+    assert ms1_mzs.dtype == np.float32
+    assert ms1_is.dtype == np.float32
+    assert np.shape(ms1_rts) == np.shape(ms1_mzs) == np.shape(ms1_is)
+
+def test_ms1_index_uses_scan_rts():
+
+    ms1_data = MS1Data()
+    ms1_data.append_scan(0.5, np.array([176.1135, 200.0]), np.array([10.0, 2.0]))
+    ms1_data.append_scan(3.5, np.array([176.1136]), np.array([50.0]))
+    ms1_data.trim()
+
+    peak_rts, peak_mzs, peak_is = _get_batch_peak_data(MS1Index(ms1_data), [176.1135], rts=[1.0], rt_window=1)
+
+    assert np.allclose(peak_rts, [0.5])
+    assert np.allclose(peak_is, [10.0])
+
+def test_ms1_index_polarity_partition():
+
+    ms1_data = MS1Data()
+    ms1_data.append_scan(0.5, np.array([176.1135]), np.array([10.0]), polarity=polarity_codes['POS'])
+    ms1_data.append_scan(0.6, np.array([176.1135]), np.array([50.0]), polarity=polarity_codes['NEG'])
+    ms1_data.trim()
+
+    pos_rts, pos_mzs, pos_is = _get_batch_peak_data(MS1Index(ms1_data, polarity='POS'), [176.1135])
+    neg_rts, neg_mzs, neg_is = _get_batch_peak_data(MS1Index(ms1_data, polarity='NEG'), [176.1135])
+    all_rts, all_mzs, all_is = _get_batch_peak_data(MS1Index(ms1_data), [176.1135])
+
+    assert np.allclose(pos_is, [10.0])
+    assert np.allclose(neg_is, [50.0])
+    assert np.allclose(all_is, [50.0])
+
+#Test targeted extraction windows
+
+def test_target_filter_keeps_only_atlas_windows():
+
+    target_edges = _build_target_edges([176.1135, 176.1140, 229.9811, np.nan], tolerance=0.0015)
+    test_mzs = np.array([100.0, 176.1120, 176.1135, 176.1157, 176.2, 229.9811, 229.99, 500.0])
+
+    target_filter = _get_target_filter(target_edges, test_mzs)
+
+    assert len(target_edges) == 4
+    assert list(target_filter) == [False, True, True, True, False, True, False, False]
+
+def test_empty_targets_do_not_filter(tmp_path):
+
+    test_file_path = str(tmp_path / 'test_targets.mzML')
+    _write_test_indexed_mzml(test_file_path, [(1, None, [100.0, 176.1135], [10.0, 20.0], {'polarity':'POS', 'tic':30.0}),
+                                              (1, None, [101.0, 174.0989], [5.0, 6.0], {'polarity':'NEG', 'tic':11.0})])
+
+    all_ms1_data, _, _ = _extract_mzml_data(test_file_path, backend='native')
+    empty_ms1_data, _, _ = _extract_mzml_data(test_file_path, backend='native', targets={})
+    no_windows_ms1_data, _, _ = _extract_mzml_data(test_file_path, backend='native', targets={'POS':np.array([]), 'NEG':np.array([])})
+    pos_ms1_data, _, _ = _extract_mzml_data(test_file_path, backend='native', targets={'POS':_build_target_edges([176.1135], tolerance=0.0015),
+                                                                                        'NEG':_build_target_edges([], tolerance=0.0015)})
+
+    assert empty_ms1_data.mzs.tolist() == no_windows_ms1_data.mzs.tolist() == all_ms1_data.mzs.tolist() == [100.0, 176.1135, 101.0, 174.0989]
+    assert pos_ms1_data.mzs.tolist() == [176.1135, 101.0, 174.0989]
+
+#Test native mzml backend against pymzml
+
+def test_native_backend_ms1_equals_pymzml(request):
+
+    rootdir = request.config.rootdir
+    test_file_path = os.path.join(rootdir, "tests/test_data/20210929_JGI-AK-TH_DS_503916_WRFungi_final_QE-HF_C18_USDAY63680_FPS_MS1_31-P_CsAWO-pellet_3_Rg80to1200-CE102040-Csubverm-QC-C18QU_Run248.mzML")
+
+    pymzml_ms1_data, pymzml_tic_data, _ = _extract_mzml_data(test_file_path, backend='pymzml')
+    native_ms1_data, native_tic_data, _ = _extract_mzml_data(test_file_path, backend='native')
+
+    for pymzml_array, native_array in zip(pymzml_ms1_data, native_ms1_data):
+        assert np.allclose(pymzml_array, native_array, atol=1e-6)
+    assert np.array_equal(pymzml_ms1_data.scan_polarities, native_ms1_data.scan_polarities)
+    assert np.allclose(pymzml_tic_data[0], native_tic_data[0], atol=1e-6)
+    assert np.allclose(pymzml_tic_data[1], native_tic_data[1], atol=1e-6)
+
+def test_native_backend_real_vals(request):
+
+    rootdir = request.config.rootdir
+    test_file_path = os.path.join(rootdir, "tests/test_data/20210929_JGI-AK-TH_DS_503916_WRFungi_final_QE-HF_C18_USDAY63680_FPS_MS1_31-P_CsAWO-pellet_3_Rg80to1200-CE102040-Csubverm-QC-C18QU_Run248.mzML")
+
+    real_vals1 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_tic0.npz"))["arr_0"]
+    real_vals2 = np.load(os.path.join(rootdir, "tests/test_data/test_file_ms1_tic1.npz"))["arr_0"]
+
+    test_vals1, test_vals2 = _extract_ms1_tic(test_file_path, backend='native')
+
+    assert np.allclose(test_vals1, real_vals1, atol=1e-6)
+    assert np.allclose(test_vals2, real_vals2, atol=1e-6)
+
+def test_native_backend_equals_pymzml_on_generated_mzml(tmp_path):
+
+    test_file_path = str(tmp_path / 'test_encodings.mzML')
+    _write_test_indexed_mzml(test_file_path, [(1, None, [100.0, 176.1135, 229.9811], [10.0, 20.0, 30.5], {'polarity':'POS', 'tic':61.5}),
+                                              (1, None, [101.5, 174.0989], [12.0, 8.0], {'polarity':'NEG', 'tic':20.0, 'rt':12.0, 'rt_unit':'second', 'mz_dtype':'<f4', 'compression':None}),
+                                              (2, 176.1136, [111.0808, 129.1045], [5.0, 6.0], {'polarity':'POS', 'i_dtype':'<f8'}),
+                                              (1, None, [102.25, 176.1130], [7.0, 9.0], {'polarity':'POS', 'tic':16.0, 'rt':18.0, 'rt_unit':'second', 'i_dtype':'<f8', 'compression':None}),
+                                              (2, 174.0990, [75.01253, 156.07551], [3.0, 4.0], {'polarity':'NEG', 'compression':None}),
+                                              (1, None, [103.0], [1.0], {'polarity':'NEG', 'rt':0.4, 'tic':1.0})])
+
+    for extract_args in [{'pmz':176.1135}, {'precursor_index':PrecursorIndex([176.1135, 174.0989], tolerance=0.0015)}]:
+        pymzml_ms1_data, pymzml_tic_data, pymzml_ms2_data = _extract_mzml_data(test_file_path, tolerance=0.0015, backend='pymzml', **extract_args)
+        native_ms1_data, native_tic_data, native_ms2_data = _extract_mzml_data(test_file_path, tolerance=0.0015, backend='native', **extract_args)
+
+        assert native_ms1_data.n_scans == pymzml_ms1_data.n_scans == 4
+        for pymzml_array, native_array in zip(pymzml_ms1_data, native_ms1_data):
+            assert np.array_equal(pymzml_array, native_array)
+        assert np.array_equal(pymzml_ms1_data.scan_polarities, native_ms1_data.scan_polarities)
+        assert list(native_ms1_data.scan_polarities) == [polarity_codes[polarity] for polarity in ['POS', 'NEG', 'POS', 'NEG']]
+        assert np.allclose(native_ms1_data.scan_rts, [0.0, 0.2, 0.3, 0.4])
+        assert native_tic_data[0] == [61.5, 20.0, 16.0, 1.0]
+
+        assert np.allclose(pymzml_tic_data[0], native_tic_data[0])
+        assert np.allclose(pymzml_tic_data[1], native_tic_data[1])
+
+        if 'pmz' in extract_args:
+            pymzml_ms2_data, native_ms2_data = [pymzml_ms2_data], [native_ms2_data]
+        assert [len(entry_spectra) for entry_spectra in native_ms2_data] == [len(entry_spectra) for entry_spectra in pymzml_ms2_data]
+        for pymzml_spectra, native_spectra in zip(pymzml_ms2_data, native_ms2_data):
+            for pymzml_spec, native_spec in zip(pymzml_spectra, native_spectra):
+                assert np.allclose(pymzml_spec, native_spec)
+        assert sum(len(entry_spectra) for entry_spectra in native_ms2_data) == len(native_ms2_data)
+
+def test_decode_binary_array_encodings():
+
+    test_array = np.array([176.1135, 229.9811, 1000.5])
+
+    for dtype in ['<f4', '<f8']:
+        raw_bytes = test_array.astype(dtype).tobytes()
+        zlib_text = base64.b64encode(zlib.compress(raw_bytes)).decode()
+        plain_text = base64.b64encode(raw_bytes).decode()
+
+        assert np.allclose(_decode_binary_array(zlib_text, dtype, 'zlib'), test_array, atol=1e-4)
+        assert np.allclose(_decode_binary_array(plain_text, dtype, None), test_array, atol=1e-4)
+        assert _decode_binary_array(None, dtype, None).shape == (0,)
+
+#Test ms2 extraction
+
+_test_dtypes = {'<f4':('MS:1000521', '32-bit float'), '<f8':('MS:1000523', '64-bit float')}
+_test_compressions = {'zlib':('MS:1000574', 'zlib compression'), None:('MS:1000576', 'no compression')}
+_test_polarities = {'POS':('MS:1000130', 'positive scan'), 'NEG':('MS:1000129', 'negative scan')}
+
+def _encode_test_array(values, dtype, compression='zlib'):
+    raw_bytes = np.asarray(values, dtype=dtype).tobytes()
+    return base64.b64encode(zlib.compress(raw_bytes) if compression == 'zlib' else raw_bytes).decode()
+
+def _get_test_binary_array(values, dtype, compression, array_accession, array_name):
+    return ('<binaryDataArray encodedLength="0"><cvParam cvRef="MS" accession="{dtype_acc}" name="{dtype_name}" value="" />'
+            '<cvParam cvRef="MS" accession="{compression_acc}" name="{compression_name}" value="" />'
+            '<cvParam cvRef="MS" accession="{array_acc}" name="{array_name}" value="" /><binary>{binary}</binary></binaryDataArray>\n').format(
+                dtype_acc=_test_dtypes[dtype][0], dtype_name=_test_dtypes[dtype][1], compression_acc=_test_compressions[compression][0],
+                compression_name=_test_compressions[compression][1], array_acc=array_accession, array_name=array_name,
+                binary=_encode_test_array(values, dtype, compression))
+
+def _write_test_indexed_mzml(file_path, spectra):
+    """Write a minimal indexedmzML, spectra are (ms_level, precursor_mz, mzs, intensities) with an optional dict of polarity,
+    tic (pymzml needs it on ms1 scans), rt, rt_unit ('minute' or 'second'), mz_dtype, i_dtype and compression (zlib or None)."""
+
+    xml = '<?xml version="1.0" encoding="utf-8"?>\n<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n<run id="test">\n<spectrumList count="{n}">\n'.format(n=len(spectra))
+    offsets = []
+    for idx, (ms_level, precursor_mz, mzs, intensities, *spectrum_options) in enumerate(spectra):
+        options = dict({'rt':0.1 * idx, 'rt_unit':'minute', 'mz_dtype':'<f8', 'i_dtype':'<f4', 'compression':'zlib'}, **(spectrum_options or [{}])[0])
+        offsets.append(('scan={n}'.format(n=idx + 1), len(xml.encode())))
+
+        spectrum_params = '<cvParam cvRef="MS" accession="MS:1000511" value="{ms_level}" name="ms level" />\n'.format(ms_level=ms_level)
+        if 'polarity' in options:
+            spectrum_params += '<cvParam cvRef="MS" accession="{acc}" name="{name}" value="" />\n'.format(acc=_test_polarities[options['polarity']][0],
+                                                                                                        name=_test_polarities[options['polarity']][1])
+        if 'tic' in options:
+            spectrum_params += '<cvParam cvRef="MS" accession="MS:1000285" value="{tic}" name="total ion current" />\n'.format(tic=options['tic'])
+
+        unit_accession = 'UO:0000031' if options['rt_unit'] == 'minute' else 'UO:0000010'
+        precursor = ''
+        if precursor_mz is not None:
+            precursor = '<precursorList count="1"><precursor><selectedIonList count="1"><selectedIon><cvParam cvRef="MS" accession="MS:1000744" value="{pmz}" name="selected ion m/z" /></selectedIon></selectedIonList></precursor></precursorList>'.format(pmz=precursor_mz)
+        xml += ('<spectrum index="{idx}" id="scan={n}" defaultArrayLength="{length}">\n{spectrum_params}'
+                '<scanList count="1"><scan><cvParam cvRef="MS" accession="MS:1000016" value="{rt}" name="scan start time" unitCvRef="UO" unitAccession="{unit_accession}" unitName="{rt_unit}" /></scan></scanList>\n'
+                '{precursor}\n<binaryDataArrayList count="2">\n{mz_array}{i_array}</binaryDataArrayList>\n</spectrum>\n').format(
+                    idx=idx, n=idx + 1, length=len(mzs), spectrum_params=spectrum_params, rt=options['rt'], unit_accession=unit_accession,
+                    rt_unit=options['rt_unit'], precursor=precursor,
+                    mz_array=_get_test_binary_array(mzs, options['mz_dtype'], options['compression'], 'MS:1000514', 'm/z array'),
+                    i_array=_get_test_binary_array(intensities, options['i_dtype'], options['compression'], 'MS:1000515', 'intensity array'))
+    xml += '</spectrumList>\n</run>\n</mzML>\n'
+    index_offset = len(xml.encode())
+    xml += '<indexList count="1">\n<index name="spectrum">\n'
+    xml += ''.join('<offset idRef="{scan_id}">{offset}</offset>\n'.format(scan_id=scan_id, offset=offset) for scan_id, offset in offsets)
+    xml += '</index>\n</indexList>\n<indexListOffset>{offset}</indexListOffset>\n</indexedmzML>\n'.format(offset=index_offset)
+
+    with open(file_path, 'w') as fh:
+        fh.write(xml)
+
+def test_ms2_top_k_keeps_most_intense_spectra(tmp_path):
+
+    test_file_path = str(tmp_path / 'test_indexed.mzML')
+    _write_test_indexed_mzml(test_file_path, [(2, 176.1135, [111.0808], [5.0]),
+                                              (2, 176.1135, [129.1045, 140.0793], [6.0, 9.0]),
+                                              (2, 176.1135, [140.0793], [15.0]),
+                                              (2, 176.1135, [150.0], [3.0])])
+
+    all_ms2_data = _extract_ms2_data(test_file_path, 176.1135, tolerance=0.0015)
+    top_ms2_data = _extract_ms2_data(test_file_path, 176.1135, tolerance=0.0015, top_k=1)
+    _, _, streamed_top_ms2_data = _extract_mzml_data(test_file_path, pmz=176.1135, tolerance=0.0015, backend='native', ms2_top_k=2)
+
+    assert len(all_ms2_data) == 4
+    assert len(top_ms2_data) == 1
+    assert np.array_equal(top_ms2_data[0], all_ms2_data[1])
+
+    #ties keep the earlier spectrum, kept spectra stay in scan order
+    assert len(streamed_top_ms2_data) == 2
+    assert np.allclose(streamed_top_ms2_data[0], all_ms2_data[1])
+    assert np.allclose(streamed_top_ms2_data[1], all_ms2_data[2])
+
+def test_nearest_peaks_equal_isclose_search():
+
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        mzs = np.round(rng.uniform(100, 102, rng.integers(0, 40)), 3)
+        mzs = np.concatenate([mzs, mzs[:rng.integers(0, 5)]])
+        intensities = rng.uniform(0, 1000, len(mzs))
+        target_mzs = np.round(rng.uniform(99.9, 102.1, 6), 3)
+
+        observed_mzs, observed_intensities = _get_nearest_peaks(mzs, intensities, target_mzs, 0.005)
+
+        for target_mz, observed_mz, observed_intensity in zip(target_mzs, observed_mzs, observed_intensities):
+            idx = np.isclose(mzs, target_mz, atol=0.005)
+            if idx.any():
+                nearest_mz_idx = find_nearest(mzs[idx], target_mz)
+                assert observed_mz == mzs[idx][nearest_mz_idx]
+                assert observed_intensity == intensities[idx][nearest_mz_idx]
+            else:
+                assert np.isnan(observed_mz) and np.isnan(observed_intensity)
+
+def test_precursor_index_assigns_scans_to_all_matching_entries(tmp_path):
+
+    test_file_path = str(tmp_path / 'test_indexed.mzML')
+    _write_test_indexed_mzml(test_file_path, [(2, 176.1136, [111.0808], [5.0]),
+                                              (2, 300.0, [150.0], [7.0]),
+                                              (2, 176.1140, [129.1045], [6.0])])
+
+    precursor_index = PrecursorIndex([300.0, 176.1135, 176.1171, 500.0], tolerance=0.0015)
+    _, _, ms2_data = _extract_mzml_data(test_file_path, tolerance=0.0015, backend='native', precursor_index=precursor_index)
+
+    assert list(precursor_index.get_entries(176.1140)) == [1, 2]
+    assert [len(entry_spectra) for entry_spectra in ms2_data] == [1, 2, 1, 0]
+    assert np.allclose(ms2_data[2][0], [[129.1045], [6.0]])
+
+    for mz in np.linspace(176.11, 176.12, 1001):
+        expected_entries = np.flatnonzero(np.isclose(precursor_index.pmzs, mz, atol=0.0015))
+        assert list(precursor_index.get_entries(mz)) == list(expected_entries)
@@ -0,0 +1,67 @@
+import random
+import asyncio
+from pipeline import PipelineStage, run_pipeline
+
+def _run_jobs(jobs, stages, max_in_memory=1, stop_at=None):
+    job_iter = iter(jobs)
+    committed = []
+    discarded = []
+
+    def next_job():
+        job = next(job_iter, None)
+        return None if job is None else (job, job['run_stages'])
+
+    def commit(job, error):
+        committed.append((job['num'], error))
+        return job['num'] != stop_at
+
+    asyncio.run(run_pipeline(next_job, stages, commit, discard=discarded.append, max_in_memory=max_in_memory))
+    return committed, discarded
+
+def test_run_pipeline_order():
+    async def stage(job):
+        await asyncio.sleep(random.random() / 100)
+        job['stages'] += 1
+
+    jobs = [{'num':num, 'run_stages':num % 3 != 0, 'stages':0} for num in range(20)]
+    committed, discarded = _run_jobs(jobs, [PipelineStage(stage, workers=3), PipelineStage(stage, workers=2)])
+
+    assert committed == [(num, None) for num in range(20)]
+    assert [job['stages'] for job in jobs] == [0 if num % 3 == 0 else 2 for num in range(20)]
+    assert discarded == []
+
+def test_run_pipeline_memory_slots():
+    in_memory = [0, 0]
+
+    async def parse(job):
+        in_memory[0] += 1
+        in_memory[1] = max(in_memory)
+        await asyncio.sleep(0.001)
+
+    async def analyze(job):
+        await asyncio.sleep(0.002)
+        in_memory[0] -= 1
+
+    jobs = [{'num':num, 'run_stages':True} for num in range(10)]
+    stages = [PipelineStage(parse, workers=4, holds_memory=True), PipelineStage(analyze, workers=4, holds_memory=True)]
+    committed, discarded = _run_jobs(jobs, stages, max_in_memory=2)
+
+    assert len(committed) == 10
+    assert in_memory[1] == 2
+
+def test_run_pipeline_errors():
+    async def stage(job):
+        if job['num'] == 3:
+            raise ValueError('bad job')
+        job['second_stage'] = False
+
+    async def second_stage(job):
+        job['second_stage'] = True
+
+    jobs = [{'num':num, 'run_stages':True} for num in range(10)]
+    committed, discarded = _run_jobs(jobs, [PipelineStage(stage, workers=2), PipelineStage(second_stage)], stop_at=3)
+
+    assert [num for num, error in committed] == [0, 1, 2, 3]
+    assert isinstance(committed[3][1], ValueError)
+    assert 'second_stage' not in jobs[3]
+    assert all(job['num'] > 3 for job in discarded)
@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import os
+import pytest
+import matplotlib.pyplot as plt
+import plots
+from plots import prepare_ms1_page_data, ms1_page_categories, _get_outlier_mask
+
+
+# Test ms1 page data preparation
+
+def test_page_data_splits_compounds_polarities_and_categories():
+
+    ms1_data = pd.DataFrame({'compound_name':['a', 'a', 'b', 'a', 'a'],
+                             'polarity':['POS', 'NEG', 'POS', 'POS', 'POS'],
+                             'file_category':['S1', 'S1', 'ISTD', 'QC', 'ExCtrl'],
+                             'run_num':[1, 1, 2, 3, 4],
+                             'observed_intensity':np.array([100.0, 10.0, 1000.0, 5.0, 1e4], dtype=np.float32),
+                             'ppm_error':[0.5, 1.0, -1.0, 0.0, 3.0],
+                             'retention_time':[1.0, 1.1, 2.0, 3.0, 1.0]})
+
+    page_data = prepare_ms1_page_data(ms1_data, ms1_page_categories)
+
+    assert sorted(page_data) == ['a', 'b']
+    assert page_data['a']['run_num'].tolist() == [1, 1, 4]
+    assert page_data['a']['POS']['S1']['run_num'].tolist() == [1]
+    assert page_data['a']['POS']['ISTD']['run_num'].tolist() == []
+    assert page_data['a']['POS']['run_num_range'] == (1, 4)
+    assert np.isnan(page_data['b']['NEG']['run_num_range'][0])
+
+    assert page_data['a']['POS']['median']['ppm_error'] == 1.75
+    assert np.allclose(page_data['a']['POS']['ExCtrl']['observed_intensity_logy'], [4.0])
+    assert page_data['a']['POS']['ExCtrl']['outliers']['ppm_error'].tolist() == [False]
+
+def test_outlier_mask_matches_labeling_rules():
+
+    y_values = np.array([1.0, 9.0, 11.0, 0.05, np.nan])
+
+    assert _get_outlier_mask('observed_intensity', y_values, 1.0).tolist() == [False, False, True, True, False]
+    assert _get_outlier_mask('ppm_error', y_values, 1.0).tolist() == [False, True, True, False, False]
+    assert _get_outlier_mask('retention_time', y_values, 1.0).tolist() == [False, True, True, True, False]
+
+# Test qc pdf saving
+
+def _make_text_page(key):
+    fig = plt.figure()
+    fig.suptitle(key)
+    return [fig]
+
+def test_export_without_pypdf_reports_full_redraw_once(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(plots, 'PdfWriter', None)
+    monkeypatch.setattr(plots, '_reported_missing_pypdf', False)
+
+    def get_page(key):
+        return _make_text_page, (key,)
+
+    page_cache = plots.PageCache(os.path.join(tmp_path, 'pages'), redraw_keys=set())
+    plots._save_qc_pdf(os.path.join(tmp_path, 'first.pdf'), ['a'], get_page, page_cache=page_cache)
+    plots._save_qc_pdf(os.path.join(tmp_path, 'second.pdf'), ['a'], get_page, page_cache=page_cache)
+
+    assert capsys.readouterr().out.count('pypdf is not installed') == 1
+    assert os.path.isfile(os.path.join(tmp_path, 'second.pdf'))
+
+def _make_sized_page(width):
+    return [plt.figure(figsize=(width, 3))]
+
+def test_render_pool_keeps_page_order(tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+
+    page_widths = [4, 7, 5, 6, 3]
+    def get_page(width):
+        return _make_sized_page, (width,)
+
+    for plot_workers in [1, 2]:
+        render_pool = plots.create_render_pool(plot_workers)
+        try:
+            page_cache = plots.PageCache(os.path.join(tmp_path, 'pages_{workers}'.format(workers=plot_workers)))
+            plots._save_qc_pdf(os.path.join(tmp_path, 'plots_{workers}.pdf'.format(workers=plot_workers)), page_widths, get_page,
+                               page_cache=page_cache, render_pool=render_pool)
+        finally:
+            if render_pool is not None:
+                render_pool.shutdown()
+
+    for plot_workers in [1, 2]:
+        pdf_reader = pypdf.PdfReader(os.path.join(tmp_path, 'plots_{workers}.pdf'.format(workers=plot_workers)))
+        assert [round(float(page.mediabox.width) / 72) for page in pdf_reader.pages] == page_widths
+
+# Test ms2 pages
+
+def test_ms2_figure_matches_entries_by_name_and_polarity():
+
+    ms2_diagnostic = {'POS':[{'name':'ISTD_A', 'pmz':176.1135, 'diagnostic_ions':[111.0808]}, {'name':'ISTD_B', 'pmz':300.0, 'diagnostic_ions':[111.0808]}],
+                      'NEG':[{'name':'ISTD_A', 'pmz':174.09893, 'diagnostic_ions':[75.01253]}]}
+    ms2_data = pd.DataFrame({'run_num':[1, 2, 1, 1],
+                             'polarity':['POS', 'POS', 'POS', 'NEG'],
+                             'precursor_name':['ISTD_A', 'ISTD_A', 'ISTD_B', 'ISTD_A'],
+                             'precursor_mz':[176.1135 + 1e-12, 176.1135, 300.0, 174.09893],
+                             'theoretical_mz':[111.0808, 111.0808, 111.0808, 75.01253],
+                             'observed_intensity':[10.0, 20.0, 30.0, 40.0]})
+
+    fig = plots._make_compound_ms2_figure(ms2_data, 'observed_intensity', 'ISTD_A', ms2_diagnostic)
+
+    pos_ax, neg_ax = fig.axes[:2]
+    assert [line.get_ydata().tolist() for line in pos_ax.get_lines()] == [[10.0, 20.0]]
+    assert [line.get_ydata().tolist() for line in neg_ax.get_lines()] == [[40.0]]
+    plt.close('all')
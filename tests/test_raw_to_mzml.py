@@ -0,0 +1,190 @@
+import os
+import sys
+import pytest
+import asyncio
+from raw_to_mzml import _raw_to_mzml, _raw_to_mzml_stream, _raw_to_mzml_async, _remove_mzml, ConversionPool
+
+#stand-in for ThermoRawFileParser, fails or hangs when the raw file asks it to
+stand_in_converter = '''
+import os, sys, time
+args = dict(arg.split('=', 1) for arg in sys.argv[1:] if '=' in arg)
+content = open(args['-i']).read()
+if content == 'fail':
+    sys.exit(1)
+if content == 'hang':
+    time.sleep(30)
+if content == 'flaky' and not os.path.exists(args['-i'] + '.tried'):
+    open(args['-i'] + '.tried', 'w').close()
+    sys.exit(1)
+if '--stdout' in sys.argv:
+    if content == 'no stream':
+        sys.exit(2)
+    sys.stdout.write(content)
+    sys.exit(0)
+name = os.path.splitext(os.path.basename(args['-i']))[0]
+with open(os.path.join(args['-o'], name + '.mzML'), 'w') as fh:
+    fh.write(content)
+'''
+
+@pytest.fixture
+def stand_in(tmp_path):
+
+    script_path = str(tmp_path / 'stand_in_converter.py')
+    with open(script_path, 'w') as fh:
+        fh.write(stand_in_converter)
+
+    def converter(file_path, output_dir):
+        return [sys.executable, script_path, '-i={input}'.format(input=file_path), '-o={output}'.format(output=output_dir)]
+
+    return converter
+
+@pytest.fixture
+def stream_stand_in(tmp_path, stand_in):
+
+    script_path = str(tmp_path / 'stand_in_converter.py')
+
+    def stream_converter(file_path):
+        return [sys.executable, script_path, '-i={input}'.format(input=file_path), '--stdout']
+
+    return stream_converter
+
+def _read_stream(file_path, stream):
+    return stream.read().decode()
+
+def _make_raw_file(tmp_path, name, content):
+    raw_file_path = str(tmp_path / name)
+    with open(raw_file_path, 'w') as fh:
+        fh.write(content)
+    return raw_file_path
+
+# Test single conversions
+
+def test_conversion_outputs_are_unique(tmp_path, stand_in):
+
+    raw_file_path = _make_raw_file(tmp_path, 'test_file.raw', 'spectra')
+    output_root = str(tmp_path / 'mzml_temp')
+
+    first_mzml = _raw_to_mzml(raw_file_path, converter=stand_in, output_root=output_root)
+    second_mzml = _raw_to_mzml(raw_file_path, converter=stand_in, output_root=output_root)
+
+    assert first_mzml != second_mzml
+    assert os.path.basename(first_mzml) == 'test_file.mzML'
+    assert open(first_mzml).read() == 'spectra'
+
+    _remove_mzml(first_mzml)
+
+    assert not os.path.exists(os.path.dirname(first_mzml))
+    assert os.path.isfile(second_mzml)
+
+def test_conversion_retries_then_fails(tmp_path, stand_in):
+
+    output_root = str(tmp_path / 'mzml_temp')
+    flaky_file_path = _make_raw_file(tmp_path, 'flaky_file.raw', 'flaky')
+    failing_file_path = _make_raw_file(tmp_path, 'failing_file.raw', 'fail')
+
+    assert os.path.isfile(_raw_to_mzml(flaky_file_path, converter=stand_in, output_root=output_root, retries=1))
+
+    with pytest.raises(RuntimeError):
+        _raw_to_mzml(failing_file_path, converter=stand_in, output_root=output_root, retries=2)
+
+    assert len(os.listdir(output_root)) == 1
+
+def test_conversion_timeout(tmp_path, stand_in):
+
+    hanging_file_path = _make_raw_file(tmp_path, 'hanging_file.raw', 'hang')
+
+    with pytest.raises(RuntimeError, match='timed out'):
+        _raw_to_mzml(hanging_file_path, converter=stand_in, output_root=str(tmp_path / 'mzml_temp'), timeout=1)
+
+def test_async_conversion(tmp_path, stand_in):
+
+    output_root = str(tmp_path / 'mzml_temp')
+    raw_file_paths = [_make_raw_file(tmp_path, 'file_{num}.raw'.format(num=num), 'mzml {num}'.format(num=num)) for num in range(3)]
+    hanging_file_path = _make_raw_file(tmp_path, 'hanging_file.raw', 'hang')
+
+    async def convert_files():
+        return await asyncio.gather(*[_raw_to_mzml_async(raw_file_path, converter=stand_in, output_root=output_root) for raw_file_path in raw_file_paths])
+
+    mzml_file_paths = asyncio.run(convert_files())
+
+    assert [open(mzml_file_path).read() for mzml_file_path in mzml_file_paths] == ['mzml 0', 'mzml 1', 'mzml 2']
+
+    with pytest.raises(RuntimeError, match='timed out'):
+        asyncio.run(_raw_to_mzml_async(hanging_file_path, converter=stand_in, output_root=output_root, timeout=1))
+    assert len(os.listdir(output_root)) == 3
+
+def test_cancelled_async_conversion_waits_for_converter(tmp_path, stand_in, monkeypatch):
+
+    output_root = str(tmp_path / 'mzml_temp')
+    hanging_file_path = _make_raw_file(tmp_path, 'hanging_file.raw', 'hang')
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def record_process(*args, **kwargs):
+        processes.append(await create_subprocess_exec(*args, **kwargs))
+        return processes[-1]
+
+    async def cancel_conversion():
+        conversion = asyncio.ensure_future(_raw_to_mzml_async(hanging_file_path, converter=stand_in, output_root=output_root))
+        await asyncio.sleep(0.5)
+        conversion.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await conversion
+        #the converter has exited once the cancelled conversion returns
+        return processes[0].returncode
+
+    monkeypatch.setattr(asyncio, 'create_subprocess_exec', record_process)
+
+    assert asyncio.run(cancel_conversion()) is not None
+    assert os.listdir(output_root) == []
+
+# Test conversion pool
+
+def test_conversion_pool_prefetch(tmp_path, stand_in):
+
+    output_root = str(tmp_path / 'mzml_temp')
+    raw_file_paths = [_make_raw_file(tmp_path, 'file_{n}.raw'.format(n=n), str(n)) for n in range(4)]
+
+    conversion_pool = ConversionPool(workers=2, converter=stand_in, output_root=output_root)
+    conversion_pool.prefetch(raw_file_paths)
+
+    assert len(conversion_pool.pending) == 4
+
+    mzml_file_path = conversion_pool.get_result(raw_file_paths[0])
+
+    assert open(mzml_file_path).read() == '0'
+    assert raw_file_paths[0] not in conversion_pool.pending
+
+    conversion_pool.shutdown()
+
+    assert os.listdir(output_root) == [os.path.basename(os.path.dirname(mzml_file_path))]
+
+# Test streaming conversions
+
+def test_stream_conversion_writes_no_files(tmp_path, stream_stand_in):
+
+    raw_file_path = _make_raw_file(tmp_path, 'test_file.raw', 'spectra')
+
+    assert _raw_to_mzml_stream(raw_file_path, _read_stream, stream_converter=stream_stand_in) == 'spectra'
+    assert sorted(os.listdir(str(tmp_path))) == ['stand_in_converter.py', 'test_file.raw']
+
+def test_stream_conversion_timeout(tmp_path, stream_stand_in):
+
+    hanging_file_path = _make_raw_file(tmp_path, 'hanging_file.raw', 'hang')
+
+    with pytest.raises(RuntimeError, match='timed out'):
+        _raw_to_mzml_stream(hanging_file_path, _read_stream, stream_converter=stream_stand_in, timeout=1)
+
+def test_conversion_pool_stream_falls_back_to_file(tmp_path, stand_in, stream_stand_in):
+
+    output_root = str(tmp_path / 'mzml_temp')
+    streamed_file_path = _make_raw_file(tmp_path, 'streamed_file.raw', 'spectra')
+    fallback_file_path = _make_raw_file(tmp_path, 'fallback_file.raw', 'no stream')
+
+    conversion_pool = ConversionPool(workers=2, converter=stand_in, output_root=output_root, stream_consumer=_read_stream, stream_converter=stream_stand_in)
+
+    assert conversion_pool.get_result(streamed_file_path) == 'spectra'
+    assert conversion_pool.get_result(fallback_file_path) == 'no stream'
+    assert os.listdir(output_root) == []
+
+    conversion_pool.shutdown()
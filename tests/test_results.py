@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from results import ResultTable, initialize_table, get_table_columns, write_table_part, read_table, rewrite_table, compact_table
+
+
+# Test block appends
+
+def test_blocks_broadcast_file_fields():
+
+    table = ResultTable(['file_name', 'run_num', 'observed_mz'], capacity=2)
+    table.append({'file_name':'file_1', 'run_num':1, 'observed_mz':np.array([100.0, 200.0, 300.0])})
+    table.append({'file_name':'file_2', 'run_num':2, 'observed_mz':np.array([400.0])})
+
+    expected_df = pd.DataFrame([{'file_name':'file_1', 'run_num':1, 'observed_mz':100.0},
+                                {'file_name':'file_1', 'run_num':1, 'observed_mz':200.0},
+                                {'file_name':'file_1', 'run_num':1, 'observed_mz':300.0},
+                                {'file_name':'file_2', 'run_num':2, 'observed_mz':400.0}])
+
+    assert len(table) == 4
+    pd.testing.assert_frame_equal(table.to_frame(), expected_df)
+
+def test_columns_keep_and_promote_dtypes():
+
+    table = ResultTable(['observed_intensity', 'ms1_tic'])
+    table.append({'observed_intensity':np.array([1.5, 2.5], dtype=np.float32), 'ms1_tic':([1.0, 2.0], [0.1, 0.2])})
+    assert table.arrays['observed_intensity'].dtype == np.float32
+    assert table.to_frame()['ms1_tic'].iloc[1] == ([1.0, 2.0], [0.1, 0.2])
+
+    table.append({'observed_intensity':np.array([np.nan]), 'ms1_tic':None})
+    assert table.arrays['observed_intensity'].dtype == np.float64
+    assert np.array_equal(table.to_frame()['observed_intensity'], [1.5, 2.5, np.nan], equal_nan=True)
+
+def test_clear_keeps_arrays_and_releases_objects():
+
+    table = ResultTable(['file_name', 'observed_mz'])
+    table.append({'file_name':'file_1', 'observed_mz':np.arange(10.0)})
+    arrays = dict(table.arrays)
+
+    table.clear()
+    table.append({'file_name':'file_2', 'observed_mz':np.array([], dtype=float)})
+
+    assert len(table) == 0
+    assert table.arrays['observed_mz'] is arrays['observed_mz']
+    assert table.arrays['file_name'][5] is None
+
+
+# Test the binary store
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    for idx, value in enumerate(values):
+        array[idx] = value
+    return array
+
+def test_table_parts_round_trip_typed_columns(tmp_path):
+
+    table_dir = os.path.join(tmp_path, 'ms1_tic_data')
+    initialize_table(table_dir, ['file_name', 'run_num', 'compound_name', 'ms1_tic'])
+    assert read_table(table_dir).empty
+
+    write_table_part(table_dir, {'file_name':np.array(['file_1', 'file_2'], dtype=object), 'run_num':np.array([1, 2]),
+                                 'compound_name':np.array(['a', np.nan], dtype=object),
+                                 'ms1_tic':_object_array([([1.0, 2.0], [0.1, 0.2]), ([3.0], [0.3])])})
+    write_table_part(table_dir, {'file_name':np.array(['file_3'], dtype=object), 'run_num':np.array([3]),
+                                 'compound_name':np.array(['c'], dtype=object), 'ms1_tic':_object_array([np.zeros((2, 0))])})
+
+    table_df = read_table(table_dir)
+
+    assert get_table_columns(table_dir) == ['file_name', 'run_num', 'compound_name', 'ms1_tic']
+    assert table_df['file_name'].tolist() == ['file_1', 'file_2', 'file_3']
+    assert table_df['run_num'].dtype == np.int64
+    assert table_df['compound_name'].iloc[0] == 'a' and np.isnan(table_df['compound_name'].iloc[1])
+    assert table_df['ms1_tic'].iloc[0].dtype == np.float32
+    assert np.array_equal(table_df['ms1_tic'].iloc[1], np.array([[3.0], [0.3]], dtype=np.float32))
+    assert table_df['ms1_tic'].iloc[2].shape == (2, 0)
+
+def test_compaction_merges_parts_and_reads_do_not(tmp_path):
+
+    table_dir = os.path.join(tmp_path, 'ms1_peak_data')
+    initialize_table(table_dir, ['run_num'])
+    for run_num in range(5):
+        write_table_part(table_dir, {'run_num':np.array([run_num])})
+
+    part_names = sorted(os.listdir(table_dir))
+    assert read_table(table_dir)['run_num'].tolist() == [0, 1, 2, 3, 4]
+    assert sorted(os.listdir(table_dir)) == part_names
+
+    compact_table(table_dir, max_parts=3)
+    assert len([name for name in os.listdir(table_dir) if name.endswith('.npz')]) == 1
+    assert read_table(table_dir)['run_num'].tolist() == [0, 1, 2, 3, 4]
+
+    write_table_part(table_dir, {'run_num':np.array([5])})
+    compact_table(table_dir, max_parts=3)
+    assert read_table(table_dir)['run_num'].tolist() == [0, 1, 2, 3, 4, 5]
+    assert len([name for name in os.listdir(table_dir) if name.endswith('.npz')]) == 2
+
+def test_rewritten_table_replaces_its_parts(tmp_path):
+
+    table_dir = os.path.join(tmp_path, 'ms1_peak_data')
+    initialize_table(table_dir, ['file_name'])
+    write_table_part(table_dir, {'file_name':np.array(['file_1', 'file_2'], dtype=object)})
+    first_part = write_table_part(table_dir, {'file_name':np.array(['file_3'], dtype=object)})
+
+    table_df = read_table(table_dir)
+    rewrite_table(table_dir, table_df[table_df['file_name'] != 'file_2'])
+
+    assert read_table(table_dir)['file_name'].tolist() == ['file_1', 'file_3']
+    assert not os.path.exists(os.path.join(table_dir, first_part))
@@ -0,0 +1,116 @@
+import numpy as np
+import os
+import time
+import pytest
+from extract_mzml_data import MS1Data
+from spectral_cache import _get_cache_key, _get_extraction_params, store_cached_data, load_cached_data, evict_cache
+
+
+def _make_test_ms1_data():
+
+    ms1_data = MS1Data(chunk_size=8)
+    ms1_data.append_scan(0.5, np.array([100.0, 176.1135]), np.array([1.0, 2.0]), polarity=1)
+    ms1_data.append_scan(0.6, np.array([174.0989]), np.array([3.0]), polarity=-1)
+    ms1_data.trim()
+
+    return ms1_data
+
+# Test cache round trip
+
+def test_cached_data_equals_stored_data(tmp_path):
+
+    ms1_data = _make_test_ms1_data()
+    ms1_tic = ([3.0, 3.0], [0.5, 0.6])
+    ms2_data = [[np.array([[111.0808, 129.1045], [5.0, 6.0]]), np.array([[140.0793], [7.0]])], [], [np.array([[75.01253], [8.0]])]]
+
+    store_cached_data(str(tmp_path), 'test_key', ms1_data, ms1_tic, ms2_data)
+    cached_ms1_data, cached_ms1_tic, cached_ms2_data = load_cached_data(str(tmp_path), 'test_key')
+
+    for stored_array, cached_array in zip(ms1_data, cached_ms1_data):
+        assert np.array_equal(stored_array, cached_array)
+    assert np.array_equal(ms1_data.scan_polarities, cached_ms1_data.scan_polarities)
+    assert cached_ms1_tic == ms1_tic
+    assert [len(entry_spectra) for entry_spectra in cached_ms2_data] == [2, 0, 1]
+    for stored_spectra, cached_spectra in zip(ms2_data, cached_ms2_data):
+        for stored_spec, cached_spec in zip(stored_spectra, cached_spectra):
+            assert np.array_equal(stored_spec, cached_spec)
+
+def test_cache_miss_returns_none(tmp_path):
+
+    assert load_cached_data(str(tmp_path), 'missing_key') is None
+
+def test_entry_evicted_while_loading_is_a_cache_miss(tmp_path):
+
+    store_cached_data(str(tmp_path), 'test_key', _make_test_ms1_data(), ([3.0, 3.0], [0.5, 0.6]), None)
+    os.remove(os.path.join(tmp_path, 'test_key', 'mzs.npy'))
+
+    assert load_cached_data(str(tmp_path), 'test_key') is None
+
+# Test cache keys
+
+def test_cache_key_changes_with_file_and_params(tmp_path):
+
+    raw_file_path = str(tmp_path / 'test.raw')
+    with open(raw_file_path, 'wb') as fh:
+        fh.write(b'raw')
+
+    params = _get_extraction_params(tolerance=0.0015)
+    key = _get_cache_key(raw_file_path, params)
+
+    assert key == _get_cache_key(raw_file_path, params)
+    assert key == _get_cache_key(raw_file_path, _get_extraction_params(tolerance=0.02))
+    assert key != _get_cache_key(raw_file_path, _get_extraction_params(tolerance=0.0015, targets={'POS':np.array([1.0, 2.0])}))
+    assert key == _get_cache_key(raw_file_path, _get_extraction_params(tolerance=0.0015, targets={'POS':np.array([]), 'NEG':np.array([])}))
+
+    with open(raw_file_path, 'ab') as fh:
+        fh.write(b'more')
+
+    assert key != _get_cache_key(raw_file_path, params)
+
+def test_cache_key_follows_panel_entry_order(tmp_path):
+
+    raw_file_path = str(tmp_path / 'test.raw')
+    with open(raw_file_path, 'wb') as fh:
+        fh.write(b'raw')
+
+    panel = {'POS':[{'name':'ISTD_A', 'pmz':200.0, 'diagnostic_ions':[100.0]}, {'name':'ISTD_B', 'pmz':300.0, 'diagnostic_ions':[150.0]}]}
+    reordered_panel = {'POS':panel['POS'][::-1]}
+    renamed_panel = {'POS':[dict(panel['POS'][0], name='ISTD_C'), panel['POS'][1]]}
+
+    key = _get_cache_key(raw_file_path, _get_extraction_params(panel, tolerance=0.0015))
+
+    assert key != _get_cache_key(raw_file_path, _get_extraction_params(reordered_panel, tolerance=0.0015))
+    assert key != _get_cache_key(raw_file_path, _get_extraction_params(renamed_panel, tolerance=0.0015))
+    assert key != _get_cache_key(raw_file_path, _get_extraction_params(panel, tolerance=0.02))
+
+# Test lru eviction
+
+def test_evict_least_recently_used(tmp_path):
+
+    ms1_data = _make_test_ms1_data()
+    for key in ['first', 'second', 'third']:
+        store_cached_data(str(tmp_path), key, ms1_data, ([], []), None)
+        os.utime(os.path.join(str(tmp_path), key, 'meta.json'), (time.time(), time.time()))
+        time.sleep(0.05)
+
+    load_cached_data(str(tmp_path), 'first')
+    entry_size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(str(tmp_path), 'first')))
+
+    evict_cache(str(tmp_path), 2.5 * entry_size / 1024**3)
+
+    assert sorted(os.listdir(str(tmp_path))) == ['first', 'third']
+
+def test_evict_skips_entries_being_written(tmp_path):
+
+    ms1_data = _make_test_ms1_data()
+    store_cached_data(str(tmp_path), 'stored', ms1_data, ([], []), None)
+    store_cached_data(str(tmp_path), 'writing', ms1_data, ([], []), None)
+    os.rename(os.path.join(str(tmp_path), 'writing'), os.path.join(str(tmp_path), 'writing.tmp1'))
+    store_cached_data(str(tmp_path), 'orphaned', ms1_data, ([], []), None)
+    os.rename(os.path.join(str(tmp_path), 'orphaned'), os.path.join(str(tmp_path), 'orphaned.tmp2'))
+    os.utime(os.path.join(str(tmp_path), 'orphaned.tmp2'), (time.time() - 2 * 24 * 3600, time.time() - 2 * 24 * 3600))
+
+    entry_size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(str(tmp_path), 'stored')))
+    evict_cache(str(tmp_path), 1.5 * entry_size / 1024**3)
+
+    assert sorted(os.listdir(str(tmp_path))) == ['stored', 'writing.tmp1']
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from sqlite_store import initialize_db, get_db_columns, insert_rows, query_table, delete_rows, get_distinct_values
+
+
+tables = {'ms1_peak_data':['file_name', 'run_num', 'compound_name', 'observed_intensity'],
+          'ms1_tic_data':['file_name', 'ms1_tic']}
+
+def _object_array(values):
+    array = np.empty(len(values), dtype=object)
+    for idx, value in enumerate(values):
+        array[idx] = value
+    return array
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = os.path.join(tmp_path, 'results.db')
+    initialize_db(db_path, tables, indexes={'ms1_peak_data':[('compound_name', 'run_num'), ('file_name',)]}, trace_columns=['ms1_tic'])
+    return db_path
+
+
+# Test table creation
+
+def test_initialize_creates_wal_tables_and_indexes(db_path):
+
+    assert get_db_columns(db_path, 'ms1_peak_data') == tables['ms1_peak_data']
+    assert get_db_columns(db_path, 'other_table') is None
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    index_names = [row[1] for row in connection.execute('PRAGMA index_list(ms1_peak_data)')]
+    connection.close()
+
+    assert sorted(index_names) == ['ms1_peak_data_compound_name_run_num', 'ms1_peak_data_file_name']
+
+# Test inserts and queries
+
+def test_insert_and_query_slices(db_path):
+
+    insert_rows(db_path, {'ms1_peak_data':{'file_name':np.array(['file_1', 'file_1'], dtype=object), 'run_num':np.array([1, 1]),
+                                           'compound_name':np.array(['a', 'b'], dtype=object), 'observed_intensity':np.array([1.5, 2.5], dtype=np.float32)},
+                          'ms1_tic_data':{'file_name':np.array(['file_1'], dtype=object), 'ms1_tic':_object_array([([1.0, 2.0], [0.1, 0.2])])}})
+    insert_rows(db_path, {'ms1_peak_data':{'file_name':np.array(['file_2'], dtype=object), 'run_num':np.array([2]),
+                                           'compound_name':np.array(['a'], dtype=object), 'observed_intensity':np.array([np.nan])}})
+
+    assert query_table(db_path, 'ms1_peak_data')['file_name'].tolist() == ['file_1', 'file_1', 'file_2']
+
+    compound_df = query_table(db_path, 'ms1_peak_data', compound_name='a', run_num=[1, 2])
+    assert compound_df['run_num'].tolist() == [1, 2]
+    assert compound_df['observed_intensity'].iloc[0] == 1.5 and np.isnan(compound_df['observed_intensity'].iloc[1])
+
+    tic = query_table(db_path, 'ms1_tic_data')['ms1_tic'].iloc[0]
+    assert tic.dtype == np.float32
+    assert np.array_equal(tic, np.array([[1.0, 2.0], [0.1, 0.2]], dtype=np.float32))
+
+def test_delete_rows_of_files(db_path):
+
+    insert_rows(db_path, {'ms1_peak_data':{'file_name':np.array(['file_1', 'file_2', 'file_3'], dtype=object), 'run_num':np.array([1, 2, 3]),
+                                           'compound_name':np.array(['a', 'a', 'a'], dtype=object), 'observed_intensity':np.ones(3)}})
+    delete_rows(db_path, 'ms1_peak_data', 'file_name', ['file_2'])
+
+    assert get_distinct_values(db_path, 'ms1_peak_data', 'file_name') == ['file_1', 'file_3']
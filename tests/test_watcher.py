@@ -0,0 +1,95 @@
+import os
+import time
+import watcher
+from watcher import RawFileWatcher
+
+def _write_raw(path, content=b'raw'):
+    with open(path, 'ab') as raw_file:
+        raw_file.write(content)
+
+def test_is_complete_waits_for_stable_size(tmp_path):
+    raw_path = str(tmp_path / 'test.raw')
+    _write_raw(raw_path)
+    now = time.time()
+
+    raw_watcher = RawFileWatcher(str(tmp_path), stable_seconds=30)
+    try:
+        assert not raw_watcher.is_complete(raw_path, now=now)
+        assert raw_watcher.is_complete(raw_path, now=now + 31)
+
+        _write_raw(raw_path)
+        assert not raw_watcher.is_complete(raw_path, now=now + 32)
+        assert raw_watcher.get_seconds_until_complete([raw_path], now=now + 40) == 22
+        assert raw_watcher.is_complete(raw_path, now=now + 63)
+    finally:
+        raw_watcher.stop()
+
+def test_is_complete_trusts_old_files(tmp_path):
+    raw_path = str(tmp_path / 'test.raw')
+    _write_raw(raw_path)
+    os.utime(raw_path, (time.time() - 3600, time.time() - 3600))
+
+    raw_watcher = RawFileWatcher(str(tmp_path), stable_seconds=30)
+    try:
+        assert raw_watcher.is_complete(raw_path)
+        assert not raw_watcher.is_complete(str(tmp_path / 'missing.raw'))
+    finally:
+        raw_watcher.stop()
+
+def test_is_complete_probes_handle(tmp_path, monkeypatch):
+    raw_path = str(tmp_path / 'test.raw')
+    _write_raw(raw_path)
+    os.utime(raw_path, (time.time() - 3600, time.time() - 3600))
+    monkeypatch.setattr(watcher, '_probe_file_handle', lambda file_path: False)
+
+    raw_watcher = RawFileWatcher(str(tmp_path), stable_seconds=30)
+    try:
+        assert not raw_watcher.is_complete(raw_path)
+        raw_watcher.probe_handle = False
+        assert raw_watcher.is_complete(raw_path)
+    finally:
+        raw_watcher.stop()
+
+def test_wait_for_change_polling(tmp_path, monkeypatch):
+    monkeypatch.setattr(watcher, 'Observer', None)
+
+    raw_watcher = RawFileWatcher(str(tmp_path), poll_interval=0.1)
+    start = time.time()
+    assert not raw_watcher.wait_for_change(60)
+    assert time.time() - start < 5
+    raw_watcher.stop()
+
+def test_wait_for_change_event(tmp_path):
+    if watcher.Observer is None:
+        return
+
+    raw_watcher = RawFileWatcher(str(tmp_path))
+    try:
+        _write_raw(str(tmp_path / 'test.raw'))
+        assert raw_watcher.wait_for_change(10)
+    finally:
+        raw_watcher.stop()
+
+def test_probe_file_handle_never_creates_files(tmp_path):
+    raw_path = str(tmp_path / 'deleted.raw')
+
+    assert not watcher._probe_file_handle(raw_path)
+    assert not os.path.exists(raw_path)
+
+def test_probe_file_handle_read_only_file(tmp_path, monkeypatch):
+    raw_path = str(tmp_path / 'test.raw')
+    _write_raw(raw_path)
+    os.chmod(raw_path, 0o444)
+    assert watcher._probe_file_handle(raw_path)
+
+    def deny_open(*args, **kwargs):
+        raise PermissionError('read-only share')
+    monkeypatch.setattr(watcher, 'open', deny_open, raising=False)
+    assert watcher._probe_file_handle(raw_path)
+
+def test_watcher_uses_default_stable_seconds(tmp_path):
+    raw_watcher = RawFileWatcher(str(tmp_path))
+    try:
+        assert raw_watcher.stable_seconds == watcher.default_stable_seconds
+    finally:
+        raw_watcher.stop()
@@ -0,0 +1,145 @@
+#watch the experimental directory for raw files and decide when their acquisition has finished
+
+import os
+import time
+import threading
+import ctypes
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+class _RawFileEventHandler(FileSystemEventHandler):
+
+    def __init__(self, changed):
+        self.changed = changed
+
+    def on_any_event(self, event):
+        paths = [getattr(event, 'src_path', ''), getattr(event, 'dest_path', '')]
+        if any(str(path).lower().endswith('.raw') for path in paths):
+            self.changed.set()
+
+default_stable_seconds = 15
+
+#win32 constants for the share-mode probe
+_generic_read = 0x80000000
+_file_share_read = 0x1
+_open_existing = 3
+_sharing_violation_errors = (32, 33)
+_missing_file_errors = (2, 3)
+
+def _probe_windows_handle(file_path):
+    """Opens file_path for reading while denying other writers, which fails with a sharing violation while the file is being written."""
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.CreateFileW.restype = ctypes.c_void_p
+    handle = kernel32.CreateFileW(file_path, _generic_read, _file_share_read, None, _open_existing, 0, None)
+    if handle is None or handle == ctypes.c_void_p(-1).value:
+        error = ctypes.get_last_error()
+        return error not in _sharing_violation_errors and error not in _missing_file_errors
+    kernel32.CloseHandle(ctypes.c_void_p(handle))
+    return True
+
+def _probe_file_handle(file_path):
+    """False while another process (the acquisition software) holds the raw file open for writing.
+
+    The file is only opened for reading and never created. Missing files are not complete; a file that
+    cannot be read because of its permissions (read-only file or share) is not being written and counts as free.
+    """
+
+    if os.name == 'nt':
+        return _probe_windows_handle(file_path)
+    try:
+        with open(file_path, 'rb'):
+            pass
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+class RawFileWatcher():
+    """Wakes up on raw file create/modify events and tracks when each file stops changing.
+
+    Events come from watchdog (inotify on Linux, ReadDirectoryChangesW on Windows) when it is installed,
+    otherwise the directory is polled every poll_interval seconds. A file is complete once its size and
+    mtime have not changed for stable_seconds and, with probe_handle, no other process holds it open for writing.
+    Watchers of several directories can share one changed event.
+    """
+
+    def __init__(self, path, stable_seconds=default_stable_seconds, probe_handle=True, poll_interval=5, changed=None):
+        self.path = path
+        self.stable_seconds = stable_seconds
+        self.probe_handle = probe_handle
+        self.poll_interval = poll_interval
+        self.file_states = {}
+        self.changed = threading.Event() if changed is None else changed
+        self.observer = None
+
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(_RawFileEventHandler(self.changed), path, recursive=False)
+            self.observer.daemon = True
+            self.observer.start()
+
+    def _get_unchanged_since(self, file_path, now):
+        """Time since which the size and mtime of file_path are unchanged. Unseen files are trusted from their mtime."""
+
+        file_stat = os.stat(file_path)
+        signature = (file_stat.st_size, file_stat.st_mtime_ns)
+
+        previous_state = self.file_states.get(file_path)
+        if previous_state is None:
+            self.file_states[file_path] = (signature, min(now, file_stat.st_mtime))
+        elif previous_state[0] != signature:
+            self.file_states[file_path] = (signature, now)
+
+        return self.file_states[file_path][1]
+
+    def is_complete(self, file_path, now=None):
+
+        now = time.time() if now is None else now
+        try:
+            unchanged_since = self._get_unchanged_since(file_path, now)
+        except OSError:
+            return False
+
+        if now - unchanged_since < self.stable_seconds:
+            return False
+
+        return not self.probe_handle or _probe_file_handle(file_path)
+
+    def get_seconds_until_complete(self, file_paths, now=None):
+        """Shortest wait before one of file_paths can become complete, at least one second."""
+
+        now = time.time() if now is None else now
+        wait_times = []
+        for file_path in file_paths:
+            try:
+                wait_times.append(self.stable_seconds - (now - self._get_unchanged_since(file_path, now)))
+            except OSError:
+                continue
+
+        return max(1, min(wait_times, default=self.stable_seconds))
+
+    def wait_for_change(self, timeout):
+        """Block until a raw file event or the timeout. Without events, wake at least every poll_interval to rescan."""
+
+        if self.observer is None:
+            timeout = min(timeout, self.poll_interval)
+
+        changed = self.changed.wait(timeout)
+        self.changed.clear()
+
+        return changed
+
+    def forget(self, file_path):
+        self.file_states.pop(file_path, None)
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()